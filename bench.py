@@ -0,0 +1,503 @@
+"""
+Офлайн-бенчмарк обработчиков бота без подключения к Discord
+
+Гоняет настоящие обработчики из main.py (on_message, on_voice_state_update,
+on_member_update, on_bulk_message_delete, log_action) синтетическими потоками
+событий через заглушки Guild/Member/Channel.
+
+Запуск:
+    python bench.py                      # in-memory заменитель Postgres
+    python bench.py --postgres           # локальный Postgres из DATABASE_URL (или --dsn)
+    python bench.py --events 5000 --users 500 --concurrency 100 --json результат.json
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+# main.py и db.py требуют переменные окружения на импорте - для офлайн-прогона хватит заглушек
+os.environ.setdefault('DISCORD_BOT_TOKEN', 'offline-benchmark')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import db
+import main
+
+# ========== IN-MEMORY ЗАМЕНИТЕЛЬ POSTGRES ==========
+
+class FakeConnection:
+    """Понимает ровно те запросы, которые делает бот (реестр db.QUERIES), и считает их"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_server_pid(self):
+        # Подготовленных запросов нет - db.run_query пойдет по текстовому SQL
+        return 0
+
+    def _count(self, query):
+        self.store.queries += 1
+        self.store.by_kind[' '.join(query.split())[:40]] += 1
+
+    async def fetchrow(self, query, *args, timeout=None):
+        self._count(query)
+        if 'UPDATE users' in query and 'old_total_xp' in query:
+            return self._add_user_xp(*args)
+        if 'INSERT INTO users' in query and 'old_total_xp' in query:
+            if args[0] in self.store.users:
+                return None
+            self.store.users[args[0]] = {
+                'user_id': args[0], 'text_xp': 0, 'text_level': 1, 'voice_xp': 0, 'voice_level': 1,
+                'total_xp': 0, 'total_level': 1, 'prestige': 0, 'profile_text': None, 'profile_text_updated': None
+            }
+            return self._add_user_xp(*args)
+        if 'FROM users WHERE user_id' in query:
+            row = self.store.users.get(args[0])
+            return dict(row) if row else None
+        if 'FROM server_settings' in query:
+            return self.store.settings.get(args[0])
+        return None
+
+    async def fetch(self, query, *args, timeout=None):
+        self._count(query)
+        if 'FROM users' in query and 'ORDER BY' in query:
+            field = query.split('ORDER BY')[1].split()[0]
+            rows = sorted(self.store.users.values(), key=lambda row: (row[field], row['user_id']), reverse=True)
+            if 'WHERE' in query:
+                # Keyset: строки после курсора (xp, user_id)
+                rows = [row for row in rows if (row[field], row['user_id']) < (args[0], args[1])]
+            level = field.replace('_xp', '_level')
+            return [{'user_id': row['user_id'], 'xp': row[field], 'level': row[level]} for row in rows[:args[-1]]]
+        return []
+
+    async def fetchval(self, query, *args, timeout=None):
+        self._count(query)
+        return None
+
+    async def execute(self, query, *args, timeout=None):
+        self._count(query)
+        if 'INSERT INTO users' in query:
+            self._upsert_user(query, args)
+        elif 'INSERT INTO server_settings' in query:
+            column = 'log_channel' if 'log_channel' in query.split('VALUES')[0] else 'notification_channel'
+            settings = self.store.settings.setdefault(args[0], {'notification_channel': None, 'log_channel': None})
+            settings[column] = args[1]
+        return 'OK'
+
+    def _add_user_xp(self, user_id, text_delta, voice_delta, xp_per_level, max_level):
+        row = self.store.users.get(user_id)
+        if row is None:
+            return None
+        old = {f'old_{xp_type}_level': row[f'{xp_type}_level'] for xp_type in ('text', 'voice', 'total')}
+        old['old_total_xp'] = row['total_xp']
+        row['text_xp'] = max(0, row['text_xp'] + text_delta)
+        row['voice_xp'] = max(0, row['voice_xp'] + voice_delta)
+        row['total_xp'] = row['text_xp'] + row['voice_xp']
+        for xp_type in ('text', 'voice', 'total'):
+            row[f'{xp_type}_level'] = min(row[f'{xp_type}_xp'] // xp_per_level + 1, max_level)
+        row['last_updated'] = datetime.now()
+        result = {key: row[key] for key in ('text_xp', 'text_level', 'voice_xp', 'voice_level', 'total_xp', 'total_level')}
+        result.update(old)
+        return result
+
+    def _upsert_user(self, query, args):
+        columns = [c.strip() for c in query.split('(', 1)[1].split(')', 1)[0].split(',')]
+        values = [v.strip() for v in query.split('VALUES', 1)[1].split('(', 1)[1].split(')', 1)[0].split(',')]
+
+        row = {}
+        for column, value in zip(columns, values):
+            if value.startswith('$'):
+                row[column] = args[int(value[1:]) - 1]
+            elif value.upper().startswith('NOW'):
+                row[column] = datetime.now()
+            else:
+                row[column] = int(value)
+
+        if 'DO NOTHING' in query and row['user_id'] in self.store.users:
+            return
+        self.store.users.setdefault(row['user_id'], {}).update(row)
+
+class FakePool:
+    """Заменитель asyncpg.Pool с настраиваемой задержкой на запрос"""
+
+    def __init__(self, latency=0.0):
+        self.users = {}
+        self.settings = {}
+        self.queries = 0
+        self.by_kind = defaultdict(int)
+        self.latency = latency
+
+    def acquire(self, timeout=None):
+        pool = self
+
+        class _Acquire:
+            async def __aenter__(self):
+                if pool.latency:
+                    await asyncio.sleep(pool.latency)
+                return FakeConnection(pool)
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Acquire()
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+    def get_max_size(self):
+        return 1
+
+    async def close(self):
+        pass
+
+# ========== ЗАГЛУШКИ DISCORD ==========
+
+class FakeAsset:
+    def __init__(self, user_id):
+        self.url = f"https://cdn.discordapp.com/embed/avatars/{user_id % 5}.png"
+
+class FakePermissions:
+    def __init__(self, admin=False):
+        self.administrator = admin
+        self.manage_messages = admin
+
+class FakeRole:
+    def __init__(self, role_id, guild):
+        self.id = role_id
+        self.name = f"role-{role_id}"
+        self.mention = f"<@&{role_id}>"
+        self.guild = guild
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeMember:
+    def __init__(self, user_id, guild, bot=False):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = bot
+        self.guild = guild
+        self.roles = []
+        self.nick = None
+        self.timed_out_until = None
+        self.display_avatar = FakeAsset(user_id)
+        self.guild_permissions = FakePermissions()
+        self.voice = None
+        self.joined_at = datetime.now().astimezone() - timedelta(days=30)
+        self.created_at = datetime.now().astimezone() - timedelta(days=365)
+
+    def clone(self, **changes):
+        copy = FakeMember.__new__(FakeMember)
+        copy.__dict__.update(self.__dict__)
+        copy.__dict__.update(changes)
+        return copy
+
+class FakeChannel:
+    def __init__(self, channel_id, guild, gateway, voice=False):
+        self.id = channel_id
+        self.name = f"{'voice' if voice else 'text'}-{channel_id}"
+        self.mention = f"<#{channel_id}>"
+        self.guild = guild
+        self.gateway = gateway
+        self.members = []
+
+    async def send(self, content=None, embed=None, **kwargs):
+        if self.gateway.api_latency:
+            await asyncio.sleep(self.gateway.api_latency)
+        self.gateway.sent += 1
+
+class FakeVoiceState:
+    def __init__(self, channel=None, self_mute=False, self_deaf=False):
+        self.channel = channel
+        self.self_mute = self_mute
+        self.self_deaf = self_deaf
+        self.mute = False
+        self.deaf = False
+
+class FakeMessage:
+    def __init__(self, message_id, author, channel, content):
+        self.id = message_id
+        self.author = author
+        self.guild = channel.guild
+        self.channel = channel
+        self.content = content
+        self.attachments = []
+        self.pinned = False
+
+class FakeGuild:
+    def __init__(self, guild_id, gateway, member_count, role_count=20):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.gateway = gateway
+        self.system_channel = None
+        self.members = {}
+        self.roles = [FakeRole(guild_id * 1000 + idx, self) for idx in range(role_count)]
+        self.text_channel = FakeChannel(guild_id * 10 + 1, self, gateway)
+        self.log_channel = FakeChannel(guild_id * 10 + 2, self, gateway)
+        self.voice_channels = [FakeChannel(guild_id * 10 + 3 + idx, self, gateway, voice=True) for idx in range(3)]
+
+        for idx in range(member_count):
+            member = FakeMember(guild_id * 100000 + idx, self)
+            self.members[member.id] = member
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def audit_logs(self, limit=100, action=None, **kwargs):
+        # Пустой аудит-лог, но с задержкой как у настоящего HTTP-запроса
+        self.gateway.audit_calls += 1
+        if self.gateway.api_latency:
+            await asyncio.sleep(self.gateway.api_latency)
+        return
+        yield
+
+class FakeGateway:
+    """Набор серверов и счетчики "исходящих" вызовов API"""
+
+    def __init__(self, guild_count, members_per_guild, api_latency=0.0):
+        self.api_latency = api_latency
+        self.sent = 0
+        self.audit_calls = 0
+        self.guilds = [FakeGuild(idx + 1, self, members_per_guild) for idx in range(guild_count)]
+        self.channels = {}
+        for guild in self.guilds:
+            for channel in [guild.text_channel, guild.log_channel, *guild.voice_channels]:
+                self.channels[channel.id] = channel
+        self.bot_user = FakeMember(1, None, bot=True)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_guild(self, guild_id):
+        for guild in self.guilds:
+            if guild.id == guild_id:
+                return guild
+        return None
+
+def attach_gateway(gateway):
+    """Подмена обращений бота к кэшу гейтвея на заглушки"""
+    async def process_commands(message):
+        return None
+
+    main.bot.get_channel = gateway.get_channel
+    main.bot.get_guild = gateway.get_guild
+    main.bot.process_commands = process_commands
+    main.bot._connection.user = gateway.bot_user
+
+# ========== СЦЕНАРИИ ==========
+
+def message_events(gateway, count):
+    message_id = 0
+    for _ in range(count):
+        guild = random.choice(gateway.guilds)
+        author = random.choice(list(guild.members.values()))
+        message_id += 1
+        yield 'on_message', (FakeMessage(message_id, author, guild.text_channel, "привет " * random.randint(1, 20)),)
+
+def voice_events(gateway, count):
+    in_voice = {}
+    for _ in range(count):
+        guild = random.choice(gateway.guilds)
+        member = random.choice(list(guild.members.values()))
+        before_channel = in_voice.get(member.id)
+
+        roll = random.random()
+        if before_channel is None:
+            after_channel = random.choice(guild.voice_channels)
+        elif roll < 0.4:
+            after_channel = None
+        elif roll < 0.7:
+            after_channel = random.choice(guild.voice_channels)
+        else:
+            after_channel = before_channel
+
+        if after_channel is None:
+            in_voice.pop(member.id, None)
+        else:
+            in_voice[member.id] = after_channel
+
+        before = FakeVoiceState(before_channel)
+        after = FakeVoiceState(after_channel, self_mute=after_channel is before_channel and random.random() < 0.5)
+        yield 'on_voice_state_update', (member, before, after)
+
+def member_update_events(gateway, count):
+    for _ in range(count):
+        guild = random.choice(gateway.guilds)
+        member = random.choice(list(guild.members.values()))
+        before = member.clone(roles=list(member.roles))
+
+        role = random.choice(guild.roles)
+        if role in member.roles:
+            member.roles.remove(role)
+        else:
+            member.roles.append(role)
+
+        yield 'on_member_update', (before, member.clone(roles=list(member.roles)))
+
+def bulk_delete_events(gateway, count, batch_size=50):
+    message_id = 10 ** 9
+    for _ in range(count):
+        guild = random.choice(gateway.guilds)
+        members = list(guild.members.values())
+        messages = []
+        for idx in range(batch_size):
+            message_id += 1
+            author = gateway.bot_user if idx % 10 == 0 else random.choice(members)
+            messages.append(FakeMessage(message_id, author, guild.text_channel, "спам"))
+        yield 'on_bulk_message_delete', (messages,)
+
+def log_action_events(gateway, count):
+    for _ in range(count):
+        guild = random.choice(gateway.guilds)
+        member = random.choice(list(guild.members.values()))
+        yield 'log_action', (guild, "🧪 Бенчмарк", "Синтетическая запись", main.COLORS['INFO'], member)
+
+SCENARIOS = {
+    'message': message_events,
+    'voice': voice_events,
+    'member_update': member_update_events,
+    'bulk_delete': bulk_delete_events,
+    'log_action': log_action_events
+}
+
+# ========== ИЗМЕРЕНИЯ ==========
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+def db_calls():
+    """Число обращений к БД по реестру метрик (одинаково для обоих бэкендов)"""
+    return sum(
+        hist['count']
+        for (name, _), hist in main.metrics.histograms.items()
+        if name == 'db_query_seconds'
+    )
+
+async def run_scenario(name, gateway, pool, args):
+    events = list(SCENARIOS[name](gateway, args.events))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def run_one(handler_name, handler_args):
+        async with semaphore:
+            handler = main.log_action if handler_name == 'log_action' else getattr(main.bot, handler_name)
+            start = time.perf_counter()
+            await handler(*handler_args)
+            latencies.append(time.perf_counter() - start)
+
+    queries_before = pool.queries if isinstance(pool, FakePool) else None
+    db_before = db_calls()
+    sent_before, audit_before = gateway.sent, gateway.audit_calls
+    rss_before = main.rss_bytes()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(handler_name, handler_args) for handler_name, handler_args in events))
+
+    # Агрегированные изменения уходят после дебаунса - дожидаемся их отправки
+    await asyncio.gather(*(batch['task'] for batch in list(main.pending_changes.values())))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        'scenario': name,
+        'events': len(events),
+        'seconds': round(elapsed, 3),
+        'events_per_second': round(len(events) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'db_calls_per_event': round((db_calls() - db_before) / len(events), 3),
+        'messages_sent': gateway.sent - sent_before,
+        'audit_log_calls': gateway.audit_calls - audit_before,
+        'rss_growth_kb': (main.rss_bytes() - rss_before) // 1024
+    }
+    if queries_before is not None:
+        result['queries_per_event'] = round((pool.queries - queries_before) / len(events), 3)
+    return result
+
+async def setup_database(args, gateway):
+    if args.postgres:
+        if args.dsn:
+            db.CONFIG['DATABASE_URL'] = args.dsn
+        await db.init_database()
+        pool = db.db_pool
+    else:
+        pool = db.db_pool = FakePool(latency=args.db_latency / 1000)
+
+    for guild in gateway.guilds:
+        await main.set_log_channel(guild.id, guild.log_channel.id)
+
+    return pool
+
+async def run(args):
+    random.seed(args.seed)
+
+    main.CONFIG['TEXT_COOLDOWN'] = args.cooldown
+    main.CONFIG['CHANGE_DEBOUNCE_SECONDS'] = 0.05
+    main.CONFIG['CHANGE_DEBOUNCE_MAX_SECONDS'] = 0.5
+
+    gateway = FakeGateway(args.guilds, args.users, api_latency=args.api_latency / 1000)
+    attach_gateway(gateway)
+    pool = await setup_database(args, gateway)
+
+    results = []
+    try:
+        for name in args.scenarios:
+            results.append(await run_scenario(name, gateway, pool, args))
+    finally:
+        if args.postgres:
+            await db.close_database()
+
+    return results
+
+def print_table(results):
+    columns = [
+        ('scenario', 'сценарий'), ('events', 'событий'), ('events_per_second', 'событий/с'),
+        ('p50_ms', 'p50 мс'), ('p99_ms', 'p99 мс'), ('db_calls_per_event', 'БД/событие'),
+        ('messages_sent', 'отправлено'), ('audit_log_calls', 'аудит'), ('rss_growth_kb', 'RSS +КБ')
+    ]
+    widths = [max(len(title), *(len(str(r[key])) for r in results)) for key, title in columns]
+    print("  ".join(title.ljust(width) for (_, title), width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[key]).ljust(width) for (key, _), width in zip(columns, widths)))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--events', type=int, default=2000, help="событий на сценарий")
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--users', type=int, default=200, help="участников на сервер")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременно обрабатываемых событий")
+    parser.add_argument('--cooldown', type=int, default=0, help="кулдаун текстового XP (0 - XP за каждое сообщение)")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="задержка in-memory БД на запрос, мс")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка заглушек Discord API, мс")
+    parser.add_argument('--postgres', action='store_true', help="использовать настоящий Postgres вместо in-memory")
+    parser.add_argument('--dsn', help="строка подключения к Postgres (по умолчанию DATABASE_URL)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help="сохранить результаты в JSON-файл")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
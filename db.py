@@ -0,0 +1,976 @@
+"""
+Общее ядро бота, воркера и утилит: конфигурация, логирование и метрики,
+миграции схемы, пул Postgres с реестром подготовленных запросов,
+предохранитель БД, начисление опыта и история XP.
+
+Импортируется из main.py, worker.py и xp_tool.py. Discord здесь не нужен:
+воркеру и утилитам хватает DATABASE_URL. Логирование настраивает тот,
+кто запускает процесс (setup_logging), - импорт ничего не запускает.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import logging.handlers
+import queue
+from datetime import date, timedelta
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from dotenv import load_dotenv
+import asyncpg
+
+# Загрузка переменных окружения
+load_dotenv()
+
+# Конфигурация
+CONFIG = {
+    'TOKEN': os.getenv('DISCORD_BOT_TOKEN'),
+    'DATABASE_URL': os.getenv('DATABASE_URL'),
+    'MAX_LEVEL': 1000,
+    'TEXT_XP_MIN': 5,
+    'TEXT_XP_MAX': 10,
+    'TEXT_COOLDOWN': 30,
+    'VOICE_XP_PER_MINUTE': 5,
+    'XP_PER_LEVEL': 100,
+    'ADMIN_ALERT_ENABLED': True,
+    'LOG_LEVEL': os.getenv('LOG_LEVEL', 'INFO').upper(),  # DEBUG включает подробные логи XP/войса
+    'METRICS_HOST': os.getenv('METRICS_HOST', '127.0.0.1'),
+    'METRICS_PORT': int(os.getenv('METRICS_PORT', '0')),  # 0 - эндпоинт метрик выключен
+    'PROFILE_ENABLED': os.getenv('PROFILE_ENABLED', '0') == '1',  # Замеры обработчиков и лагов цикла событий
+    'SLOW_CALLBACK_SECONDS': float(os.getenv('SLOW_CALLBACK_SECONDS', '0.1')),
+    'DEV_GUILD_ID': int(os.getenv('DEV_GUILD_ID', '0')),  # Синхронизировать команды только на тестовый сервер
+    'FORCE_COMMAND_SYNC': os.getenv('FORCE_COMMAND_SYNC', '0') == '1',
+    # Пул соединений с БД
+    'DB_POOL_MIN_SIZE': int(os.getenv('DB_POOL_MIN_SIZE', '5')),
+    'DB_POOL_MAX_SIZE': int(os.getenv('DB_POOL_MAX_SIZE', '20')),
+    'DB_STATEMENT_CACHE_SIZE': int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100')),
+    'DB_COMMAND_TIMEOUT': float(os.getenv('DB_COMMAND_TIMEOUT', '60')),
+    'DB_CONNECT_TIMEOUT': float(os.getenv('DB_CONNECT_TIMEOUT', '10')),
+    'DB_MAX_INACTIVE_LIFETIME': float(os.getenv('DB_MAX_INACTIVE_LIFETIME', '300')),
+    'DB_CALL_TIMEOUT': float(os.getenv('DB_CALL_TIMEOUT', '3')),  # Дедлайн одного обращения к БД (с ожиданием пула)
+    'DB_BREAKER_THRESHOLD': int(os.getenv('DB_BREAKER_THRESHOLD', '5')),  # Сбоев подряд до размыкания
+    'DB_BREAKER_COOLDOWN': float(os.getenv('DB_BREAKER_COOLDOWN', '15')),  # Пауза перед пробным запросом
+    'USER_CACHE_SIZE': int(os.getenv('USER_CACHE_SIZE', '10000')),  # Карточек в кэше для деградированного режима
+    # Шардинг: SHARDED=1 - AutoShardedBot; SHARD_IDS - кластерный режим, процесс держит только эти шарды
+    'SHARDED': os.getenv('SHARDED', '0') == '1',
+    'SHARD_COUNT': int(os.getenv('SHARD_COUNT', '0')),  # 0 - сколько рекомендует Discord
+    'SHARD_IDS': os.getenv('SHARD_IDS', ''),  # "0-3" или "0,2,4"; пусто - все шарды в этом процессе
+    # Шлюз: интенты и кэш участников
+    'GATEWAY_PROFILE': os.getenv('GATEWAY_PROFILE', 'lean'),  # lean - только нужные обработчикам, full - Intents.all()
+    'GATEWAY_PRESENCES': os.getenv('GATEWAY_PRESENCES', '0') == '1',  # Статус и активность в /статистика
+    'MEMBER_CACHE': os.getenv('MEMBER_CACHE', 'all'),  # all - все участники, voice - только в голосовых (логи ролей, ников и выходов - только по ним)
+    'CHUNK_GUILDS': os.getenv('CHUNK_GUILDS', '1') == '1',  # Загрузка всех участников при старте (для MEMBER_CACHE=all)
+    'CLUSTER_ID': int(os.getenv('CLUSTER_ID', '0')),  # Номер процесса кластера (смещение порта метрик, логи)
+    # Выносной воркер (worker.py): учет XP и запись аудита в отдельном процессе
+    'WORKER_SOCKET': os.getenv('WORKER_SOCKET', ''),  # Unix-сокет воркера; пусто - все в процессе бота
+    'WORKER_SPAWN': os.getenv('WORKER_SPAWN', '0') == '1',  # Запускать воркер дочерним процессом
+    'WORKER_FLUSH_SECONDS': float(os.getenv('WORKER_FLUSH_SECONDS', '1')),  # Период записи пачек в воркере
+    'WORKER_MAX_BUFFER': 1_000_000,  # Байт в буфере сокета, сверх которых события обрабатываются локально
+    'XP_HISTORY_FLUSH_SECONDS': int(os.getenv('XP_HISTORY_FLUSH_SECONDS', '30')),  # Период записи истории XP
+    'XP_HISTORY_RETENTION_DAYS': int(os.getenv('XP_HISTORY_RETENTION_DAYS', '90')),  # Срок хранения дневных корзин
+    'XP_HISTORY_WEEK_RETENTION_DAYS': int(os.getenv('XP_HISTORY_WEEK_RETENTION_DAYS', '365')),  # Недельных корзин
+    'XP_HISTORY_MONTH_RETENTION_DAYS': int(os.getenv('XP_HISTORY_MONTH_RETENTION_DAYS', '730')),  # Месячных корзин
+    # Графические карточки ранга (нужен Pillow)
+    'RANK_CARDS': os.getenv('RANK_CARDS', '1') == '1',
+    'RANK_CARD_FONT': os.getenv('RANK_CARD_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'),
+    'RANK_CARD_BACKGROUND': os.getenv('RANK_CARD_BACKGROUND', ''),  # Картинка фона 934x282 (пусто - заливка)
+    'RANK_CARD_THREADS': int(os.getenv('RANK_CARD_THREADS', '2')),
+    'AVATAR_CACHE_SIZE': int(os.getenv('AVATAR_CACHE_SIZE', '512')),
+    'RANK_CARD_CACHE_SIZE': int(os.getenv('RANK_CARD_CACHE_SIZE', '1024')),
+    # Страницы топа: keyset-пагинация и короткий кэш страниц по серверу
+    'LEADERBOARD_PAGE_SIZE': int(os.getenv('LEADERBOARD_PAGE_SIZE', '10')),
+    'LEADERBOARD_CACHE_SECONDS': int(os.getenv('LEADERBOARD_CACHE_SECONDS', '30')),
+    'LEADERBOARD_CACHE_SIZE': 2048,
+    'LEADERBOARD_MAX_SCAN': int(os.getenv('LEADERBOARD_MAX_SCAN', '1000')),  # Строк топа на страницу (пропуск не-участников)
+    # Имена и аватары участников для топов и уведомлений
+    'MEMBER_CACHE_SECONDS': int(os.getenv('MEMBER_CACHE_SECONDS', '600')),
+    'MEMBER_CACHE_SIZE': int(os.getenv('MEMBER_CACHE_SIZE', '50000')),
+    'MEMBER_QUERY_TIMEOUT': 10,  # Ожидание ответа шлюза на запрос участников
+    # Место в рейтинге: индекс в памяти, периодически сверяемый с БД
+    'RANK_REFRESH_SECONDS': int(os.getenv('RANK_REFRESH_SECONDS', '300')),  # Сверка (XP из воркера и других процессов)
+    'RANK_LOAD_TIMEOUT': 60,  # Таймаут загрузки гистограммы опыта
+    # Выполнение слеш-команд: авто-defer, лимиты параллельности и частоты
+    'COMMAND_DEFER_AFTER': float(os.getenv('COMMAND_DEFER_AFTER', '2')),  # Нет ответа за столько секунд - defer (лимит Discord 3с)
+    'COMMAND_DEFER_BUDGET': float(os.getenv('COMMAND_DEFER_BUDGET', '1')),  # Ожидаемая длительность выше - defer сразу
+    'COMMAND_CONCURRENCY': int(os.getenv('COMMAND_CONCURRENCY', '8')),  # Одновременных вызовов одной команды
+    'COMMAND_QUEUE_TIMEOUT': 10,  # Максимальное ожидание свободного слота команды
+    'USER_RATE_PER_MINUTE': float(os.getenv('USER_RATE_PER_MINUTE', '20')),  # Команд в минуту на пользователя
+    'USER_RATE_BURST': int(os.getenv('USER_RATE_BURST', '5')),  # Команд подряд без ожидания
+    # Очистка сообщений (/очистить): фоновое задание с потоковым чтением истории
+    'PURGE_MAX_MESSAGES': 10000,  # Сообщений на удаление за одно задание
+    'PURGE_MAX_SCAN': 100000,  # Сообщений истории, просматриваемых одним заданием
+    'PURGE_SINGLE_DELETE_INTERVAL': 1.1,  # Пауза между удалениями старше 14 дней (поштучно)
+    'PURGE_PROGRESS_INTERVAL': 3,  # Период обновления прогресса
+    # Массовая модерация (/массово)
+    'BATCH_MAX_TARGETS': 200,  # Участников за одну команду (лимит bulk ban Discord)
+    'BATCH_CONCURRENCY': 5,  # Одновременных запросов кика/таймаута (лимиты корзин соблюдает discord.py)
+    # Детектор рейдов: скользящее окно входов на сервер
+    'RAID_WINDOW_SECONDS': int(os.getenv('RAID_WINDOW_SECONDS', '30')),
+    'RAID_JOIN_THRESHOLD': int(os.getenv('RAID_JOIN_THRESHOLD', '10')),  # Входов за окно
+    'RAID_YOUNG_THRESHOLD': int(os.getenv('RAID_YOUNG_THRESHOLD', '5')),  # Входов свежих аккаунтов за окно
+    'RAID_ACCOUNT_AGE_DAYS': int(os.getenv('RAID_ACCOUNT_AGE_DAYS', '7')),  # Аккаунт моложе - свежий
+    'RAID_SIMILAR_THRESHOLD': int(os.getenv('RAID_SIMILAR_THRESHOLD', '4')),  # Входов с похожими именами за окно
+    'RAID_COOLDOWN_SECONDS': int(os.getenv('RAID_COOLDOWN_SECONDS', '120')),  # Тишина, после которой рейд завершен
+    'RAID_AUTO_TIMEOUT': os.getenv('RAID_AUTO_TIMEOUT', '0') == '1',  # Таймаут всем вошедшим во время рейда
+    'RAID_TIMEOUT_MINUTES': int(os.getenv('RAID_TIMEOUT_MINUTES', '60')),
+    'RAID_AUTO_LOCKDOWN': os.getenv('RAID_AUTO_LOCKDOWN', '0') == '1',  # Максимальный уровень проверки на время рейда
+    'CHANGE_DEBOUNCE_SECONDS': 3,  # Тишина, после которой пачка изменений уходит в лог
+    'CHANGE_DEBOUNCE_MAX_SECONDS': 15  # Максимальная задержка пачки при непрерывных изменениях
+}
+
+if not CONFIG['DATABASE_URL']:
+    raise ValueError("URL базы данных не найден! Установите переменную DATABASE_URL")
+
+# ========== ЛОГИРОВАНИЕ И МЕТРИКИ ==========
+
+log = logging.getLogger('bot')
+
+def setup_logging(tag=""):
+    """
+    Логгер с очередью: в цикле событий только put, вывод в stdout - в отдельном потоке
+    tag - подпись процесса в строках лога; вызывающий останавливает возвращенный listener
+    """
+    log_queue = queue.SimpleQueue()
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(f'%(asctime)s %(levelname)-7s {tag}%(name)s: %(message)s'))
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(CONFIG['LOG_LEVEL'])
+    log.propagate = False
+    
+    listener.start()
+    return listener, log_queue
+
+class Metrics:
+    """Реестр метрик: счетчики, гистограммы и гейджи с метками"""
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    PREFIX = 'discord_bot_'
+    
+    def __init__(self):
+        self.counters = defaultdict(float)  # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): {'buckets': [...], 'sum': float, 'count': int}}
+        self.gauges = {}  # {name: func() -> число или [(labels, число), ...]}
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, value=1, **labels):
+        self.counters[self._key(name, labels)] += value
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = {
+                'buckets': [0] * len(self.DEFAULT_BUCKETS),
+                'sum': 0.0,
+                'count': 0
+            }
+        
+        idx = bisect_left(self.DEFAULT_BUCKETS, value)
+        if idx < len(self.DEFAULT_BUCKETS):
+            hist['buckets'][idx] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    def gauge(self, name, func):
+        """Регистрация гейджа, значение считается в момент чтения метрик"""
+        self.gauges[name] = func
+    
+    @staticmethod
+    def _format_labels(labels, extra=None):
+        pairs = list(labels) + (list(extra) if extra else [])
+        if not pairs:
+            return ""
+        escaped = (
+            (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+    
+    def render_prometheus(self):
+        """Текстовый формат Prometheus (exposition format 0.0.4)"""
+        lines = []
+        
+        by_name = defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            by_name[name].append((labels, value))
+        for name, samples in sorted(by_name.items()):
+            lines.append(f"# TYPE {self.PREFIX}{name} counter")
+            for labels, value in samples:
+                lines.append(f"{self.PREFIX}{name}{self._format_labels(labels)} {value}")
+        
+        by_name = defaultdict(list)
+        for (name, labels), hist in self.histograms.items():
+            by_name[name].append((labels, hist))
+        for name, samples in sorted(by_name.items()):
+            lines.append(f"# TYPE {self.PREFIX}{name} histogram")
+            for labels, hist in samples:
+                cumulative = 0
+                for bound, count in zip(self.DEFAULT_BUCKETS, hist['buckets']):
+                    cumulative += count
+                    lines.append(f"{self.PREFIX}{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.PREFIX}{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{self.PREFIX}{name}_sum{self._format_labels(labels)} {hist['sum']}")
+                lines.append(f"{self.PREFIX}{name}_count{self._format_labels(labels)} {hist['count']}")
+        
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                log.error("Ошибка чтения гейджа %s: %s", name, e)
+                continue
+            if value is None:
+                continue
+            lines.append(f"# TYPE {self.PREFIX}{name} gauge")
+            samples = value if isinstance(value, list) else [((), value)]
+            for labels, sample in samples:
+                lines.append(f"{self.PREFIX}{name}{self._format_labels(labels)} {sample}")
+        
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ========== МИГРАЦИИ СХЕМЫ ==========
+# Каждая миграция применяется один раз и записывается в schema_version.
+# Обычные миграции выполняются в транзакции, индексы - через CREATE/DROP INDEX CONCURRENTLY
+# (вне транзакции и без блокировки записи в таблицу).
+
+MIGRATION_LOCK_ID = 7_404_031  # ключ pg_advisory_lock, чтобы два процесса не мигрировали одновременно
+
+MIGRATIONS = [
+    {
+        'version': 1,
+        'description': "Базовые таблицы users и server_settings",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                text_xp INTEGER DEFAULT 0,
+                text_level INTEGER DEFAULT 1,
+                voice_xp INTEGER DEFAULT 0,
+                voice_level INTEGER DEFAULT 1,
+                total_xp INTEGER DEFAULT 0,
+                total_level INTEGER DEFAULT 1,
+                prestige INTEGER DEFAULT 0,
+                profile_text TEXT DEFAULT NULL,
+                profile_text_updated TIMESTAMP DEFAULT NULL,
+                last_updated TIMESTAMP DEFAULT NOW()
+            )
+            ''',
+            # Старые установки создавали users без этих колонок
+            'ALTER TABLE users ADD COLUMN IF NOT EXISTS prestige INTEGER DEFAULT 0',
+            'ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_text TEXT DEFAULT NULL',
+            'ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_text_updated TIMESTAMP DEFAULT NULL',
+            '''
+            CREATE TABLE IF NOT EXISTS server_settings (
+                guild_id BIGINT PRIMARY KEY,
+                notification_channel BIGINT,
+                log_channel BIGINT,
+                last_updated TIMESTAMP DEFAULT NOW()
+            )
+            '''
+        ]
+    },
+    {
+        'version': 2,
+        'description': "Индексы рейтингов",
+        'indexes': [
+            ('idx_users_total_xp', 'users (total_xp DESC)'),
+            ('idx_users_text_xp', 'users (text_xp DESC)'),
+            ('idx_users_voice_xp', 'users (voice_xp DESC)'),
+            ('idx_users_prestige', 'users (prestige DESC)')
+        ]
+    },
+    {
+        'version': 3,
+        'description': "Служебная таблица bot_meta (хэш дерева команд и т.п.)",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS bot_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT NOW()
+            )
+            '''
+        ]
+    },
+    {
+        'version': 4,
+        'description': "Покрывающие индексы рейтингов под keyset-пагинацию по (xp DESC, user_id DESC)",
+        'indexes': [
+            ('idx_users_total_xp_keyset', 'users (total_xp DESC, user_id DESC) INCLUDE (total_level)'),
+            ('idx_users_text_xp_keyset', 'users (text_xp DESC, user_id DESC) INCLUDE (text_level)'),
+            ('idx_users_voice_xp_keyset', 'users (voice_xp DESC, user_id DESC) INCLUDE (voice_level)')
+        ]
+    },
+    {
+        'version': 5,
+        'description': "Удаление индексов рейтингов, замененных покрывающими",
+        'drop_indexes': ['idx_users_total_xp', 'idx_users_text_xp', 'idx_users_voice_xp']
+    },
+    {
+        'version': 6,
+        'description': "Журнал событий аудита (пишет воркер)",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS audit_events (
+                id BIGSERIAL PRIMARY KEY,
+                guild_id BIGINT NOT NULL,
+                action TEXT NOT NULL,
+                description TEXT,
+                target_id BIGINT,
+                moderator_id BIGINT,
+                reason TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_audit_events_guild_time ON audit_events (guild_id, created_at DESC)'
+        ]
+    },
+    {
+        'version': 7,
+        'description': "История XP: корзины за день, неделю и месяц по серверам",
+        'sql': [
+            # period: 'd' - день, 'w' - неделя (с понедельника), 'm' - месяц; period_start - первый день периода
+            '''
+            CREATE TABLE IF NOT EXISTS xp_rollups (
+                guild_id BIGINT NOT NULL,
+                period CHAR(1) NOT NULL,
+                period_start DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                text_xp INTEGER NOT NULL DEFAULT 0,
+                voice_xp INTEGER NOT NULL DEFAULT 0,
+                total_xp INTEGER GENERATED ALWAYS AS (text_xp + voice_xp) STORED,
+                PRIMARY KEY (guild_id, period, period_start, user_id)
+            )
+            ''',
+            # Топ за период читается из индекса так же, как общий топ (миграция 4)
+            '''CREATE INDEX IF NOT EXISTS idx_xp_rollups_total
+               ON xp_rollups (guild_id, period, period_start, total_xp DESC) INCLUDE (user_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_xp_rollups_text
+               ON xp_rollups (guild_id, period, period_start, text_xp DESC) INCLUDE (user_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_xp_rollups_voice
+               ON xp_rollups (guild_id, period, period_start, voice_xp DESC) INCLUDE (user_id)'''
+        ]
+    }
+]
+
+async def get_schema_version(conn):
+    """Текущая версия схемы (0 - таблицы schema_version еще нет)"""
+    try:
+        return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def create_index_concurrently(conn, name, definition):
+    """CREATE INDEX CONCURRENTLY с удалением невалидного индекса от прерванной прошлой попытки"""
+    is_valid = await conn.fetchval(
+        'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)',
+        name
+    )
+    if is_valid is False:
+        log.warning("⚠️ Индекс %s невалиден (прерванная сборка), пересоздаем", name)
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    
+    await conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+async def run_migrations(conn):
+    """
+    Применение недостающих миграций
+    Если схема актуальна - ровно один запрос, без DDL
+    """
+    latest = MIGRATIONS[-1]['version']
+    if await get_schema_version(conn) >= latest:
+        return 0
+    
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        current = await get_schema_version(conn)
+        applied = 0
+        
+        for migration in MIGRATIONS:
+            if migration['version'] <= current:
+                continue
+            
+            log.info("🛠️ Миграция %s: %s", migration['version'], migration['description'])
+            
+            if 'indexes' in migration or 'drop_indexes' in migration:
+                for name, definition in migration.get('indexes', []):
+                    await create_index_concurrently(conn, name, definition)
+                # Обычный DROP INDEX взял бы ACCESS EXCLUSIVE на users до конца транзакции
+                for name in migration.get('drop_indexes', []):
+                    await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+                await conn.execute(
+                    'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+                    migration['version'], migration['description']
+                )
+            else:
+                async with conn.transaction():
+                    for statement in migration['sql']:
+                        await conn.execute(statement)
+                    await conn.execute(
+                        'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+                        migration['version'], migration['description']
+                    )
+            
+            applied += 1
+        
+        return applied
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+
+# ========== РАБОТА С БАЗОЙ ДАННЫХ ==========
+
+# Пул соединений с БД
+db_pool = None
+
+# Реестр запросов: каждый запрос заранее подготавливается на каждом соединении пула
+# (см. init_connection), поэтому горячие запросы не тратят время на parse/plan
+QUERIES = {
+    'get_user': 'SELECT * FROM users WHERE user_id = $1',
+    # Проекции под конкретные чтения - без profile_text и служебных колонок там, где они не нужны
+    'get_level_card': '''
+        SELECT user_id, text_xp, text_level, voice_xp, voice_level,
+               total_xp, total_level, prestige, profile_text
+        FROM users WHERE user_id = $1
+    ''',
+    'create_user': '''
+        INSERT INTO users (user_id, text_xp, text_level, voice_xp, voice_level, total_xp, total_level, prestige)
+        VALUES ($1, 0, 1, 0, 1, 0, 1, 0)
+        ON CONFLICT (user_id) DO NOTHING
+    ''',
+    # Сбросы опыта - одним оператором: строка блокируется, старые значения берутся из той же версии строки.
+    # Престиж применяется, только если условия выполняются на момент записи
+    'prestige_user': '''
+        WITH old AS (SELECT user_id, total_xp FROM users WHERE user_id = $1 FOR UPDATE)
+        UPDATE users AS u SET
+            text_xp = 0, text_level = 1, voice_xp = 0, voice_level = 1, total_xp = 0, total_level = 1,
+            prestige = u.prestige + 1, last_updated = NOW()
+        FROM old
+        WHERE u.user_id = old.user_id AND u.prestige < $2
+          AND u.text_level >= LEAST($3, $4) AND u.voice_level >= LEAST($3, $4)
+        RETURNING u.prestige, old.total_xp AS old_total_xp
+    ''',
+    'reset_user': '''
+        WITH old AS (
+            SELECT user_id, total_xp, total_level, prestige, profile_text FROM users WHERE user_id = $1 FOR UPDATE
+        )
+        UPDATE users AS u SET
+            text_xp = 0, text_level = 1, voice_xp = 0, voice_level = 1, total_xp = 0, total_level = 1,
+            prestige = 0, profile_text = NULL, profile_text_updated = NULL, last_updated = NOW()
+        FROM old
+        WHERE u.user_id = old.user_id
+        RETURNING old.total_xp AS old_total_xp, old.total_level AS old_total_level,
+                  old.prestige AS old_prestige, old.profile_text AS old_profile_text
+    ''',
+    # Текст профиля меняется не чаще раза в 30 дней - условие проверяется в самой записи
+    'set_profile_text': '''
+        INSERT INTO users (user_id, profile_text, profile_text_updated, last_updated)
+        VALUES ($1, $2, NOW(), NOW())
+        ON CONFLICT (user_id) DO UPDATE SET
+            profile_text = EXCLUDED.profile_text,
+            profile_text_updated = NOW(),
+            last_updated = NOW()
+        WHERE users.profile_text_updated IS NULL OR users.profile_text_updated <= NOW() - INTERVAL '30 days'
+        RETURNING user_id
+    ''',
+    'clear_profile_text': 'UPDATE users SET profile_text = NULL, profile_text_updated = NULL WHERE user_id = $1',
+    'get_profile_text_updated': 'SELECT profile_text_updated FROM users WHERE user_id = $1',
+    # Атомарное начисление дельты: никаких read-modify-write, опыт не может потеряться или обнулиться.
+    # RETURNING отдает новый опыт и еще не пересчитанные (старые) уровни
+    # Опыт и уровни (по формуле calculate_level: $4 - XP_PER_LEVEL, $5 - MAX_LEVEL) - одним оператором,
+    # начисление не может примениться наполовину. Уровни и опыт до начисления - из той же заблокированной
+    # версии строки, которую обновляет UPDATE. Нет строки - нет результата (см. apply_xp_delta)
+    'add_user_xp': '''
+        WITH old AS (
+            SELECT user_id, text_level, voice_level, total_level, total_xp FROM users WHERE user_id = $1 FOR UPDATE
+        )
+        UPDATE users AS u SET
+            text_xp = GREATEST(u.text_xp + $2, 0),
+            text_level = LEAST(GREATEST(u.text_xp + $2, 0) / $4 + 1, $5),
+            voice_xp = GREATEST(u.voice_xp + $3, 0),
+            voice_level = LEAST(GREATEST(u.voice_xp + $3, 0) / $4 + 1, $5),
+            total_xp = GREATEST(u.text_xp + $2, 0) + GREATEST(u.voice_xp + $3, 0),
+            total_level = LEAST((GREATEST(u.text_xp + $2, 0) + GREATEST(u.voice_xp + $3, 0)) / $4 + 1, $5),
+            last_updated = NOW()
+        FROM old
+        WHERE u.user_id = old.user_id
+        RETURNING
+            u.text_xp, u.text_level, u.voice_xp, u.voice_level, u.total_xp, u.total_level,
+            old.text_level AS old_text_level, old.voice_level AS old_voice_level,
+            old.total_level AS old_total_level, old.total_xp AS old_total_xp
+    ''',
+    # Первое начисление: до него у пользователя уровни новичка. Строку уже вставил другой - пусто
+    'insert_user_xp': '''
+        INSERT INTO users (user_id, text_xp, text_level, voice_xp, voice_level, total_xp, total_level, last_updated)
+        VALUES (
+            $1,
+            GREATEST($2, 0), LEAST(GREATEST($2, 0) / $4 + 1, $5),
+            GREATEST($3, 0), LEAST(GREATEST($3, 0) / $4 + 1, $5),
+            GREATEST($2, 0) + GREATEST($3, 0), LEAST((GREATEST($2, 0) + GREATEST($3, 0)) / $4 + 1, $5),
+            NOW()
+        )
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING
+            text_xp, text_level, voice_xp, voice_level, total_xp, total_level,
+            1 AS old_text_level, 1 AS old_voice_level, 1 AS old_total_level, 0 AS old_total_xp
+    ''',
+    # Гистограмма опыта для индекса мест в рейтинге (index-only scan по keyset-индексу)
+    'rank_histogram': 'SELECT total_xp, COUNT(*) FROM users GROUP BY total_xp',
+    # Топ читается целиком из покрывающих keyset-индексов (миграция 4)
+    # Порядок (xp DESC, user_id DESC) однозначен при равном опыте - по нему же идут страницы топа
+    'leaderboard_total': 'SELECT user_id, total_xp AS xp, total_level AS level FROM users ORDER BY total_xp DESC, user_id DESC LIMIT $1',
+    'leaderboard_text': 'SELECT user_id, text_xp AS xp, text_level AS level FROM users ORDER BY text_xp DESC, user_id DESC LIMIT $1',
+    'leaderboard_voice': 'SELECT user_id, voice_xp AS xp, voice_level AS level FROM users ORDER BY voice_xp DESC, user_id DESC LIMIT $1',
+    # Следующая страница после курсора (xp, user_id) последней строки - поиск по индексу вместо OFFSET
+    'leaderboard_total_after': '''
+        SELECT user_id, total_xp AS xp, total_level AS level FROM users
+        WHERE (total_xp, user_id) < ($1, $2)
+        ORDER BY total_xp DESC, user_id DESC LIMIT $3
+    ''',
+    'leaderboard_text_after': '''
+        SELECT user_id, text_xp AS xp, text_level AS level FROM users
+        WHERE (text_xp, user_id) < ($1, $2)
+        ORDER BY text_xp DESC, user_id DESC LIMIT $3
+    ''',
+    'leaderboard_voice_after': '''
+        SELECT user_id, voice_xp AS xp, voice_level AS level FROM users
+        WHERE (voice_xp, user_id) < ($1, $2)
+        ORDER BY voice_xp DESC, user_id DESC LIMIT $3
+    ''',
+    'load_settings': 'SELECT guild_id, notification_channel, log_channel FROM server_settings',
+    'get_settings': 'SELECT notification_channel, log_channel FROM server_settings WHERE guild_id = $1',
+    'set_notification_channel': '''
+        INSERT INTO server_settings (guild_id, notification_channel, last_updated)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (guild_id) 
+        DO UPDATE SET notification_channel = $2, last_updated = NOW()
+    ''',
+    'set_log_channel': '''
+        INSERT INTO server_settings (guild_id, log_channel, last_updated)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (guild_id) 
+        DO UPDATE SET log_channel = $2, last_updated = NOW()
+    ''',
+    'get_bot_meta': 'SELECT value FROM bot_meta WHERE key = $1',
+    'set_bot_meta': '''
+        INSERT INTO bot_meta (key, value, updated_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (key)
+        DO UPDATE SET value = $2, updated_at = NOW()
+    ''',
+    # Пачка начислений за день разом раскладывается в корзины дня, недели и месяца
+    'add_xp_history': '''
+        INSERT INTO xp_rollups (guild_id, period, period_start, user_id, text_xp, voice_xp)
+        SELECT d.guild_id, p.period, p.period_start, d.user_id, d.text_xp, d.voice_xp
+        FROM unnest($1::BIGINT[], $2::BIGINT[], $3::INTEGER[], $4::INTEGER[]) AS d(guild_id, user_id, text_xp, voice_xp)
+        CROSS JOIN (VALUES ('d', $5::DATE), ('w', $6::DATE), ('m', $7::DATE)) AS p(period, period_start)
+        ON CONFLICT (guild_id, period, period_start, user_id)
+        DO UPDATE SET
+            text_xp = xp_rollups.text_xp + EXCLUDED.text_xp,
+            voice_xp = xp_rollups.voice_xp + EXCLUDED.voice_xp
+    ''',
+    # Свой срок хранения для каждого периода: $1 - дни, $2 - недели, $3 - месяцы
+    'prune_xp_history': '''
+        DELETE FROM xp_rollups
+        WHERE (period = 'd' AND period_start < $1)
+           OR (period = 'w' AND period_start < $2)
+           OR (period = 'm' AND period_start < $3)
+    ''',
+    'period_leaderboard_total': '''
+        SELECT user_id, total_xp AS xp FROM xp_rollups
+        WHERE guild_id = $1 AND period = $2 AND period_start = $3
+        ORDER BY total_xp DESC LIMIT $4
+    ''',
+    'period_leaderboard_text': '''
+        SELECT user_id, text_xp AS xp FROM xp_rollups
+        WHERE guild_id = $1 AND period = $2 AND period_start = $3
+        ORDER BY text_xp DESC LIMIT $4
+    ''',
+    'period_leaderboard_voice': '''
+        SELECT user_id, voice_xp AS xp FROM xp_rollups
+        WHERE guild_id = $1 AND period = $2 AND period_start = $3
+        ORDER BY voice_xp DESC LIMIT $4
+    '''
+}
+
+prepared_statements = {}  # {pid серверного процесса: {имя запроса: PreparedStatement}}
+
+async def init_connection(conn):
+    """Хук init пула: подготовка всех запросов реестра на новом соединении"""
+    pid = conn.get_server_pid()
+    prepared_statements[pid] = {name: await conn.prepare(sql) for name, sql in QUERIES.items()}
+    conn.add_termination_listener(lambda _conn: prepared_statements.pop(pid, None))
+
+async def init_database():
+    """Инициализация подключения к БД и применение миграций"""
+    global db_pool
+    
+    try:
+        # Миграции - до создания пула, иначе init_connection не сможет подготовить запросы
+        conn = await asyncpg.connect(CONFIG['DATABASE_URL'], timeout=CONFIG['DB_CONNECT_TIMEOUT'])
+        try:
+            applied = await run_migrations(conn)
+        finally:
+            await conn.close()
+        
+        db_pool = await asyncpg.create_pool(
+            CONFIG['DATABASE_URL'],
+            min_size=CONFIG['DB_POOL_MIN_SIZE'],
+            max_size=CONFIG['DB_POOL_MAX_SIZE'],
+            command_timeout=CONFIG['DB_COMMAND_TIMEOUT'],
+            statement_cache_size=CONFIG['DB_STATEMENT_CACHE_SIZE'],
+            max_inactive_connection_lifetime=CONFIG['DB_MAX_INACTIVE_LIFETIME'],
+            timeout=CONFIG['DB_CONNECT_TIMEOUT'],
+            init=init_connection
+        )
+        
+        if applied:
+            log.info("✅ База данных инициализирована, применено миграций: %s", applied)
+        else:
+            log.info("✅ База данных инициализирована, схема актуальна (версия %s)", MIGRATIONS[-1]['version'])
+        log.info(
+            "🗄️ Пул БД: %s-%s соединений, подготовлено запросов: %s",
+            CONFIG['DB_POOL_MIN_SIZE'], CONFIG['DB_POOL_MAX_SIZE'], len(QUERIES)
+        )
+        
+    except Exception as e:
+        log.error("⛔ Ошибка инициализации БД: %s", e)
+        raise
+
+async def close_database():
+    """Закрытие пула (повторный вызов ничего не делает)"""
+    global db_pool
+    
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+@asynccontextmanager
+async def db_connection(query, timeout=None):
+    """Соединение из пула с замером времени запроса (включая ожидание пула)"""
+    with metrics.timer('db_query_seconds', query=query):
+        wait_start = time.perf_counter()
+        async with db_pool.acquire(timeout=timeout) as conn:
+            metrics.observe('db_pool_wait_seconds', time.perf_counter() - wait_start)
+            yield conn
+
+async def run_query(conn, method, name, *args, timeout=None):
+    """
+    Выполнение именованного запроса на уже взятом соединении
+    method: 'fetch', 'fetchrow', 'fetchval' или 'execute'
+    """
+    statement = prepared_statements.get(conn.get_server_pid(), {}).get(name)
+    if statement is None:
+        # Соединение без подготовленных запросов - asyncpg закэширует план сам
+        return await getattr(conn, method)(QUERIES[name], *args, timeout=timeout)
+    
+    # У PreparedStatement нет execute, результат таких запросов нам не нужен
+    return await getattr(statement, 'fetch' if method == 'execute' else method)(*args, timeout=timeout)
+
+class DatabaseUnavailable(Exception):
+    """
+    БД недоступна: предохранитель разомкнут или обращение не уложилось в дедлайн
+    sent - запрос уже ушел на сервер: изменение могло примениться, повторять его нельзя
+    """
+    
+    def __init__(self, message, sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+# Ошибки, означающие проблему с БД/сетью, а не с конкретным запросом
+DB_UNAVAILABLE_ERRORS = (
+    asyncio.TimeoutError,
+    OSError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError
+)
+
+class CircuitBreaker:
+    """
+    Предохранитель БД: после DB_BREAKER_THRESHOLD сбоев подряд размыкается
+    и сразу отказывает, через DB_BREAKER_COOLDOWN пропускает один пробный запрос
+    """
+    
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+    
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+    
+    def record_success(self):
+        if self.state != 'closed':
+            log.info("✅ БД снова доступна, выходим из деградированного режима")
+        self.failures = 0
+        self.state = 'closed'
+        self.probe_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                log.warning("⚠️ БД недоступна (%s сбоев подряд), деградированный режим", self.failures)
+                metrics.inc('db_breaker_trips_total')
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+    
+    @property
+    def degraded(self):
+        return self.state != 'closed'
+
+db_breaker = CircuitBreaker(CONFIG['DB_BREAKER_THRESHOLD'], CONFIG['DB_BREAKER_COOLDOWN'])
+
+async def db_query(method, name, *args):
+    """
+    Выполнение именованного запроса из реестра QUERIES (с учетом времени по имени)
+    Через предохранитель и с коротким дедлайном; при недоступности БД - DatabaseUnavailable
+    """
+    if db_pool is None or not db_breaker.allow():
+        metrics.inc('db_rejected_total', query=name)
+        raise DatabaseUnavailable(f"{name}: предохранитель разомкнут")
+    
+    # Дедлайн общий на ожидание пула и сам запрос (таймауты asyncpg, без лишней задачи на вызов)
+    deadline = time.monotonic() + CONFIG['DB_CALL_TIMEOUT']
+    sent = False
+    try:
+        async with db_connection(name, timeout=CONFIG['DB_CALL_TIMEOUT']) as conn:
+            remaining = max(deadline - time.monotonic(), 0.001)
+            sent = True
+            result = await run_query(conn, method, name, *args, timeout=remaining)
+    except DB_UNAVAILABLE_ERRORS as e:
+        db_breaker.record_failure()
+        raise DatabaseUnavailable(f"{name}: {type(e).__name__} {e}", sent=sent) from e
+    except asyncpg.PostgresError:
+        # Ошибка самого запроса - БД ответила, значит доступна
+        db_breaker.record_success()
+        raise
+    except BaseException:
+        # Отмена обработчика - пробный запрос не состоялся
+        db_breaker.probe_in_flight = False
+        raise
+    
+    db_breaker.record_success()
+    return result
+
+# ========== МЕСТО В РЕЙТИНГЕ ==========
+# Место по total_xp считается в памяти, без COUNT(*) по таблице на каждую карточку.
+# Индекс строится из гистограммы опыта при старте, обновляется начислениями этого
+# процесса и раз в RANK_REFRESH_SECONDS перестраивается из БД - так подтягиваются
+# начисления воркера и других процессов кластера. Равный опыт - одно место.
+
+class RankIndex:
+    """
+    Дерево Фенвика по корзинам опыта шириной XP_PER_LEVEL плюс число пользователей
+    на каждое значение опыта: место за O(log n) + O(ширина корзины)
+    """
+    
+    def __init__(self, bucket_xp):
+        self.bucket_xp = bucket_xp
+        self.counts = {}  # {total_xp: пользователей}
+        self.tree = [0]
+        self.total = 0
+        self.loaded = False
+    
+    def build(self, counts, size):
+        """Построение дерева за O(size + число значений)"""
+        tree = [0] * (size + 1)
+        for xp, count in counts.items():
+            tree[xp // self.bucket_xp + 1] += count
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                tree[parent] += tree[index]
+        self.counts, self.tree, self.total = counts, tree, sum(counts.values())
+    
+    def load(self, histogram):
+        """Перестроить по [(total_xp, пользователей)]"""
+        counts = {xp: count for xp, count in histogram if count > 0}
+        self.build(counts, max(counts, default=0) // self.bucket_xp + 1)
+        self.loaded = True
+    
+    def add(self, xp, delta):
+        bucket = xp // self.bucket_xp + 1
+        if bucket >= len(self.tree):
+            # Опыт вышел за край дерева - перестраиваем с запасом (редко, амортизированно)
+            self.build(self.counts, max(bucket, 2 * (len(self.tree) - 1)))
+        
+        count = self.counts.get(xp, 0) + delta
+        if count:
+            self.counts[xp] = count
+        else:
+            del self.counts[xp]
+        self.total += delta
+        while bucket < len(self.tree):
+            self.tree[bucket] += delta
+            bucket += bucket & -bucket
+    
+    def move(self, old_xp, new_xp, inserted=False):
+        """Учесть изменение опыта пользователя (до загрузки индекса - ничего не делаем)"""
+        if not self.loaded or (old_xp == new_xp and not inserted):
+            return
+        # Расхождение (старого значения нет в индексе) исправит ближайшая сверка с БД
+        if not inserted and self.counts.get(old_xp):
+            self.add(old_xp, -1)
+        self.add(new_xp, 1)
+    
+    def rank(self, xp):
+        """Место в рейтинге: 1 + число пользователей с большим опытом"""
+        bucket = xp // self.bucket_xp
+        index = min(bucket + 1, len(self.tree) - 1)
+        not_greater = 0
+        while index > 0:
+            not_greater += self.tree[index]
+            index -= index & -index
+        
+        # Внутри своей корзины - точный подсчет по значениям
+        greater = self.total - not_greater
+        greater += sum(self.counts.get(value, 0) for value in range(xp + 1, (bucket + 1) * self.bucket_xp))
+        return greater + 1
+
+rank_index = RankIndex(CONFIG['XP_PER_LEVEL'])
+
+# ========== НАЧИСЛЕНИЕ ОПЫТА ==========
+
+user_cache = OrderedDict()  # {user_id: данные карточки} - LRU для чтения в деградированном режиме
+
+def cache_user(user_id, data):
+    """Запомнить последнее известное состояние пользователя"""
+    user_id = int(user_id)
+    cached = user_cache.setdefault(user_id, {})
+    cached.update(data)
+    user_cache.move_to_end(user_id)
+    while len(user_cache) > CONFIG['USER_CACHE_SIZE']:
+        user_cache.popitem(last=False)
+
+# Расчет уровня по опыту
+def calculate_level(xp):
+    return min(xp // CONFIG['XP_PER_LEVEL'] + 1, CONFIG['MAX_LEVEL'])
+
+# Добавление опыта
+async def apply_xp_delta(user_id, text_delta, voice_delta):
+    """
+    Атомарно прибавить дельты опыта и пересчитать уровни (один оператор)
+    Возвращает (старые уровни, новые данные); ошибки БД пробрасываются
+    """
+    args = (user_id, text_delta, voice_delta, CONFIG['XP_PER_LEVEL'], CONFIG['MAX_LEVEL'])
+    row = await db_query('fetchrow', 'add_user_xp', *args)
+    inserted = row is None
+    if inserted:
+        row = await db_query('fetchrow', 'insert_user_xp', *args)
+        if row is None:
+            # Строку между запросами вставило параллельное начисление - обновляем ее под блокировкой,
+            # иначе оба начисления сообщили бы о повышении с уровня новичка
+            inserted = False
+            row = await db_query('fetchrow', 'add_user_xp', *args)
+            if row is None:
+                raise LookupError(f"пользователь {user_id} удален во время начисления")
+    
+    user = dict(row)
+    old_levels = {xp_type: user.pop(f'old_{xp_type}_level') for xp_type in ('text', 'voice', 'total')}
+    # Старый опыт из БД: по дельтам его не восстановить, если GREATEST(..., 0) обрезал списание
+    rank_index.move(user.pop('old_total_xp'), user['total_xp'], inserted=inserted)
+    
+    if user_id in user_cache:
+        cache_user(user_id, user)
+    return old_levels, user
+
+def count_possibly_lost_xp(text_delta, voice_delta):
+    """Учесть опыт, запрос которого дошел до сервера без ответа - записан он или нет, неизвестно"""
+    metrics.inc('xp_possibly_lost_total', text_delta, type='text')
+    metrics.inc('xp_possibly_lost_total', voice_delta, type='voice')
+
+# ========== ИСТОРИЯ XP ==========
+# Начисления копятся в памяти и раз в XP_HISTORY_FLUSH_SECONDS одним запросом
+# прибавляются к корзинам дня, недели и месяца (xp_rollups). Топ за неделю/месяц
+# читает готовую корзину периода по индексу - без агрегации на лету.
+
+xp_history_buffer = {}  # {(день, guild_id, user_id): [text_xp, voice_xp]}
+
+def period_starts(day):
+    """Начало дня, недели (понедельник) и месяца для даты"""
+    return day, day - timedelta(days=day.weekday()), day.replace(day=1)
+
+def record_xp_history(guild_id, user_id, xp, xp_type):
+    """Учесть начисление в истории (только заработанный опыт - списания админом не в счет)"""
+    if xp <= 0:
+        return
+    bucket = xp_history_buffer.setdefault((date.today(), int(guild_id), int(user_id)), [0, 0])
+    bucket[0 if xp_type == 'text' else 1] += xp
+
+async def flush_xp_history():
+    """Записать накопленную историю; при недоступности БД она остается в буфере"""
+    global xp_history_buffer
+    if not xp_history_buffer:
+        return 0
+    
+    batch, xp_history_buffer = xp_history_buffer, {}
+    by_day = defaultdict(list)
+    for (day, guild_id, user_id), (text_xp, voice_xp) in batch.items():
+        by_day[day].append((guild_id, user_id, text_xp, voice_xp))
+    
+    written = 0
+    for day, rows in sorted(by_day.items()):
+        guild_ids, user_ids, text_xps, voice_xps = (list(column) for column in zip(*rows))
+        try:
+            await db_query(
+                'execute', 'add_xp_history',
+                guild_ids, user_ids, text_xps, voice_xps, *period_starts(day)
+            )
+        except Exception as e:
+            if isinstance(e, DatabaseUnavailable) and e.sent:
+                # Запрос дошел до сервера и мог примениться - повтор удвоил бы опыт в топах за период
+                log.error("⛔ История XP за %s могла не записаться (%s записей): %s", day, len(rows), e)
+                continue
+            log.warning("⚠️ Запись истории XP отложена (%s записей): %s", len(rows), e)
+            # Возвращаем в буфер, складывая с тем, что пришло за время записи
+            for guild_id, user_id, text_xp, voice_xp in rows:
+                bucket = xp_history_buffer.setdefault((day, guild_id, user_id), [0, 0])
+                bucket[0] += text_xp
+                bucket[1] += voice_xp
+            continue
+        written += len(rows)
+    
+    metrics.inc('xp_history_rows_total', written)
+    return written
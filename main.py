@@ -3,45 +3,157 @@ from discord.ext import commands, tasks
 from discord import app_commands
 import random
 import time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import os
+import json
+import re
+import hashlib
 import asyncio
-from dotenv import load_dotenv
-import asyncpg
-
-# Загрузка переменных окружения
-load_dotenv()
-
-# Конфигурация
-CONFIG = {
-    'TOKEN': os.getenv('DISCORD_BOT_TOKEN'),
-    'DATABASE_URL': os.getenv('DATABASE_URL'),
-    'MAX_LEVEL': 1000,
-    'TEXT_XP_MIN': 5,
-    'TEXT_XP_MAX': 10,
-    'TEXT_COOLDOWN': 30,
-    'VOICE_XP_PER_MINUTE': 5,
-    'XP_PER_LEVEL': 100,
-    'ADMIN_ALERT_ENABLED': True
-}
+import signal
+import logging
+import logging.handlers
+import functools
+import sys
+import threading
+import traceback
+import unicodedata
+import resource
+import io
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # Pillow не установлен - карточки ранга остаются текстовыми
+    Image = ImageDraw = ImageFont = None
+
+import db
+from db import (
+    CONFIG, log, metrics, setup_logging,
+    CircuitBreaker, DatabaseUnavailable, db_breaker, db_connection, db_query, run_query,
+    init_database, close_database, rank_index, user_cache, cache_user, calculate_level,
+    apply_xp_delta, count_possibly_lost_xp, period_starts, record_xp_history, flush_xp_history
+)
 
 if not CONFIG['TOKEN']:
     raise ValueError("Токен бота не найден! Установите переменную DISCORD_BOT_TOKEN")
 
-if not CONFIG['DATABASE_URL']:
-    raise ValueError("URL базы данных не найден! Установите переменную DATABASE_URL")
+def parse_shard_ids(value):
+    """'0-3,8' -> [0, 1, 2, 3, 8]; пустая строка - None (все шарды)"""
+    if not value.strip():
+        return None
+    
+    shard_ids = set()
+    for part in value.split(','):
+        start, _, end = part.strip().partition('-')
+        shard_ids.update(range(int(start), int(end or start) + 1))
+    return sorted(shard_ids)
+
+CONFIG['SHARD_IDS'] = parse_shard_ids(CONFIG['SHARD_IDS'])
+if CONFIG['SHARD_IDS'] is not None:
+    if not CONFIG['SHARD_COUNT']:
+        raise ValueError("Для SHARD_IDS нужно задать общее число шардов SHARD_COUNT")
+    if CONFIG['SHARD_IDS'][-1] >= CONFIG['SHARD_COUNT']:
+        raise ValueError("SHARD_IDS выходят за пределы SHARD_COUNT")
+    CONFIG['SHARDED'] = True
+
+if CONFIG['GATEWAY_PROFILE'] not in ('lean', 'full'):
+    raise ValueError("GATEWAY_PROFILE должен быть lean или full")
+if CONFIG['MEMBER_CACHE'] not in ('all', 'voice'):
+    raise ValueError("MEMBER_CACHE должен быть all или voice")
+
+# ========== ШЛЮЗ ==========
+# Intents.all() - это и присутствия (статусы/активности всех участников: основная
+# часть трафика шлюза на больших серверах), и печать, реакции, ЛС, эмодзи, события
+# и т.д., которые боту не нужны. Профиль lean подписывается только на то, что
+# обрабатывается в этом файле.
+
+def build_intents():
+    if CONFIG['GATEWAY_PROFILE'] == 'full':
+        return discord.Intents.all()
+    
+    intents = discord.Intents.none()
+    intents.guilds = True  # Сервера, каналы, роли и их логи
+    intents.members = True  # Входы/выходы, роли и ники, детектор рейдов
+    intents.moderation = True  # Баны и разбаны
+    intents.voice_states = True  # Голосовой XP
+    intents.guild_messages = True  # Текстовый XP, логи удаления и изменения
+    intents.message_content = True  # Текст в логах, фильтр /очистить
+    intents.invites = True
+    intents.webhooks = True
+    intents.presences = CONFIG['GATEWAY_PRESENCES']  # Только статус и активность в /статистика
+    return intents
+
+def build_member_cache_flags(intents):
+    """all - кэш всех участников (как раньше), voice - только тех, кто в голосовых каналах"""
+    if CONFIG['MEMBER_CACHE'] == 'voice':
+        return discord.MemberCacheFlags(voice=True, joined=False)
+    return discord.MemberCacheFlags.from_intents(intents)
+
+def rss_bytes():
+    """Текущий RSS процесса (Linux), иначе пиковый"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
 
 # Инициализация бота
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='!', intents=intents)
+intents = build_intents()
+bot_options = {
+    'command_prefix': '!',
+    'intents': intents,
+    'member_cache_flags': build_member_cache_flags(intents),
+    # Без кэша всех участников загружать их при старте незачем
+    'chunk_guilds_at_startup': CONFIG['CHUNK_GUILDS'] and CONFIG['MEMBER_CACHE'] == 'all'
+}
+if CONFIG['SHARDED']:
+    bot = commands.AutoShardedBot(
+        shard_count=CONFIG['SHARD_COUNT'] or None,
+        shard_ids=CONFIG['SHARD_IDS'],
+        **bot_options
+    )
+else:
+    bot = commands.Bot(**bot_options)
 
-# Пул соединений с БД
-db_pool = None
+def gateway_report():
+    """Профиль шлюза и размер кэша discord.py - для сравнения GATEWAY_PROFILE/MEMBER_CACHE по RSS"""
+    disabled = [name for name, enabled in discord.Intents.all() if enabled and not getattr(bot.intents, name)]
+    return {
+        'profile': CONFIG['GATEWAY_PROFILE'],
+        'member_cache': CONFIG['MEMBER_CACHE'],
+        'disabled_intents': disabled,
+        'guilds': len(bot.guilds),
+        'cached_members': sum(len(guild.members) for guild in bot.guilds),
+        'member_count': sum(guild.member_count or 0 for guild in bot.guilds),
+        'cached_users': len(bot.users),
+        'rss_mb': round(rss_bytes() / 2 ** 20, 1)
+    }
 
 # Хранилище данных (для кэша)
 cooldowns = {}
 voice_sessions = {}  # {user_id: {'start_time': timestamp, 'guild_id': guild_id, 'channel_id': channel_id}}
 voice_xp_cache = {}  # {user_id: {'last_xp_time': timestamp, 'pending_xp': xp}}
+settings_cache = {}  # {guild_id: {'notification_channel': id, 'log_channel': id}}
+settings_state = {'loaded': False}  # True - в кэше все сервера, промах означает "настроек нет"
+worker_client = None  # WorkerClient, если задан WORKER_SOCKET
+
+def owns_guild(guild_id):
+    """Сервер обслуживается этим процессом (в кластерном режиме - только шарды из SHARD_IDS)"""
+    if CONFIG['SHARD_IDS'] is None:
+        return True
+    return (int(guild_id) >> 22) % CONFIG['SHARD_COUNT'] in CONFIG['SHARD_IDS']
+
+def shard_connected(shard_id):
+    """Шард подключен к гейтвею (без шардинга - весь бот)"""
+    if not CONFIG['SHARDED']:
+        return bot.ws is not None and bot.ws.open
+    shard = bot.get_shard(shard_id)
+    return shard is not None and not shard.is_closed()
+
+pending_changes = {}  # {(guild_id, kind): {'guild': guild, 'entities': {...}, 'first': ts, 'last': ts, 'task': task}}
 
 # Цвета для эмбедов
 COLORS = {
@@ -60,151 +172,164 @@ COLORS = {
     'MESSAGE': discord.Color.blurple()
 }
 
-# ========== РАБОТА С БАЗОЙ ДАННЫХ ==========
+# ========== ЛОГИРОВАНИЕ И МЕТРИКИ ==========
+
+# В кластерном режиме логи нескольких процессов идут в один поток - подписываем процесс
+log_listener, log_queue = setup_logging(f"[c{CONFIG['CLUSTER_ID']}] " if CONFIG['SHARD_IDS'] is not None else "")
+
+# Логи discord.py (бот запускается через bot.start, который их не настраивает)
+discord_log = logging.getLogger('discord')
+discord_log.addHandler(logging.handlers.QueueHandler(log_queue))
+discord_log.setLevel(logging.INFO)
+discord_log.propagate = False
+
+metrics_runner = None
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
 
-async def init_database():
-    """Инициализация подключения к БД и создание таблиц"""
-    global db_pool
+async def start_metrics_server():
+    """Локальный HTTP-эндпоинт /metrics (включается через METRICS_PORT)"""
+    global metrics_runner
     
-    try:
-        db_pool = await asyncpg.create_pool(
-            CONFIG['DATABASE_URL'],
-            min_size=5,
-            max_size=20,
-            command_timeout=60
-        )
-        
-        async with db_pool.acquire() as conn:
-            # Таблица пользователей (ОКОНЧАТЕЛЬНАЯ ВЕРСИЯ)
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    text_xp INTEGER DEFAULT 0,
-                    text_level INTEGER DEFAULT 1,
-                    voice_xp INTEGER DEFAULT 0,
-                    voice_level INTEGER DEFAULT 1,
-                    total_xp INTEGER DEFAULT 0,
-                    total_level INTEGER DEFAULT 1,
-                    prestige INTEGER DEFAULT 0,
-                    profile_text TEXT DEFAULT NULL,
-                    profile_text_updated TIMESTAMP DEFAULT NULL,
-                    last_updated TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-            
-            # Таблица настроек серверов
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS server_settings (
-                    guild_id BIGINT PRIMARY KEY,
-                    notification_channel BIGINT,
-                    log_channel BIGINT,
-                    last_updated TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-            
-            # Индексы для оптимизации
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_total_xp ON users(total_xp DESC)')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_text_xp ON users(text_xp DESC)')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_voice_xp ON users(voice_xp DESC)')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_prestige ON users(prestige DESC)')
-            
-        print("✅ База данных успешно инициализирована!")
-        
-    except Exception as e:
-        print(f"⛔ Ошибка инициализации БД: {e}")
-        raise
+    if not CONFIG['METRICS_PORT'] or metrics_runner is not None:
+        return
+    
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    
+    # Процессы кластера на одной машине слушают соседние порты
+    port = CONFIG['METRICS_PORT'] + CONFIG['CLUSTER_ID']
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, CONFIG['METRICS_HOST'], port).start()
+    log.info("📈 Метрики доступны на http://%s:%s/metrics", CONFIG['METRICS_HOST'], port)
+
+# ========== РАБОТА С БАЗОЙ ДАННЫХ ==========
+# Пул, реестр запросов и предохранитель - в db.py
+
+DB_UNAVAILABLE_MESSAGE = "⚠️ База данных временно недоступна, попробуйте чуть позже"
+
+def default_user_data(user_id):
+    """Данные нового пользователя"""
+    return {
+        'user_id': int(user_id),
+        'text_xp': 0,
+        'text_level': 1,
+        'voice_xp': 0,
+        'voice_level': 1,
+        'total_xp': 0,
+        'total_level': 1,
+        'prestige': 0,
+        'profile_text': None,
+        'profile_text_updated': None
+    }
 
 async def get_user_data(user_id):
-    """Получение данных пользователя из БД"""
-    try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                'SELECT * FROM users WHERE user_id = $1',
-                int(user_id)
-            )
-            
-            if row:
-                # Создаем словарь с учетом возможного отсутствия новых полей
-                user_data = dict(row)
-                
-                # Добавляем новые поля если их нет
-                if 'prestige' not in user_data:
-                    user_data['prestige'] = 0
-                if 'profile_text' not in user_data:
-                    user_data['profile_text'] = None
-                if 'profile_text_updated' not in user_data:
-                    user_data['profile_text_updated'] = None
-                
-                return user_data
-            else:
-                # Создаём нового пользователя с новыми полями
-                await conn.execute('''
-                    INSERT INTO users (user_id, text_xp, text_level, voice_xp, voice_level, total_xp, total_level, prestige)
-                    VALUES ($1, 0, 1, 0, 1, 0, 1, 0)
-                ''', int(user_id))
-                
-                return {
-                    'user_id': int(user_id),
-                    'text_xp': 0,
-                    'text_level': 1,
-                    'voice_xp': 0,
-                    'voice_level': 1,
-                    'total_xp': 0,
-                    'total_level': 1,
-                    'prestige': 0,
-                    'profile_text': None,
-                    'profile_text_updated': None
-                }
-    except Exception as e:
-        print(f"Ошибка получения данных пользователя: {e}")
-        return {
-            'user_id': int(user_id),
-            'text_xp': 0,
-            'text_level': 1,
-            'voice_xp': 0,
-            'voice_level': 1,
-            'total_xp': 0,
-            'total_level': 1,
-            'prestige': 0,
-            'profile_text': None,
-            'profile_text_updated': None
-        }
+    """
+    Получение полной строки пользователя из БД
+    Ошибки БД пробрасываются: нулевые данные по умолчанию нельзя показывать вместо настоящих
+    """
+    row = await db_query('fetchrow', 'get_user', int(user_id))
+    
+    if row:
+        # Все колонки гарантированы миграциями (см. MIGRATIONS)
+        return dict(row)
+    
+    # Создаём нового пользователя с новыми полями
+    await db_query('execute', 'create_user', int(user_id))
+    return default_user_data(user_id)
 
-async def save_user_data(user_id, data):
-    """Сохранение данных пользователя в БД"""
+pending_xp_deltas = {}  # {user_id: {'text': дельта, 'voice': дельта}} - опыт, не записанный из-за недоступности БД
+
+def cached_user_view(user_id):
+    """Карточка из кэша с учетом еще не записанного опыта (None - пользователь не в кэше)"""
+    cached = user_cache.get(int(user_id))
+    if cached is None:
+        return None
+    
+    data = dict(cached)
+    delta = pending_xp_deltas.get(int(user_id))
+    if delta:
+        data['text_xp'] = max(0, data['text_xp'] + delta['text'])
+        data['voice_xp'] = max(0, data['voice_xp'] + delta['voice'])
+        data['total_xp'] = data['text_xp'] + data['voice_xp']
+        for xp_type in ('text', 'voice', 'total'):
+            data[f'{xp_type}_level'] = calculate_level(data[f'{xp_type}_xp'])
+    return data
+
+async def get_level_card_data(user_id):
+    """
+    Данные для карточки уровня/профиля (без служебных колонок)
+    Если БД недоступна - из кэша; None, если показать нечего
+    """
     try:
-        async with db_pool.acquire() as conn:
-            # Используем UPSERT для обновления или создания записи
-            await conn.execute('''
-                INSERT INTO users (user_id, text_xp, text_level, voice_xp, voice_level, 
-                                 total_xp, total_level, prestige, profile_text, profile_text_updated, last_updated)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, NOW())
-                ON CONFLICT (user_id) 
-                DO UPDATE SET 
-                    text_xp = EXCLUDED.text_xp,
-                    text_level = EXCLUDED.text_level,
-                    voice_xp = EXCLUDED.voice_xp,
-                    voice_level = EXCLUDED.voice_level,
-                    total_xp = EXCLUDED.total_xp,
-                    total_level = EXCLUDED.total_level,
-                    prestige = EXCLUDED.prestige,
-                    profile_text = EXCLUDED.profile_text,
-                    profile_text_updated = EXCLUDED.profile_text_updated,
-                    last_updated = NOW()
-            ''', 
-            int(user_id), 
-            data['text_xp'], 
-            data['text_level'], 
-            data['voice_xp'], 
-            data['voice_level'], 
-            data['total_xp'], 
-            data['total_level'],
-            data.get('prestige', 0),
-            data.get('profile_text'),
-            data.get('profile_text_updated')
-            )
+        row = await db_query('fetchrow', 'get_level_card', int(user_id))
+        # Строку создаст первое начисление опыта - для показа хватит значений по умолчанию
+        data = dict(row) if row else default_user_data(user_id)
+        cache_user(user_id, data)
+        data = cached_user_view(user_id)
     except Exception as e:
-        print(f"Ошибка сохранения данных пользователя: {e}")
+        log.warning("Карточка %s из кэша, БД: %s", user_id, e)
+        data = cached_user_view(user_id)
+    
+    if data is not None:
+        data['rank'] = get_rank_position(data['total_xp'])
+    return data
+
+MAX_PRESTIGE = 3
+PRESTIGE_LEVEL = 1000  # Уровень в текстовом и голосовом чате, нужный для престижа
+
+def prestige_required_level():
+    """Уровень для престижа: выше MAX_LEVEL не подняться, поэтому не больше него"""
+    return min(PRESTIGE_LEVEL, CONFIG['MAX_LEVEL'])
+
+def can_prestige(data):
+    """Доступен ли престиж (те же условия, что в запросе prestige_user)"""
+    required = prestige_required_level()
+    return (
+        data.get('prestige', 0) < MAX_PRESTIGE and
+        data['text_level'] >= required and
+        data['voice_level'] >= required
+    )
+
+user_reset_lock = asyncio.Lock()  # Сброс опыта не пересекается с дописыванием отложенного опыта
+
+async def reset_user_xp(user_id, query, *args):
+    """
+    Сброс опыта именованным запросом (prestige_user / reset_user) - одна транзакция в БД
+    Отложенный опыт, кэши, индекс мест и страницы топа обновляются вместе с ним.
+    Возвращает строку RETURNING или None, если сброс не применен (ошибки БД пробрасываются)
+    """
+    user_id = int(user_id)
+    async with user_reset_lock:
+        # Опыт, заработанный до сброса, не должен дописаться после него
+        dropped = pending_xp_deltas.pop(user_id, None)
+        
+        def restore_dropped():
+            if dropped:
+                delta = pending_xp_deltas.setdefault(user_id, {'text': 0, 'voice': 0})
+                delta['text'] += dropped['text']
+                delta['voice'] += dropped['voice']
+        
+        try:
+            row = await db_query('fetchrow', query, user_id, *args)
+        except BaseException:
+            restore_dropped()
+            raise
+        if row is None:
+            restore_dropped()
+            return None
+        
+        user_cache.pop(user_id, None)
+        voice = voice_xp_cache.get(str(user_id))
+        if voice:
+            voice['pending_xp'] = 0
+        if worker_client:
+            worker_client.send('forget', user_id=user_id)
+        rank_index.move(row['old_total_xp'], 0)
+        leaderboard_page_cache.clear()
+        return row
 
 def get_prestige_emoji(prestige_level):
     """Получение эмодзи престижа"""
@@ -216,119 +341,348 @@ def get_prestige_emoji(prestige_level):
     }
     return prestige_emojis.get(prestige_level, "")
 
+async def load_settings_cache():
+    """Предзагрузка настроек всех серверов одним запросом"""
+    try:
+        rows = await db_query('fetch', 'load_settings')
+        
+        settings_cache.clear()
+        for row in rows:
+            # В кластерном режиме держим в памяти только свои сервера
+            if not owns_guild(row['guild_id']):
+                continue
+            settings_cache[row['guild_id']] = {
+                'notification_channel': row['notification_channel'],
+                'log_channel': row['log_channel']
+            }
+        settings_state['loaded'] = True
+        log.info("✅ Загружены настройки %s серверов", len(settings_cache))
+    except Exception as e:
+        log.error("⛔ Ошибка загрузки настроек серверов: %s", e)
+
+async def get_guild_settings(guild_id):
+    """Настройки сервера: из кэша, при промахе (если кэш не загружен целиком) - из БД"""
+    guild_id = int(guild_id)
+    if guild_id in settings_cache or settings_state['loaded']:
+        return settings_cache.get(guild_id, {})
+    
+    row = await db_query('fetchrow', 'get_settings', guild_id)
+    settings_cache[guild_id] = dict(row) if row else {'notification_channel': None, 'log_channel': None}
+    return settings_cache[guild_id]
+
 async def get_notification_channel(guild_id):
     """Получение канала уведомлений"""
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                'SELECT notification_channel FROM server_settings WHERE guild_id = $1',
-                int(guild_id)
-            )
-            return row['notification_channel'] if row else None
+        return (await get_guild_settings(guild_id)).get('notification_channel')
     except Exception as e:
-        print(f"Ошибка получения канала уведомлений: {e}")
+        log.error("Ошибка получения канала уведомлений: %s", e)
         return None
 
 async def get_log_channel(guild_id):
     """Получение канала логов"""
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                'SELECT log_channel FROM server_settings WHERE guild_id = $1',
-                int(guild_id)
-            )
-            return row['log_channel'] if row else None
+        return (await get_guild_settings(guild_id)).get('log_channel')
     except Exception as e:
-        print(f"Ошибка получения канала логов: {e}")
+        log.error("Ошибка получения канала логов: %s", e)
         return None
 
 async def set_notification_channel(guild_id, channel_id):
     """Установка канала уведомлений"""
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO server_settings (guild_id, notification_channel, last_updated)
-                VALUES ($1, $2, NOW())
-                ON CONFLICT (guild_id) 
-                DO UPDATE SET notification_channel = $2, last_updated = NOW()
-            ''', int(guild_id), int(channel_id))
+        await db_query('execute', 'set_notification_channel', int(guild_id), int(channel_id))
+        settings_cache.setdefault(int(guild_id), {'notification_channel': None, 'log_channel': None})['notification_channel'] = int(channel_id)
     except Exception as e:
-        print(f"Ошибка установки канала уведомлений: {e}")
+        log.error("Ошибка установки канала уведомлений: %s", e)
 
 async def set_log_channel(guild_id, channel_id):
     """Установка канала логов"""
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO server_settings (guild_id, log_channel, last_updated)
-                VALUES ($1, $2, NOW())
-                ON CONFLICT (guild_id) 
-                DO UPDATE SET log_channel = $2, last_updated = NOW()
-            ''', int(guild_id), int(channel_id))
+        await db_query('execute', 'set_log_channel', int(guild_id), int(channel_id))
+        settings_cache.setdefault(int(guild_id), {'notification_channel': None, 'log_channel': None})['log_channel'] = int(channel_id)
     except Exception as e:
-        print(f"Ошибка установки канала логов: {e}")
+        log.error("Ошибка установки канала логов: %s", e)
 
-async def get_leaderboard(xp_type='total', limit=10):
-    """Получение топа игроков"""
+async def get_bot_meta(key):
+    """Чтение служебного значения из bot_meta"""
     try:
-        field_map = {
-            'text': 'text_xp',
-            'voice': 'voice_xp',
-            'total': 'total_xp'
-        }
-        
-        field = field_map.get(xp_type, 'total_xp')
-        
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch(
-                f'SELECT * FROM users ORDER BY {field} DESC LIMIT $1',
-                limit
-            )
-            return [dict(row) for row in rows]
+        return await db_query('fetchval', 'get_bot_meta', key)
+    except Exception as e:
+        log.error("Ошибка чтения bot_meta: %s", e)
+        return None
+
+async def set_bot_meta(key, value):
+    """Запись служебного значения в bot_meta"""
+    try:
+        await db_query('execute', 'set_bot_meta', key, value)
     except Exception as e:
-        print(f"Ошибка получения топа: {e}")
+        log.error("Ошибка записи bot_meta: %s", e)
+
+async def get_leaderboard(xp_type='total', limit=10, after=None):
+    """
+    Получение топа игроков: список {'user_id', 'xp', 'level'} по выбранному типу опыта
+    after - курсор (xp, user_id) последней строки предыдущей страницы
+    """
+    try:
+        # Отдельный именованный запрос на каждый тип - один и тот же текст, один план
+        name = f'leaderboard_{xp_type}' if xp_type in ('text', 'voice') else 'leaderboard_total'
+        if after is None:
+            rows = await db_query('fetch', name, limit)
+        else:
+            rows = await db_query('fetch', f'{name}_after', after[0], after[1], limit)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        log.error("Ошибка получения топа: %s", e)
         return []
 
-# Расчет уровня по опыту
-def calculate_level(xp):
-    return min(xp // CONFIG['XP_PER_LEVEL'] + 1, CONFIG['MAX_LEVEL'])
+def buffer_xp_delta(user_id, xp, xp_type):
+    """Отложить начисление до восстановления БД"""
+    delta = pending_xp_deltas.setdefault(user_id, {'text': 0, 'voice': 0})
+    delta[xp_type] += xp
+    metrics.inc('xp_buffered_total', xp, type=xp_type)
 
-# Добавление опыта
 async def add_xp(user_id, xp, xp_type, guild=None):
+    user_id = int(user_id)
+    
+    # С воркером начисление уходит ему, уведомление о повышении уровня придет обратно через сокет
+    if worker_client and worker_client.send('xp', user_id=user_id, xp=xp, xp_type=xp_type, guild_id=guild.id if guild else None):
+        return cached_user_view(user_id)
+    
+    if guild:
+        record_xp_history(guild.id, user_id, xp, xp_type)
+    
+    # Пока БД недоступна (или еще не дописан старый буфер этого пользователя) - копим дельту в памяти,
+    # чтобы не ждать дедлайнов и сохранить порядок начислений
+    if db_breaker.degraded or user_id in pending_xp_deltas:
+        buffer_xp_delta(user_id, xp, xp_type)
+        return cached_user_view(user_id)
+    
     try:
-        user_id = int(user_id)
-        user = await get_user_data(user_id)
-        
-        old_level = user[f'{xp_type}_level']
-        
-        if xp_type == 'text':
-            user['text_xp'] = max(0, user['text_xp'] + xp)
-            user['text_level'] = calculate_level(user['text_xp'])
-        elif xp_type == 'voice':
-            user['voice_xp'] = max(0, user['voice_xp'] + xp)
-            user['voice_level'] = calculate_level(user['voice_xp'])
-        
-        # Обновляем общие показатели
-        user['total_xp'] = user['text_xp'] + user['voice_xp']
-        user['total_level'] = calculate_level(user['total_xp'])
-        
-        await save_user_data(user_id, user)
-        print(f"✅ Добавлено {xp} {xp_type} XP пользователю {user_id}. Новый уровень: {user[f'{xp_type}_level']}")
-        
-        # Проверка повышения уровня
-        new_level = user[f'{xp_type}_level']
-        if new_level > old_level and guild:
-            await send_level_up_notification(user_id, xp_type, old_level, new_level, guild)
-        
-        return user
+        old_levels, user = await apply_xp_delta(
+            user_id,
+            xp if xp_type == 'text' else 0,
+            xp if xp_type == 'voice' else 0
+        )
+    except DatabaseUnavailable as e:
+        if e.sent:
+            # Запрос дошел до сервера и мог примениться - повтор начислил бы опыт дважды
+            log.error("⛔ Опыт %s мог не записаться: %s", user_id, e)
+            count_possibly_lost_xp(xp if xp_type == 'text' else 0, xp if xp_type == 'voice' else 0)
+        else:
+            log.warning("⚠️ Опыт %s отложен до восстановления БД: %s", user_id, e)
+            buffer_xp_delta(user_id, xp, xp_type)
+        return cached_user_view(user_id)
+    except Exception as e:
+        log.error("⛔ Ошибка в add_xp: %s", e)
+        return None
+    
+    metrics.inc('xp_granted_total', xp, type=xp_type)
+    log.debug("✅ Добавлено %s %s XP пользователю %s. Новый уровень: %s", xp, xp_type, user_id, user[f'{xp_type}_level'])
+    
+    # Проверка повышения уровня
+    old_level = old_levels[xp_type]
+    new_level = user[f'{xp_type}_level']
+    if new_level > old_level and guild:
+        await send_level_up_notification(user_id, xp_type, old_level, new_level, guild)
+    
+    return user
+
+async def reconcile_xp_deltas():
+    """Дописать отложенный опыт в БД; возвращает число пользователей, у которых опыт записан"""
+    reconciled = 0
+    for user_id in list(pending_xp_deltas):
+        async with user_reset_lock:
+            # Опыт пользователя мог быть сброшен вместе с отложенными дельтами
+            if user_id not in pending_xp_deltas:
+                continue
+            text_delta, voice_delta = pending_xp_deltas[user_id]['text'], pending_xp_deltas[user_id]['voice']
+            unavailable = None
+            try:
+                await apply_xp_delta(user_id, text_delta, voice_delta)
+            except DatabaseUnavailable as e:
+                if not e.sent:
+                    break
+                # Запрос дошел до сервера и мог примениться - дельту считаем записанной, чтобы не начислить дважды
+                log.error("⛔ Отложенный опыт %s мог не записаться: %s", user_id, e)
+                count_possibly_lost_xp(text_delta, voice_delta)
+                unavailable = e
+            except Exception as e:
+                log.error("⛔ Ошибка записи отложенного опыта %s: %s", user_id, e)
+                continue
+            
+            # Пока шла запись, могли прийти новые начисления - вычитаем только записанное
+            current = pending_xp_deltas[user_id]
+            current['text'] -= text_delta
+            current['voice'] -= voice_delta
+            if not current['text'] and not current['voice']:
+                del pending_xp_deltas[user_id]
+            if unavailable:
+                break
+            reconciled += 1
+    
+    if reconciled:
+        log.info("💾 Записан отложенный опыт: %s пользователей, осталось %s", reconciled, len(pending_xp_deltas))
+    return reconciled
+
+@tasks.loop(seconds=5)
+async def reconcile_xp_task():
+    """Фоновая запись отложенного опыта после восстановления БД"""
+    # В деградированном режиме начисления не ходят в БД - пробный запрос делает эта задача
+    if pending_xp_deltas:
+        await reconcile_xp_deltas()
+
+# ========== ИСТОРИЯ XP ==========
+# Буфер и запись корзин - в db.py (их же использует воркер)
+
+xp_history_state = {'pruned_day': None}
+
+@tasks.loop(seconds=CONFIG['XP_HISTORY_FLUSH_SECONDS'])
+async def xp_history_task():
+    """Периодическая запись истории XP и раз в день - удаление устаревших корзин"""
+    await flush_xp_history()
+    
+    today = date.today()
+    if xp_history_state['pruned_day'] != today:
+        try:
+            await db_query(
+                'execute', 'prune_xp_history',
+                today - timedelta(days=CONFIG['XP_HISTORY_RETENTION_DAYS']),
+                today - timedelta(days=CONFIG['XP_HISTORY_WEEK_RETENTION_DAYS']),
+                today - timedelta(days=CONFIG['XP_HISTORY_MONTH_RETENTION_DAYS'])
+            )
+            xp_history_state['pruned_day'] = today
+        except Exception as e:
+            log.warning("⚠️ Очистка истории XP не удалась: %s", e)
+
+async def get_period_leaderboard(guild_id, period, xp_type='total', limit=10):
+    """Топ сервера за текущую неделю ('w') или месяц ('m'): список {'user_id', 'xp'}"""
+    try:
+        day, week_start, month_start = period_starts(date.today())
+        name = f'period_leaderboard_{xp_type}' if xp_type in ('text', 'voice') else 'period_leaderboard_total'
+        rows = await db_query('fetch', name, int(guild_id), period, week_start if period == 'w' else month_start, limit)
+        return [dict(row) for row in rows if row['xp'] > 0]
     except Exception as e:
-        print(f"⛔ Ошибка в add_xp: {e}")
+        log.error("Ошибка получения топа за период: %s", e)
+        return []
+
+# ========== МЕСТО В РЕЙТИНГЕ ==========
+# Индекс мест (db.rank_index) загружается при старте и сверяется с БД по таймеру
+
+def get_rank_position(total_xp):
+    """(место, всего пользователей) или None, пока индекс не загружен"""
+    if not rank_index.loaded:
         return None
+    return rank_index.rank(total_xp), max(rank_index.total, 1)
+
+async def load_rank_index():
+    """Загрузить/сверить индекс мест с БД (долгий запрос - мимо короткого дедлайна db_query)"""
+    if db.db_pool is None or db_breaker.degraded:
+        return False
+    try:
+        async with db_connection('rank_histogram', timeout=CONFIG['RANK_LOAD_TIMEOUT']) as conn:
+            rows = await run_query(conn, 'fetch', 'rank_histogram', timeout=CONFIG['RANK_LOAD_TIMEOUT'])
+        rank_index.load((row[0], row[1]) for row in rows)
+        return True
+    except Exception as e:
+        log.warning("⚠️ Индекс мест в рейтинге не загружен: %s", e)
+        return False
+
+@tasks.loop(seconds=CONFIG['RANK_REFRESH_SECONDS'])
+async def rank_refresh_task():
+    """Периодическая сверка индекса мест с БД"""
+    await load_rank_index()
+
+# ========== УЧАСТНИКИ СЕРВЕРА ==========
+# Имена и аватары участников для топов и уведомлений. Кого нет в кэше discord.py
+# (MEMBER_CACHE=voice или CHUNK_GUILDS=0, см. ШЛЮЗ), запрашиваем через шлюз пачками по ID -
+# один REQUEST_GUILD_MEMBERS на 100 пользователей вместо fetch_member на каждого.
+# Результат, включая "не участник", кэшируется на MEMBER_CACHE_SECONDS.
+
+MEMBER_QUERY_CHUNK = 100  # Лимит ID в одном запросе участников через шлюз
+
+def member_info(member):
+    return {'name': member.display_name, 'avatar': member.display_avatar.url}
+
+class MemberResolver:
+    """Пакетное получение {'name', 'avatar'} участников с кэшем по (сервер, пользователь)"""
+    
+    def __init__(self):
+        self.cache = OrderedDict()  # {(guild_id, user_id): (истекает, info или None - не участник)}
+        self.locks = defaultdict(asyncio.Lock)  # Один запрос к шлюзу на сервер за раз
+    
+    def cached(self, guild, user_id):
+        """(найдено, info) без обращения к шлюзу"""
+        member = guild.get_member(user_id)
+        if member:
+            return True, member_info(member)
+        entry = self.cache.get((guild.id, user_id))
+        if entry and entry[0] > time.monotonic():
+            return True, entry[1]
+        return False, None
+    
+    async def resolve(self, guild, user_ids):
+        """{user_id: info} для участников сервера из user_ids (не участников в ответе нет)"""
+        found, missing = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            hit, info = self.cached(guild, user_id)
+            if not hit:
+                missing.append(user_id)
+            elif info:
+                found[user_id] = info
+        
+        if missing:
+            metrics.inc('member_resolve_total', len(user_ids) - len(missing), source='cache')
+            found.update(await self.query(guild, missing))
+        else:
+            metrics.inc('member_resolve_total', len(user_ids), source='cache')
+        return found
+    
+    async def get(self, guild, user_id):
+        return (await self.resolve(guild, [int(user_id)])).get(int(user_id))
+    
+    async def query(self, guild, user_ids):
+        found = {}
+        async with self.locks[guild.id]:
+            # Пока ждали блокировку, часть могла загрузиться параллельным запросом
+            missing = []
+            for user_id in user_ids:
+                hit, info = self.cached(guild, user_id)
+                if not hit:
+                    missing.append(user_id)
+                elif info:
+                    found[user_id] = info
+            
+            # Шард переподключается - запрос не дойдет, не-участниками никого не помечаем
+            if not missing or not shard_connected(guild.shard_id):
+                return found
+            
+            for start in range(0, len(missing), MEMBER_QUERY_CHUNK):
+                chunk = missing[start:start + MEMBER_QUERY_CHUNK]
+                try:
+                    members = await asyncio.wait_for(
+                        guild.query_members(user_ids=chunk, limit=len(chunk), cache=False),
+                        CONFIG['MEMBER_QUERY_TIMEOUT']
+                    )
+                except Exception as e:
+                    log.warning("⚠️ Не удалось запросить участников %s: %s", guild.name, e)
+                    break
+                
+                metrics.inc('member_resolve_total', len(chunk), source='gateway')
+                expires_at = time.monotonic() + CONFIG['MEMBER_CACHE_SECONDS']
+                infos = {member.id: member_info(member) for member in members}
+                for user_id in chunk:
+                    lru_put(self.cache, (guild.id, user_id), (expires_at, infos.get(user_id)), CONFIG['MEMBER_CACHE_SIZE'])
+                found.update(infos)
+        return found
+    
+    def forget(self, guild_id, user_id):
+        self.cache.pop((guild_id, user_id), None)
+
+member_resolver = MemberResolver()
 
 # Отправка уведомления о повышении уровня
 async def send_level_up_notification(user_id, xp_type, old_level, new_level, guild):
     try:
-        member = guild.get_member(int(user_id))
+        member = await member_resolver.get(guild, user_id)
         if not member:
             return
         
@@ -337,7 +691,7 @@ async def send_level_up_notification(user_id, xp_type, old_level, new_level, gui
         
         embed = discord.Embed(
             title="🎉 Повышение уровня!",
-            description=f"{member.mention} достиг **{new_level}** уровня в {type_name} чате!",
+            description=f"<@{user_id}> достиг **{new_level}** уровня в {type_name} чате!",
             color=COLORS['LEVEL_UP'],
             timestamp=datetime.now()
         )
@@ -348,21 +702,23 @@ async def send_level_up_notification(user_id, xp_type, old_level, new_level, gui
             inline=True
         )
         
-        embed.set_thumbnail(url=member.display_avatar.url)
+        embed.set_thumbnail(url=member['avatar'])
         embed.set_footer(text="Поздравляем! 🎊")
         
         notification_channel_id = await get_notification_channel(guild.id)
         if notification_channel_id:
             channel = bot.get_channel(int(notification_channel_id))
             if channel:
-                await channel.send(embed=embed)
+                with metrics.timer('discord_send_seconds', kind='level_up'):
+                    await channel.send(embed=embed)
                 return
         
         if guild.system_channel:
-            await guild.system_channel.send(embed=embed)
+            with metrics.timer('discord_send_seconds', kind='level_up'):
+                await guild.system_channel.send(embed=embed)
             
     except Exception as e:
-        print(f"Ошибка отправки уведомления о уровне: {e}")
+        log.error("Ошибка отправки уведомления о уровне: %s", e)
 
 # Улучшенная функция получения информации из аудит-логов
 async def get_audit_log_info(guild, action, target=None, time_window=10):
@@ -385,21 +741,7 @@ async def get_audit_log_info(guild, action, target=None, time_window=10):
                 return entry.user, entry.reason or "Не указана"
                 
     except Exception as e:
-        print(f"Ошибка при получении аудит-лога: {e}")
-    
-    return None, "Не указана"
-
-async def find_moderator_for_role_change(guild, target_user, role=None, is_add=True):
-    """Улучшенная функция для поиска модератора при изменении ролей"""
-    try:
-        action = discord.AuditLogAction.member_role_update
-        async for entry in guild.audit_logs(limit=5, action=action):
-            if entry.target.id == target_user.id:
-                time_diff = (datetime.now().astimezone() - entry.created_at).total_seconds()
-                if time_diff < 10:
-                    return entry.user, entry.reason or "Не указана"
-    except Exception as e:
-        print(f"Ошибка при поиске модератора для изменения ролей: {e}")
+        log.error("Ошибка при получении аудит-лога: %s", e)
     
     return None, "Не указана"
 
@@ -436,10 +778,294 @@ async def get_exact_moderator(guild, action, target=None, max_lookback=5):
                 return entry.user, entry.reason or "Не указана", time_diff
                 
     except Exception as e:
-        print(f"Ошибка в get_exact_moderator: {e}")
+        log.error("Ошибка в get_exact_moderator: %s", e)
     
     return None, "Не указана", 0
 
+async def get_audit_log_attribution(guild, action, target_ids, time_window=30, fallback=False):
+    """
+    Один запрос к аудит-логу для целой пачки объектов
+    Возвращает {target_id: (модератор, причина)}; при fallback=True объекты без
+    своей записи получают самую свежую запись из окна (как get_audit_log_info без target)
+    """
+    result = {}
+    latest = None
+
+    try:
+        current_time = datetime.now().astimezone()
+        limit = min(max(len(target_ids) * 2, 10), 100)
+
+        async for entry in guild.audit_logs(limit=limit, action=action):
+            if (current_time - entry.created_at).total_seconds() > time_window:
+                continue
+
+            info = (entry.user, entry.reason or "Не указана")
+            if latest is None:
+                latest = info
+
+            target = getattr(entry, 'target', None)
+            if target is not None and target.id in target_ids and target.id not in result:
+                result[target.id] = info
+    except Exception as e:
+        log.error("Ошибка при получении аудит-лога для пачки изменений: %s", e)
+
+    if fallback and latest:
+        for target_id in target_ids:
+            result.setdefault(target_id, latest)
+
+    return result
+
+# ========== АГРЕГАЦИЯ ИЗМЕНЕНИЙ ==========
+# Массовые правки (перестановка каналов/ролей, выдача роли пачке участников) приходят
+# десятками событий подряд. Копим их по (сервер, тип объекта) и отправляем одним логом.
+
+CHANGE_KINDS = {
+    'channel': {
+        'title': ("⚙️ Обновление канала", "⚙️ Обновление каналов"),
+        'entity_name': "📺 Канал"
+    },
+    'role': {
+        'title': ("⚙️ Обновление роли", "⚙️ Обновление ролей"),
+        'entity_name': "🎭 Роль"
+    },
+    'member': {
+        'title': ("👤 Обновление участника", "👤 Обновление участников"),
+        'entity_name': "👤 Участник"
+    }
+}
+
+CHANGE_FIELD_NAMES = {
+    'name': "Название",
+    'position': "Позиция",
+    'topic': "Топик",
+    'slowmode_delay': "Слоумод",
+    'color': "Цвет",
+    'permissions': "Права",
+    'roles': "Роли",
+    'nick': "Никнейм",
+    'timed_out_until': "Таймаут"
+}
+
+# Заголовок и цвет лога участника, если в пачке изменения одного вида
+MEMBER_CHANGE_STYLES = {
+    'role_added': ("✅ Роль выдана", 'SUCCESS'),
+    'role_removed': ("⛔ Роль изъята", 'ERROR'),
+    'nick': ("📝 Изменен никнейм", 'UPDATE'),
+    'timeout': ("⏰ Таймаут участника", 'WARNING'),
+    'timeout_removed': ("🔊 Снятие таймаута", 'SUCCESS')
+}
+
+def queue_change(guild, kind, entity, field, old, new):
+    """Добавление изменения в пачку; старое значение берется из первого события, новое - из последнего"""
+    key = (guild.id, kind)
+    now = time.monotonic()
+
+    batch = pending_changes.get(key)
+    if batch is None:
+        batch = pending_changes[key] = {
+            'guild': guild,
+            'entities': {},
+            'first': now,
+            'last': now,
+            'task': None
+        }
+        batch['task'] = asyncio.create_task(flush_changes_later(key))
+
+    batch['last'] = now
+
+    entry = batch['entities'].setdefault(entity.id, {'entity': entity, 'fields': {}})
+    entry['entity'] = entity
+    if field in entry['fields']:
+        entry['fields'][field][1] = new
+    else:
+        entry['fields'][field] = [old, new]
+
+async def flush_changes_later(key):
+    """Ожидание тишины (но не дольше максимума) и отправка пачки"""
+    try:
+        while True:
+            batch = pending_changes[key]
+            deadline = min(
+                batch['last'] + CONFIG['CHANGE_DEBOUNCE_SECONDS'],
+                batch['first'] + CONFIG['CHANGE_DEBOUNCE_MAX_SECONDS']
+            )
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        batch = pending_changes.pop(key)
+        await flush_changes(key[1], batch)
+    except Exception as e:
+        pending_changes.pop(key, None)
+        log.error("Ошибка отправки пачки изменений: %s", e)
+
+def format_change(field, old, new):
+    """Строки диффа для одного поля (пустой список - изменение откатили)"""
+    label = CHANGE_FIELD_NAMES.get(field, field)
+
+    if old == new:
+        return []
+
+    if field == 'permissions':
+        changed_perms = [
+            f"{'✅' if value else '⛔'} {perm}"
+            for perm, value in new
+            if getattr(old, perm) != value
+        ]
+        if not changed_perms:
+            return []
+        return [f"**{label}:** " + ", ".join(changed_perms[:5]) + (" ..." if len(changed_perms) > 5 else "")]
+
+    if field == 'roles':
+        old_ids = {role.id for role in old}
+        new_ids = {role.id for role in new}
+        lines = []
+        added = [role.mention for role in new if role.id not in old_ids]
+        removed = [role.mention for role in old if role.id not in new_ids]
+        if added:
+            lines.append(f"**✅ Роли выданы:** {', '.join(added)}")
+        if removed:
+            lines.append(f"**⛔ Роли изъяты:** {', '.join(removed)}")
+        return lines
+
+    if field == 'timed_out_until':
+        if new and new > datetime.now().astimezone():
+            duration = (new - datetime.now().astimezone()).total_seconds() / 60
+            return [f"**⏰ Таймаут:** `{duration:.1f}` минут"]
+        return ["**🔊 Таймаут снят**"]
+
+    if field == 'slowmode_delay':
+        return [f"**{label}:** `{old}`с → `{new}`с"]
+
+    return [f"**{label}:** `{old if old is not None else 'Нет'}` → `{new if new is not None else 'Нет'}`"]
+
+def member_change_kinds(fields):
+    """Виды изменений участника (ключи MEMBER_CHANGE_STYLES); откаченные изменения не учитываются"""
+    kinds = set()
+    for field, (old, new) in fields.items():
+        if old == new:
+            continue
+        if field == 'roles':
+            old_ids = {role.id for role in old}
+            new_ids = {role.id for role in new}
+            if new_ids - old_ids:
+                kinds.add('role_added')
+            if old_ids - new_ids:
+                kinds.add('role_removed')
+        elif field == 'timed_out_until':
+            kinds.add('timeout' if new and new > datetime.now().astimezone() else 'timeout_removed')
+        elif field == 'nick':
+            kinds.add('nick')
+    return kinds
+
+def change_style(kind, entities):
+    """Заголовок и цвет эмбеда пачки: у участников - по виду изменений, если он в пачке один"""
+    title = CHANGE_KINDS[kind]['title'][0 if len(entities) == 1 else 1]
+    if kind == 'member':
+        kinds = set().union(*(member_change_kinds(entry['fields']) for entry in entities.values()))
+        if len(kinds) == 1:
+            title, color = MEMBER_CHANGE_STYLES[kinds.pop()]
+            return title, COLORS[color]
+    return title, COLORS['UPDATE']
+
+async def attribute_changes(guild, kind, entities):
+    """Одна выборка аудит-лога на пачку (для участников - по одной на тип действия)"""
+    time_window = CONFIG['CHANGE_DEBOUNCE_MAX_SECONDS'] + 10
+
+    if kind == 'channel':
+        return await get_audit_log_attribution(
+            guild, discord.AuditLogAction.channel_update, set(entities), time_window, fallback=True
+        )
+
+    if kind == 'role':
+        return await get_audit_log_attribution(
+            guild, discord.AuditLogAction.role_update, set(entities), time_window, fallback=True
+        )
+
+    role_targets = {eid for eid, e in entities.items() if 'roles' in e['fields']}
+    other_targets = {eid for eid, e in entities.items() if set(e['fields']) - {'roles'}}
+
+    attribution = {}
+    if other_targets:
+        attribution.update(await get_audit_log_attribution(
+            guild, discord.AuditLogAction.member_update, other_targets, time_window
+        ))
+    if role_targets:
+        role_attribution = await get_audit_log_attribution(
+            guild, discord.AuditLogAction.member_role_update, role_targets, time_window
+        )
+        for target_id, info in role_attribution.items():
+            attribution.setdefault(target_id, info)
+
+    return attribution
+
+async def flush_changes(kind, batch):
+    """Сборка одного diff-эмбеда по всей пачке"""
+    guild = batch['guild']
+
+    entities = {}
+    for entity_id, entry in batch['entities'].items():
+        lines = []
+        for field, (old, new) in entry['fields'].items():
+            lines.extend(format_change(field, old, new))
+        if lines:
+            entities[entity_id] = {'entity': entry['entity'], 'fields': entry['fields'], 'lines': lines}
+
+    if not entities:
+        return
+
+    attribution = await attribute_changes(guild, kind, entities)
+    kind_info = CHANGE_KINDS[kind]
+    title, color = change_style(kind, entities)
+
+    if len(entities) == 1:
+        entity_id, entry = next(iter(entities.items()))
+        entity = entry['entity']
+        moderator, reason = attribution.get(entity_id, (None, "Не указана"))
+
+        await log_action(
+            guild,
+            title,
+            "\n".join(entry['lines']),
+            color,
+            target=entity if kind == 'member' else None,
+            moderator=moderator,
+            reason=reason,
+            extra_fields=None if kind == 'member' else {
+                kind_info['entity_name']: f"{entity.mention} (`{entity.name}`)"
+            }
+        )
+        return
+
+    moderators = {info[0].id: info[0] for info in attribution.values() if info[0]}
+    common_moderator = next(iter(moderators.values())) if len(moderators) == 1 else None
+
+    blocks = []
+    for entity_id, entry in entities.items():
+        entity = entry['entity']
+        header = f"{entity.mention} (`{entity.name}`)"
+        moderator = attribution.get(entity_id, (None, None))[0]
+        if moderator and not common_moderator:
+            header += f" — {moderator.mention}"
+        blocks.append(header + "\n" + "\n".join(f"　{line}" for line in entry['lines']))
+
+    description = ""
+    for idx, block in enumerate(blocks):
+        if len(description) + len(block) > 3800:
+            description += f"*... и еще {len(blocks) - idx}*"
+            break
+        description += block + "\n\n"
+
+    await log_action(
+        guild,
+        f"{title} ({len(entities)})",
+        description.strip(),
+        color,
+        moderator=common_moderator,
+        extra_fields={"📦 Объединено": f"`{len(entities)}` объектов за `{int(batch['last'] - batch['first']) + 1}`с"}
+    )
+
 async def send_admin_alert(guild, action, moderator, details):
     try:
         BOT_OWNER_ID = 852962557002252289
@@ -471,7 +1097,7 @@ async def send_admin_alert(guild, action, moderator, details):
         if owner:
             try:
                 await owner.send(embed=alert_embed)
-                print(f"✅ Тревога отправлена владельцу сервера: {owner.name}")
+                log.info("✅ Тревога отправлена владельцу сервера: %s", owner.name)
             except discord.Forbidden:
                 if guild.system_channel:
                     await guild.system_channel.send(f"{owner.mention}", embed=alert_embed)
@@ -479,21 +1105,19 @@ async def send_admin_alert(guild, action, moderator, details):
         if bot_owner and bot_owner.id != owner.id:
             try:
                 await bot_owner.send(embed=alert_embed)
-                print(f"✅ Тревога отправлена создателю бота: {bot_owner.name}")
+                log.info("✅ Тревога отправлена создателю бота: %s", bot_owner.name)
             except discord.Forbidden:
-                print(f"⛔ Не удалось отправить тревогу создателю бота")
+                log.error("⛔ Не удалось отправить тревогу создателю бота")
         
     except Exception as e:
-        print(f"⛔ Ошибка отправки тревоги: {e}")
+        log.error("⛔ Ошибка отправки тревоги: %s", e)
 
 # Создание карточки уровня
 # Создание карточки уровня (ОБНОВЛЕНА)
-def create_level_embed(user, member, show_prestige_button=False):
-    data = user
+def get_rank_tier(data):
+    """Цвет, эмодзи и название ранга с учетом престижа"""
     prestige_level = data.get('prestige', 0)
-    prestige_emoji = get_prestige_emoji(prestige_level)
     
-    # Определяем цвет и ранг с учетом престижа
     if prestige_level >= 3:
         color = discord.Color.gold()
         rank_emoji = "👑"
@@ -519,6 +1143,16 @@ def create_level_embed(user, member, show_prestige_button=False):
         rank_emoji = "🌱"
         rank_name = "BEGINNER"
     
+    return color, rank_emoji, rank_name
+
+def create_level_embed(user, member, show_prestige_button=False):
+    data = user
+    prestige_level = data.get('prestige', 0)
+    prestige_emoji = get_prestige_emoji(prestige_level)
+    
+    # Определяем цвет и ранг с учетом престижа
+    color, rank_emoji, rank_name = get_rank_tier(data)
+    
     # Добавляем престиж к названию ранга
     if prestige_level > 0:
         rank_name = f"{rank_name} {prestige_emoji}"
@@ -539,7 +1173,8 @@ def create_level_embed(user, member, show_prestige_button=False):
         value=f"-# **Общий уровень:** `{data['total_level']}`\n"
               f"-# **Всего опыта:** `{data['total_xp']:,} XP`\n"
               f"-# **Прогресс:** `{data['total_xp'] % CONFIG['XP_PER_LEVEL']}/{CONFIG['XP_PER_LEVEL']} XP`\n"
-              f"-# **Престиж:** `{prestige_level}/3`",
+              f"-# **Престиж:** `{prestige_level}/{MAX_PRESTIGE}`"
+              + (f"\n-# **Место в рейтинге:** `#{data['rank'][0]:,}` из `{data['rank'][1]:,}`" if data.get('rank') else ""),
         inline=False
     )
     
@@ -567,7 +1202,7 @@ def create_level_embed(user, member, show_prestige_button=False):
         )
     
     # Показываем кнопку престижа если достигнут максимум
-    if show_prestige_button and prestige_level < 3 and data['text_level'] >= 1000 and data['voice_level'] >= 1000:
+    if show_prestige_button and can_prestige(data):
         embed.add_field(
             name="`🎉 Доступен престиж!`",
             value="Нажмите кнопку ниже чтобы получить престиж и сбросить уровни с бонусами!",
@@ -578,38 +1213,209 @@ def create_level_embed(user, member, show_prestige_button=False):
     
     return embed
 
-async def prestige_up(user_id, guild=None):
-    """Повышение престижа пользователя"""
-    try:
-        user_data = await get_user_data(user_id)
-        current_prestige = user_data.get('prestige', 0)
+# ========== КАРТОЧКИ РАНГА ==========
+# PNG-карточка к /уровень и /профиль. Вся работа Pillow - в пуле потоков (декодирование,
+# ресайз, отрисовка и сжатие PNG отпускают GIL), цикл событий только ждет готовые байты.
+# Шрифты, маска аватара и фон со статичными подписями (на каждый цвет ранга) готовятся
+# один раз; декодированные аватары кэшируются по хэшу аватара, готовые карточки - по
+# состоянию, которое на них видно (опыт округляется до шага полосы прогресса).
+
+CARD_SIZE = (934, 282)
+CARD_AVATAR_SIZE = 200
+CARD_XP_STEP = max(1, CONFIG['XP_PER_LEVEL'] // 20)  # Шаг полосы прогресса - 5% уровня
+
+card_executor = ThreadPoolExecutor(max_workers=CONFIG['RANK_CARD_THREADS'], thread_name_prefix='rank-card') if Image else None
+card_assets = {'fonts': None, 'mask': None, 'background': None, 'templates': {}}
+card_assets_lock = threading.Lock()
+avatar_cache = OrderedDict()  # {хэш аватара: RGBA-картинка CARD_AVATAR_SIZE}
+avatar_requests = {}  # {хэш аватара: Future} - одна загрузка на аватар при одновременных запросах
+rank_card_cache = OrderedDict()  # {ключ состояния карточки: PNG}
+
+def lru_put(cache, key, value, limit):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+def load_card_assets():
+    """Шрифты, маска аватара и фон (один раз на процесс, в потоке пула)"""
+    with card_assets_lock:
+        if card_assets['fonts'] is not None:
+            return
         
-        if current_prestige >= 3:
-            return False, "Достигнут максимальный уровень престижа!"
+        fonts = {}
+        for key, size in (('name', 42), ('level', 34), ('small', 22)):
+            try:
+                fonts[key] = ImageFont.truetype(CONFIG['RANK_CARD_FONT'], size)
+            except OSError:
+                fonts[key] = ImageFont.load_default(size)
+        
+        mask = Image.new('L', (CARD_AVATAR_SIZE, CARD_AVATAR_SIZE), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, CARD_AVATAR_SIZE - 1, CARD_AVATAR_SIZE - 1), fill=255)
         
-        # Проверяем условия для престижа
-        if user_data['text_level'] < 1000 or user_data['voice_level'] < 1000:
-            return False, "Для престижа нужен 1000 уровень в текстовом и голосовом чате!"
+        background = Image.new('RGBA', CARD_SIZE, (35, 39, 42, 255))
+        if CONFIG['RANK_CARD_BACKGROUND']:
+            try:
+                with Image.open(CONFIG['RANK_CARD_BACKGROUND']) as image:
+                    background = image.convert('RGBA').resize(CARD_SIZE)
+            except OSError as e:
+                log.warning("⚠️ Фон карточки не загружен: %s", e)
         
-        # Сбрасываем уровни и увеличиваем престиж
-        user_data['text_xp'] = 0
-        user_data['text_level'] = 1
-        user_data['voice_xp'] = 0
-        user_data['voice_level'] = 1
-        user_data['total_xp'] = 0
-        user_data['total_level'] = 1
-        user_data['prestige'] = current_prestige + 1
+        card_assets.update(mask=mask, background=background)
+        card_assets['fonts'] = fonts
+
+def card_template(accent):
+    """Фон с рамкой и статичными подписями для цвета ранга"""
+    template = card_assets['templates'].get(accent)
+    if template is None:
+        template = card_assets['background'].copy()
+        draw = ImageDraw.Draw(template)
+        fonts = card_assets['fonts']
+        draw.rounded_rectangle((8, 8, CARD_SIZE[0] - 9, CARD_SIZE[1] - 9), radius=24, outline=accent, width=4)
+        draw.text((270, 176), "ТЕКСТ", font=fonts['small'], fill=(185, 187, 190))
+        draw.text((270, 224), "ГОЛОС", font=fonts['small'], fill=(185, 187, 190))
+        card_assets['templates'][accent] = template
+    return template
+
+def decode_avatar(raw):
+    """PNG аватара -> круглая RGBA-картинка нужного размера (в потоке пула)"""
+    load_card_assets()
+    with Image.open(io.BytesIO(raw)) as image:
+        avatar = image.convert('RGBA').resize((CARD_AVATAR_SIZE, CARD_AVATAR_SIZE), Image.LANCZOS)
+    avatar.putalpha(card_assets['mask'])
+    return avatar
+
+def draw_progress(draw, box, xp, accent):
+    left, top, right, bottom = box
+    draw.rounded_rectangle(box, radius=(bottom - top) // 2, fill=(72, 75, 78))
+    progress = (xp % CONFIG['XP_PER_LEVEL']) / CONFIG['XP_PER_LEVEL']
+    if progress > 0:
+        width = max(bottom - top, int((right - left) * progress))
+        draw.rounded_rectangle((left, top, left + width, bottom), radius=(bottom - top) // 2, fill=accent)
+
+def render_rank_card(data, name, avatar, rank_name, accent):
+    """Сборка PNG-карточки (в потоке пула)"""
+    load_card_assets()
+    fonts = card_assets['fonts']
+    card = card_template(accent).copy()
+    draw = ImageDraw.Draw(card)
+    
+    if avatar is not None:
+        card.paste(avatar, (40, 41), avatar)
+    else:
+        draw.ellipse((40, 41, 40 + CARD_AVATAR_SIZE, 41 + CARD_AVATAR_SIZE), fill=(72, 75, 78))
+    
+    draw.text((270, 36), name[:22], font=fonts['name'], fill=(255, 255, 255))
+    draw.text((CARD_SIZE[0] - 36, 44), rank_name, font=fonts['small'], fill=accent, anchor='ra')
+    
+    level_text = f"УРОВЕНЬ {data['total_level']}"
+    if data.get('rank'):
+        level_text += f"   #{data['rank']:,}"
+    draw.text((270, 92), level_text, font=fonts['level'], fill=(255, 255, 255))
+    draw.text(
+        (CARD_SIZE[0] - 36, 104),
+        f"{data['total_xp'] % CONFIG['XP_PER_LEVEL']:,} / {CONFIG['XP_PER_LEVEL']:,} XP",
+        font=fonts['small'], fill=(185, 187, 190), anchor='ra'
+    )
+    draw_progress(draw, (270, 136, CARD_SIZE[0] - 36, 160), data['total_xp'], accent)
+    
+    for top, xp_type in ((176, 'text'), (224, 'voice')):
+        draw.text((CARD_SIZE[0] - 36, top), f"ур. {data[f'{xp_type}_level']}", font=fonts['small'], fill=(255, 255, 255), anchor='ra')
+        draw_progress(draw, (380, top + 6, CARD_SIZE[0] - 130, top + 20), data[f'{xp_type}_xp'], accent)
+    
+    output = io.BytesIO()
+    card.save(output, 'PNG', compress_level=1)  # Быстрое сжатие: карточка живет в кэше и уходит один раз
+    return output.getvalue()
+
+async def get_avatar_image(member):
+    """Декодированный аватар из LRU-кэша (загрузка и декодирование - один раз на хэш аватара)"""
+    asset = member.display_avatar
+    key = asset.key
+    
+    if key in avatar_cache:
+        avatar_cache.move_to_end(key)
+        metrics.inc('rank_card_avatar_cache_total', result='hit')
+        return avatar_cache[key]
+    if key in avatar_requests:
+        return await asyncio.shield(avatar_requests[key])
+    
+    metrics.inc('rank_card_avatar_cache_total', result='miss')
+    loop = asyncio.get_running_loop()
+    future = avatar_requests[key] = loop.create_future()
+    avatar = None
+    try:
+        raw = await asyncio.wait_for(asset.replace(size=256, format='png').read(), 2)
+        avatar = await loop.run_in_executor(card_executor, decode_avatar, raw)
+        lru_put(avatar_cache, key, avatar, CONFIG['AVATAR_CACHE_SIZE'])
+    except Exception as e:
+        log.warning("⚠️ Аватар %s не загружен: %s", member.id, e)
+    finally:
+        del avatar_requests[key]
+        future.set_result(avatar)
+    return avatar
+
+async def get_rank_card(data, member):
+    """PNG-карточка ранга или None (Pillow не установлен, карточки выключены или ошибка)"""
+    if card_executor is None or not CONFIG['RANK_CARDS']:
+        return None
+    
+    try:
+        # На карточке опыт виден с точностью до шага полосы - по нему и ключ кэша
+        shown = {key: data[key] for key in ('text_level', 'voice_level', 'total_level')}
+        shown['rank'] = data['rank'][0] if data.get('rank') else None
+        for xp_type in ('text', 'voice', 'total'):
+            shown[f'{xp_type}_xp'] = data[f'{xp_type}_xp'] // CARD_XP_STEP * CARD_XP_STEP
+        
+        color, _, rank_name = get_rank_tier(data)
+        key = (member.id, member.display_name, member.display_avatar.key, data.get('prestige', 0), *sorted(shown.items()))
+        
+        card = rank_card_cache.get(key)
+        if card is not None:
+            rank_card_cache.move_to_end(key)
+            metrics.inc('rank_card_cache_total', result='hit')
+            return card
+        
+        metrics.inc('rank_card_cache_total', result='miss')
+        avatar = await get_avatar_image(member)
+        with metrics.timer('rank_card_render_seconds'):
+            card = await asyncio.get_running_loop().run_in_executor(
+                card_executor, render_rank_card, shown, member.display_name, avatar, rank_name, color.to_rgb()
+            )
+        lru_put(rank_card_cache, key, card, CONFIG['RANK_CARD_CACHE_SIZE'])
+        return card
+    except Exception as e:
+        log.error("Ошибка отрисовки карточки ранга: %s", e)
+        return None
+
+async def rank_card_files(embed, data, member):
+    """Прикрепить карточку к embed: список файлов для отправки (пустой, если карточки нет)"""
+    card = await get_rank_card(data, member)
+    if card is None:
+        return []
+    embed.set_image(url="attachment://rank.png")
+    return [discord.File(io.BytesIO(card), filename="rank.png")]
+
+async def prestige_up(user_id, guild=None):
+    """Повышение престижа пользователя"""
+    try:
+        # Условия проверяются в самом UPDATE - между проверкой и сбросом опыт не изменится
+        row = await reset_user_xp(user_id, 'prestige_user', MAX_PRESTIGE, PRESTIGE_LEVEL, CONFIG['MAX_LEVEL'])
+        if row is None:
+            current = await db_query('fetchrow', 'get_level_card', int(user_id))
+            if current and current['prestige'] >= MAX_PRESTIGE:
+                return False, "Достигнут максимальный уровень престижа!"
+            return False, f"Для престижа нужен {prestige_required_level()} уровень в текстовом и голосовом чате!"
         
-        await save_user_data(user_id, user_data)
+        prestige = row['prestige']
         
         # Отправляем уведомление о престиже
         if guild:
-            member = guild.get_member(int(user_id))
+            member = await member_resolver.get(guild, user_id)
             if member:
-                prestige_emoji = get_prestige_emoji(user_data['prestige'])
+                prestige_emoji = get_prestige_emoji(prestige)
                 embed = discord.Embed(
                     title=f"{prestige_emoji} 🎉 НОВЫЙ ПРЕСТИЖ!",
-                    description=f"{member.mention} достиг **{user_data['prestige']}** престижа!",
+                    description=f"<@{user_id}> достиг **{prestige}** престижа!",
                     color=discord.Color.gold(),
                     timestamp=datetime.now()
                 )
@@ -624,7 +1430,7 @@ async def prestige_up(user_id, guild=None):
                     inline=False
                 )
                 
-                embed.set_thumbnail(url=member.display_avatar.url)
+                embed.set_thumbnail(url=member['avatar'])
                 embed.set_footer(text="Поздравляем с достижением! 🏆")
                 
                 notification_channel_id = await get_notification_channel(guild.id)
@@ -632,57 +1438,122 @@ async def prestige_up(user_id, guild=None):
                     channel = bot.get_channel(int(notification_channel_id))
                     if channel:
                         await channel.send(embed=embed)
-                        return True, f"Поздравляем с {user_data['prestige']} престижем!"
+                        return True, f"Поздравляем с {prestige} престижем!"
                 
                 if guild.system_channel:
                     await guild.system_channel.send(embed=embed)
         
-        return True, f"Поздравляем с {user_data['prestige']} престижем!"
+        return True, f"Поздравляем с {prestige} престижем!"
         
     except Exception as e:
-        print(f"Ошибка при повышении престижа: {e}")
+        log.error("Ошибка при повышении престижа: %s", e)
         return False, "Произошла ошибка при получении престижа!"
 
 # Создание топа
-async def create_leaderboard_embed(guild, top_type='total'):
+leaderboard_page_cache = OrderedDict()  # {(guild_id, тип, курсор, страница): (истекает, описание, следующий курсор)}
+
+async def get_leaderboard_page(guild, top_type, cursor, page):
+    """
+    Описание страницы топа сервера и курсор следующей страницы (None - страница последняя)
+    Страница кэшируется на LEADERBOARD_CACHE_SECONDS: листание туда-обратно не ходит в БД
+    """
+    key = (guild.id, top_type, cursor, page)
+    cached = leaderboard_page_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+    
+    size = CONFIG['LEADERBOARD_PAGE_SIZE']
+    
+    # Рейтинг общий для всех серверов: не-участников пропускаем и добираем страницу
+    # следующими строками. Лишний участник - признак того, что есть следующая страница
+    entries = []  # [(строка, info)]
+    last, scanned, exhausted = cursor, 0, False
+    while len(entries) <= size and scanned < CONFIG['LEADERBOARD_MAX_SCAN']:
+        rows = await get_leaderboard(top_type, MEMBER_QUERY_CHUNK, after=last)
+        if not rows:
+            exhausted = True
+            break
+        scanned += len(rows)
+        members = await member_resolver.resolve(guild, [int(row['user_id']) for row in rows])
+        for row in rows:
+            last = (row['xp'], row['user_id'])
+            if int(row['user_id']) in members:
+                entries.append((row, members[int(row['user_id'])]))
+                if len(entries) > size:
+                    break
+        exhausted = len(rows) < MEMBER_QUERY_CHUNK
+        if exhausted:
+            break
+    
+    if len(entries) > size:
+        entries = entries[:size]
+        next_cursor = (entries[-1][0]['xp'], entries[-1][0]['user_id'])
+    else:
+        # Лимит просмотра исчерпан - следующая страница продолжит с последней просмотренной строки
+        next_cursor = None if exhausted or not scanned else last
+    
+    medals = ["🥇", "🥈", "🥉"]
+    description = ""
+    
+    for idx, (data, member) in enumerate(entries):
+        position = page * size + idx
+        medal = medals[position] if position < 3 else f"`#{position + 1}`"
+        
+        description += f"{medal} **{member['name']}**\n"
+        description += f"　├ Уровень: `{data['level']}`\n"
+        description += f"　└ Опыт: `{data['xp']:,}` XP\n\n"
+    
+    if not description:
+        description = "*Пока нет данных*" if page == 0 else "*На этой странице нет участников сервера*"
+    
+    # Пустой ответ при недоступной БД не кэшируем
+    if scanned:
+        expires_at = time.monotonic() + CONFIG['LEADERBOARD_CACHE_SECONDS']
+        lru_put(leaderboard_page_cache, key, (expires_at, description, next_cursor), CONFIG['LEADERBOARD_CACHE_SIZE'])
+    
+    return description, next_cursor
+
+async def create_leaderboard_embed(guild, top_type='total', cursor=None, page=0):
+    """Embed страницы топа и курсор следующей страницы"""
     if top_type == 'text':
-        title = "💬 Топ-10 по текстовому чату"
-        field = 'text'
+        title = "💬 Топ по текстовому чату"
     elif top_type == 'voice':
-        title = "🎤 Топ-10 по голосовому чату"
-        field = 'voice'
+        title = "🎤 Топ по голосовому чату"
     else:
-        title = "⭐ Топ-10 общий рейтинг"
-        field = 'total'
+        title = "⭐ Общий рейтинг"
     
-    sorted_users = await get_leaderboard(top_type, 10)
+    description, next_cursor = await get_leaderboard_page(guild, top_type, cursor, page)
     
     embed = discord.Embed(title=title, color=discord.Color.gold(), timestamp=datetime.now())
+    embed.description = description
+    embed.set_footer(text=f"Страница {page + 1} • Обновлено", icon_url=bot.user.display_avatar.url)
+    
+    return embed, next_cursor
+
+async def create_period_leaderboard_embed(guild, period, top_type='total'):
+    period_name = "неделю" if period == 'w' else "месяц"
+    type_titles = {
+        'text': f"💬 Топ-10 текстового чата за {period_name}",
+        'voice': f"🎤 Топ-10 голосового чата за {period_name}",
+        'total': f"📅 Топ-10 за {period_name}"
+    }
+    
+    # С запасом: ушедшие с сервера пропускаются, их места занимают следующие
+    sorted_users = await get_period_leaderboard(guild.id, period, top_type, MEMBER_QUERY_CHUNK)
+    members = await member_resolver.resolve(guild, [int(data['user_id']) for data in sorted_users])
+    sorted_users = [data for data in sorted_users if int(data['user_id']) in members][:10]
+    
+    embed = discord.Embed(title=type_titles.get(top_type, type_titles['total']), color=discord.Color.gold(), timestamp=datetime.now())
     
     medals = ["🥇", "🥈", "🥉"]
     description = ""
     
     for idx, data in enumerate(sorted_users):
-        try:
-            member = guild.get_member(int(data['user_id']))
-            if not member:
-                continue
-            
-            medal = medals[idx] if idx < 3 else f"`#{idx + 1}`"
-            level = data[f'{field}_level']
-            xp = data[f'{field}_xp']
-            
-            description += f"{medal} **{member.display_name}**\n"
-            description += f"　├ Уровень: `{level}`\n"
-            description += f"　└ Опыт: `{xp:,}` XP\n\n"
-        except:
-            continue
+        medal = medals[idx] if idx < 3 else f"`#{idx + 1}`"
+        description += f"{medal} **{members[int(data['user_id'])]['name']}** - `{data['xp']:,}` XP\n"
     
-    if not description:
-        description = "*Пока нет данных*"
-    
-    embed.description = description
-    embed.set_footer(text=f"Обновлено", icon_url=bot.user.display_avatar.url)
+    embed.description = description or "*Пока нет данных*"
+    embed.set_footer(text=f"Обновляется раз в {CONFIG['XP_HISTORY_FLUSH_SECONDS']}с", icon_url=bot.user.display_avatar.url)
     
     return embed
 
@@ -709,8 +1580,11 @@ async def create_user_stats_embed(member):
         'offline': '⚫ Не в сети'
     }
     
-    current_status = str(member.status)
-    status_text = status_dict.get(current_status, '⚫ Не в сети')
+    # Без интента присутствий Discord не присылает статусы - все выглядели бы "не в сети"
+    if bot.intents.presences:
+        status_text = status_dict.get(str(member.status), '⚫ Не в сети')
+    else:
+        status_text = '❔ Недоступно'
     
     embed.add_field(
         name="👤 Основная информация",
@@ -743,7 +1617,7 @@ async def create_user_stats_embed(member):
         inline=False
     )
     
-    activity_text = "⛔ Не активно"
+    activity_text = "⛔ Не активно" if bot.intents.presences else "❔ Недоступно (GATEWAY_PRESENCES=0)"
     if member.activity:
         activity = member.activity
         try:
@@ -767,11 +1641,14 @@ async def create_user_stats_embed(member):
     )
     
     # ИСПРАВЛЕНО: добавлен await
-    user_level_data = await get_user_data(member.id)
-    level_text = f"**Общий уровень:** `{user_level_data['total_level']}`\n"
-    level_text += f"**Текстовый:** `{user_level_data['text_level']}`\n"
-    level_text += f"**Голосовой:** `{user_level_data['voice_level']}`\n"
-    level_text += f"**Всего опыта:** `{user_level_data['total_xp']:,} XP`"
+    user_level_data = await get_level_card_data(member.id)
+    if user_level_data:
+        level_text = f"**Общий уровень:** `{user_level_data['total_level']}`\n"
+        level_text += f"**Текстовый:** `{user_level_data['text_level']}`\n"
+        level_text += f"**Голосовой:** `{user_level_data['voice_level']}`\n"
+        level_text += f"**Всего опыта:** `{user_level_data['total_xp']:,} XP`"
+    else:
+        level_text = "*Временно недоступно*"
     
     embed.add_field(
         name="📈 Уровни",
@@ -808,20 +1685,180 @@ async def create_user_stats_embed(member):
     
     return embed
 
-# Событие: бот готов
+# ========== ВЫНОСНОЙ ВОРКЕР ==========
+# С WORKER_SOCKET учет XP и запись аудита выполняет worker.py: процесс бота только кладет
+# события в Unix-сокет (JSON-строки) и не ждет БД. Если воркер недоступен или не успевает,
+# события обрабатываются в этом процессе, как без воркера.
+
+class WorkerClient:
+    """Канал до воркера: туда - начисления XP и аудит, обратно - повышения уровня"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.process = None
+        self.closing = False
+    
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+    
+    async def start(self):
+        if CONFIG['WORKER_SPAWN']:
+            worker_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+            self.process = await asyncio.create_subprocess_exec(sys.executable, worker_path)
+            log.info("🧵 Воркер запущен (pid %s)", self.process.pid)
+        await self.connect(attempts=50)
+    
+    async def connect(self, attempts=None):
+        """Подключение к сокету воркера (attempts=None - пока не получится)"""
+        attempt = 0
+        while not self.closing:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                attempt += 1
+                if attempts is not None and attempt >= attempts:
+                    log.error("⛔ Воркер %s недоступен (%s), XP считается в процессе бота", self.path, e)
+                    return False
+                await asyncio.sleep(min(0.2 * attempt, 5))
+        else:
+            return False
+        
+        self.read_task = asyncio.create_task(self.read_loop())
+        log.info("🔌 Подключен воркер %s", self.path)
+        return True
+    
+    def send(self, op, **payload):
+        """Отправка без ожидания; False - воркер недоступен или не успевает (обработать локально)"""
+        if not self.connected or self.writer.transport.get_write_buffer_size() > CONFIG['WORKER_MAX_BUFFER']:
+            metrics.inc('worker_events_rejected_total', op=op)
+            return False
+        
+        self.writer.write(json.dumps({'op': op, **payload}, ensure_ascii=False).encode() + b'\n')
+        metrics.inc('worker_events_total', op=op)
+        return True
+    
+    async def read_loop(self):
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                if message['op'] == 'level_up':
+                    guild = bot.get_guild(message['guild_id'])
+                    if guild:
+                        # Отправка в Discord не должна задерживать чтение сокета
+                        asyncio.create_task(send_level_up_notification(
+                            message['user_id'], message['xp_type'], message['old_level'], message['new_level'], guild
+                        ))
+        except Exception as e:
+            log.error("⛔ Ошибка чтения сокета воркера: %s", e)
+        
+        self.writer.close()
+        if not self.closing:
+            log.warning("⚠️ Связь с воркером потеряна, XP считается в процессе бота до переподключения")
+            asyncio.create_task(self.connect())
+    
+    async def close(self):
+        """EOF воркеру (он дописывает пачки), затем остановка дочернего процесса"""
+        self.closing = True
+        if self.connected:
+            self.writer.write_eof()
+            await self.writer.drain()
+            if self.read_task:
+                # Воркер закрывает соединение, дописав пачки и отправив последние повышения уровня
+                await asyncio.wait([self.read_task], timeout=10)
+        
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+# ========== ЖИЗНЕННЫЙ ЦИКЛ ==========
+# setup_hook выполняется один раз за процесс (после логина, до подключения к гейтвею).
+# on_ready может прийти повторно после переподключения - там только дешевая работа с кэшем.
+
 @bot.event
-async def on_ready():
-    print(f'✅ Бот {bot.user.name} запущен!')
-    print(f'📊 Настройки XP:')
-    print(f'   Текстовый: {CONFIG["TEXT_XP_MIN"]}-{CONFIG["TEXT_XP_MAX"]} XP, кулдаун: {CONFIG["TEXT_COOLDOWN"]}с')
-    print(f'   Голосовой: {CONFIG["VOICE_XP_PER_MINUTE"]} XP/мин')
-    print(f'   XP за уровень: {CONFIG["XP_PER_LEVEL"]}')
+async def setup_hook():
+    global worker_client
+    
+    log.info('📊 Настройки XP:')
+    log.info('   Текстовый: %s-%s XP, кулдаун: %sс', CONFIG["TEXT_XP_MIN"], CONFIG["TEXT_XP_MAX"], CONFIG["TEXT_COOLDOWN"])
+    log.info('   Голосовой: %s XP/мин', CONFIG["VOICE_XP_PER_MINUTE"])
+    log.info('   XP за уровень: %s', CONFIG["XP_PER_LEVEL"])
     
     await init_database()
+    await load_settings_cache()
+    
+    await sync_command_tree()
+    
+    if CONFIG['WORKER_SOCKET']:
+        worker_client = WorkerClient(CONFIG['WORKER_SOCKET'])
+        await worker_client.start()
+    
+    voice_xp_task.start()
+    reconcile_xp_task.start()
+    xp_history_task.start()
+    log.info('✅ Фоновые задачи голосового XP, отложенного опыта и истории XP запущены')
+    
+    # Первая итерация сверки и есть загрузка индекса мест
+    rank_refresh_task.start()
+    
+    await start_metrics_server()
+    start_profiler()
+    
+    if card_executor is not None and CONFIG['RANK_CARDS']:
+        # Шрифты и фон грузятся заранее, чтобы первая карточка не ждала диск
+        await asyncio.get_running_loop().run_in_executor(card_executor, load_card_assets)
+        log.info('✅ Карточки ранга включены (потоков: %s)', CONFIG['RANK_CARD_THREADS'])
+
+def command_tree_hash(guild=None):
+    """Стабильный хэш определений слеш-команд (то, что уходит в Discord при sync)"""
+    payload = sorted(
+        (command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)),
+        key=lambda command: (command.get('type', 1), command['name'])
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def sync_command_tree():
+    """
+    Синхронизация слеш-команд только при изменении их определения
+    С DEV_GUILD_ID команды копируются на тестовый сервер и обновляются там мгновенно
+    """
+    # Команды общие для приложения - в кластере их синхронизирует только процесс с шардом 0
+    if CONFIG['SHARD_IDS'] is not None and 0 not in CONFIG['SHARD_IDS']:
+        log.info('✅ Синхронизация команд выполняется процессом с шардом 0')
+        return
+    
+    guild = discord.Object(id=CONFIG['DEV_GUILD_ID']) if CONFIG['DEV_GUILD_ID'] else None
+    if guild:
+        bot.tree.copy_global_to(guild=guild)
     
-    # Восстановление голосовых сессий после перезапуска
-    print("🔍 Восстановление голосовых сессий...")
+    scope = f"guild:{guild.id}" if guild else "global"
+    key = f"command_tree_hash:{bot.application_id}:{scope}"
+    
+    try:
+        digest = command_tree_hash(guild)
+        if not CONFIG['FORCE_COMMAND_SYNC'] and await get_bot_meta(key) == digest:
+            log.info('✅ Команды не изменились (%s), синхронизация пропущена', scope)
+            return
+        
+        synced = await bot.tree.sync(guild=guild)
+        await set_bot_meta(key, digest)
+        log.info('✅ Синхронизировано %s команд (%s)', len(synced), scope)
+    except Exception as e:
+        log.error('⛔ Ошибка синхронизации команд: %s', e)
+
+def restore_voice_sessions(shard_id=None):
+    """Подхват участников, уже сидящих в голосовых каналах (идемпотентно; shard_id - только сервера шарда)"""
+    restored = 0
     for guild in bot.guilds:
+        if shard_id is not None and guild.shard_id != shard_id:
+            continue
         for channel in guild.voice_channels:
             for member in channel.members:
                 if not member.bot:
@@ -837,18 +1874,68 @@ async def on_ready():
                             'last_xp_time': time.time(),
                             'pending_xp': 0
                         }
-                        print(f"🎤 Восстановлена сессия для {member.name} в {channel.name}")
+                        restored += 1
+                        log.debug("🎤 Восстановлена сессия для %s в %s", member.name, channel.name)
+    return restored
+
+# Событие: бот готов (в том числе после переподключения)
+@bot.event
+async def on_ready():
+    restored = restore_voice_sessions()
+    log.info('✅ Бот %s готов, восстановлено %s голосовых сессий (всего %s)', bot.user.name, restored, len(voice_sessions))
+    
+    report = gateway_report()
+    log.info(
+        "🧠 Шлюз: профиль %s, кэш участников %s (%s из %s), пользователей %s, RSS %s МБ; отключены интенты: %s",
+        report['profile'], report['member_cache'], report['cached_members'], report['member_count'],
+        report['cached_users'], report['rss_mb'], ', '.join(report['disabled_intents']) or 'нет'
+    )
+
+@bot.event
+async def on_shard_ready(shard_id):
+    # Переподключение одного шарда затрагивает только его сервера
+    restored = restore_voice_sessions(shard_id)
+    log.info("✅ Шард %s готов, восстановлено %s голосовых сессий", shard_id, restored)
+
+async def shutdown():
+    """Корректная остановка: фоновые задачи, несохраненный голосовой XP, пул БД"""
+    global metrics_runner
     
-    print(f"✅ Восстановлено {len(voice_sessions)} голосовых сессий")
+    for task in (voice_xp_task, reconcile_xp_task, xp_history_task, rank_refresh_task):
+        if task.is_running():
+            task.cancel()
     
-    try:
-        synced = await bot.tree.sync()
-        print(f'✅ Синхронизировано {len(synced)} команд')
-    except Exception as e:
-        print(f'⛔ Ошибка синхронизации команд: {e}')
+    for job in list(purge_jobs.values()):
+        job.cancelled = True
     
-    voice_xp_task.start()
-    print('✅ Фоновая задача голосового XP запущена')
+    if db.db_pool is not None:
+        flushed = 0
+        for user_id, xp_data in list(voice_xp_cache.items()):
+            if xp_data['pending_xp'] > 0:
+                await add_xp(user_id, xp_data['pending_xp'], 'voice')
+                xp_data['pending_xp'] = 0
+                flushed += 1
+        log.info("💾 Сохранен накопленный голосовой XP: %s пользователей", flushed)
+        
+        # Воркер дописывает свои пачки, получив EOF
+        if worker_client is not None:
+            await worker_client.close()
+        
+        await reconcile_xp_deltas()
+        if pending_xp_deltas:
+            log.error("⛔ БД недоступна, потерян отложенный опыт %s пользователей", len(pending_xp_deltas))
+        await flush_xp_history()
+        
+        await close_database()
+    
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    
+    if card_executor is not None:
+        card_executor.shutdown(wait=False, cancel_futures=True)
+    
+    log.info("👋 Бот остановлен")
 
 # Обработка сообщений
 @bot.event
@@ -871,11 +1958,11 @@ async def on_message(message):
     try:
         xp = random.randint(CONFIG['TEXT_XP_MIN'], CONFIG['TEXT_XP_MAX'])
         await add_xp(user_id, xp, 'text', message.guild)
-        print(f"💬 Сообщение от {message.author.name}: +{xp} XP")
+        log.debug("💬 Сообщение от %s: +%s XP", message.author.name, xp)
         
         cooldowns[user_id] = current_time
     except Exception as e:
-        print(f"⛔ Ошибка начисления XP за сообщение: {e}")
+        log.error("⛔ Ошибка начисления XP за сообщение: %s", e)
     
     await bot.process_commands(message)
 
@@ -905,7 +1992,7 @@ async def on_voice_state_update(member, before, after):
             'last_xp_time': current_time,
             'pending_xp': 0
         }
-        print(f"🎤 {member.name} вошел в голосовой канал: {after.channel.name}")
+        log.debug("🎤 %s вошел в голосовой канал: %s", member.name, after.channel.name)
         
         await log_action(
             member.guild,
@@ -927,7 +2014,7 @@ async def on_voice_state_update(member, before, after):
                 pending_xp = voice_xp_cache[user_id]['pending_xp']
                 if pending_xp > 0:
                     await add_xp(user_id, pending_xp, 'voice', member.guild)
-                    print(f"🎤 {member.name} вышел: +{pending_xp} XP за {session_minutes} минут в голосовом")
+                    log.debug("🎤 %s вышел: +%s XP за %s минут в голосовом", member.name, pending_xp, session_minutes)
                 
                 del voice_xp_cache[user_id]
             
@@ -953,7 +2040,7 @@ async def on_voice_state_update(member, before, after):
                 pending_xp = voice_xp_cache[user_id]['pending_xp']
                 if pending_xp > 0:
                     await add_xp(user_id, pending_xp, 'voice', member.guild)
-                    print(f"🎤 {member.name} перешел: +{pending_xp} XP за {session_minutes} минут")
+                    log.debug("🎤 %s перешел: +%s XP за %s минут", member.name, pending_xp, session_minutes)
             
             # Начинаем новую сессию в новом канале
             voice_sessions[user_id] = {
@@ -982,14 +2069,14 @@ async def on_voice_state_update(member, before, after):
            (before.self_deaf != after.self_deaf and after.self_deaf):
             if user_id in voice_xp_cache:
                 voice_xp_cache[user_id]['last_xp_time'] = current_time  # Сбрасываем таймер
-                print(f"🎤 {member.name} заглушил себя - XP приостановлен")
+                log.debug("🎤 %s заглушил себя - XP приостановлен", member.name)
         
         # Если пользователь размутился - возобновляем начисление XP
         elif (before.self_mute != after.self_mute and not after.self_mute) or \
              (before.self_deaf != after.self_deaf and not after.self_deaf):
             if user_id in voice_xp_cache:
                 voice_xp_cache[user_id]['last_xp_time'] = current_time  # Возобновляем таймер
-                print(f"🎤 {member.name} размутился - XP возобновлен")
+                log.debug("🎤 %s размутился - XP возобновлен", member.name)
 
 @tasks.loop(minutes=1)
 async def voice_xp_task():
@@ -1010,6 +2097,10 @@ async def voice_xp_task():
                 guild = bot.get_guild(session_data['guild_id'])
                 if not guild:
                     continue
+                
+                # Шард сервера переподключается - участники могут временно не находиться, сессию не трогаем
+                if not shard_connected(guild.shard_id):
+                    continue
                     
                 member = guild.get_member(int(user_id))
                 if not member or not member.voice or not member.voice.channel:
@@ -1023,7 +2114,7 @@ async def voice_xp_task():
                 # Проверяем, что пользователь не заглушен
                 if member.voice.self_mute or member.voice.self_deaf or member.voice.mute or member.voice.deaf:
                     # Пропускаем начисление, но не сбрасываем таймер
-                    print(f"🎤 {member.name} заглушен - пропускаем XP")
+                    log.debug("🎤 %s заглушен - пропускаем XP", member.name)
                     continue
                 
                 # Начисляем XP за минуту
@@ -1034,21 +2125,30 @@ async def voice_xp_task():
                 # Накопленный опыт (начисляем каждые 5 минут или при выходе)
                 if xp_data['pending_xp'] >= CONFIG['VOICE_XP_PER_MINUTE'] * 5:
                     await add_xp(user_id, xp_data['pending_xp'], 'voice', guild)
-                    print(f"🎤 Фоновая XP для {member.name}: +{xp_data['pending_xp']} XP")
+                    log.debug("🎤 Фоновая XP для %s: +%s XP", member.name, xp_data['pending_xp'])
                     xp_data['pending_xp'] = 0
                 
         except Exception as e:
-            print(f"⛔ Ошибка в voice_xp_task для {user_id}: {e}")
+            log.error("⛔ Ошибка в voice_xp_task для %s: %s", user_id, e)
             # Очищаем проблемные сессии
             if user_id in voice_sessions:
                 del voice_sessions[user_id]
             if user_id in voice_xp_cache:
                 del voice_xp_cache[user_id]
 
+@voice_xp_task.before_loop
+async def before_voice_xp_task():
+    # Задача стартует в setup_hook, до подключения к гейтвею
+    await bot.wait_until_ready()
+
 # ========== ПОЛНАЯ СИСТЕМА ЛОГИРОВАНИЯ ==========
 
 @bot.event
 async def on_member_join(member):
+    member_resolver.forget(member.guild.id, member.id)  # Мог быть в кэше как "не участник"
+    if track_join(member):
+        return
+    
     account_age = (datetime.now().replace(tzinfo=None) - member.created_at.replace(tzinfo=None)).days
     await log_action(
         member.guild,
@@ -1060,6 +2160,9 @@ async def on_member_join(member):
 
 @bot.event
 async def on_member_remove(member):
+    member_resolver.forget(member.guild.id, member.id)
+    if member_logs_suppressed(member.guild.id, member.id):
+        return
     await log_action(
         member.guild,
         "🚪 Участник покинул",
@@ -1070,6 +2173,8 @@ async def on_member_remove(member):
 
 @bot.event
 async def on_member_ban(guild, user):
+    if member_logs_suppressed(guild.id, user.id):
+        return
     moderator, reason = await get_audit_log_info(guild, discord.AuditLogAction.ban, user)
     await log_action(
         guild,
@@ -1096,76 +2201,26 @@ async def on_member_unban(guild, user):
 
 @bot.event
 async def on_member_update(before, after):
+    if before.display_name != after.display_name or before.display_avatar != after.display_avatar:
+        member_resolver.forget(after.guild.id, after.id)
+    
+    # Изменения копятся и уходят одним логом (см. queue_change)
     if before.roles != after.roles:
-        added_roles = [role for role in after.roles if role not in before.roles]
-        removed_roles = [role for role in before.roles if role not in after.roles]
-        
-        for role in added_roles:
-            moderator, reason = await find_moderator_for_role_change(after.guild, after, role, is_add=True)
-            await log_action(
-                after.guild,
-                "✅ Роль выдана",
-                f"**Роль:** {role.mention}",
-                COLORS['SUCCESS'],
-                target=after,
-                moderator=moderator,
-                reason=reason,
-                extra_fields={"🎭 Роль": f"{role.mention} (`{role.name}`)"}
-            )
-        
-        for role in removed_roles:
-            moderator, reason = await find_moderator_for_role_change(after.guild, after, role, is_add=False)
-            await log_action(
-                after.guild,
-                "⛔ Роль изъята",
-                f"**Роль:** {role.mention}",
-                COLORS['ERROR'],
-                target=after,
-                moderator=moderator,
-                reason=reason,
-                extra_fields={"🎭 Роль": f"{role.mention} (`{role.name}`)"}
-            )
+        queue_change(after.guild, 'member', after, 'roles', before.roles, after.roles)
     
     if before.nick != after.nick:
-        moderator, reason = await get_audit_log_info(after.guild, discord.AuditLogAction.member_update, after)
-        await log_action(
-            after.guild,
-            "📝 Изменен никнейм",
-            f"**Был:** `{before.nick or before.display_name}`\n**Стал:** `{after.nick or after.display_name}`",
-            COLORS['UPDATE'],
-            target=after,
-            moderator=moderator,
-            reason=reason
+        queue_change(
+            after.guild, 'member', after, 'nick',
+            before.nick or before.display_name, after.nick or after.display_name
         )
     
-    if before.timed_out_until != after.timed_out_until:
-        moderator, reason = await get_audit_log_info(after.guild, discord.AuditLogAction.member_update, after)
-        if after.timed_out_until:
-            duration = (after.timed_out_until - datetime.now().astimezone()).total_seconds() / 60
-            await log_action(
-                after.guild,
-                "⏰ Таймаут участника",
-                f"**Длительность:** `{duration:.1f}` минут",
-                COLORS['WARNING'],
-                target=after,
-                moderator=moderator,
-                reason=reason
-            )
-        else:
-            await log_action(
-                after.guild,
-                "🔊 Снятие таймаута",
-                f"**Таймаут досрочно снят**",
-                COLORS['SUCCESS'],
-                target=after,
-                moderator=moderator,
-                reason=reason
-            )
+    if before.timed_out_until != after.timed_out_until and not member_logs_suppressed(after.guild.id, after.id):
+        queue_change(after.guild, 'member', after, 'timed_out_until', before.timed_out_until, after.timed_out_until)
 
 @bot.event
 async def on_raw_message_delete(payload):
     # Проверяем, было ли удалено сообщение в гильдии
-    if not payload.guild_id:
+    if not payload.guild_id or payload.message_id in purge_deleted_ids:
         return
     
     guild = bot.get_guild(payload.guild_id)
@@ -1230,7 +2285,7 @@ async def on_raw_message_delete(payload):
 # Оставляем старую функцию для обычных сообщений
 @bot.event
 async def on_message_delete(message):
-    if message.author.bot or not message.guild:
+    if message.author.bot or not message.guild or message.id in purge_deleted_ids:
         return
     
     content = message.content or "*Сообщение без текста*"
@@ -1245,7 +2300,7 @@ async def on_message_delete(message):
     )
     
     # Логируем информацию для отладки
-    print(f"🔍 Удаление сообщения: автор={message.author}, найден модератор={moderator}, разница времени={time_diff:.1f}с")
+    log.debug("🔍 Удаление сообщения: автор=%s, найден модератор=%s, разница времени=%.1fс", message.author, moderator, time_diff)
     
     # Если нашли модератора и это не автор сообщения
     if moderator and moderator.id != message.author.id:
@@ -1291,11 +2346,12 @@ async def on_message_edit(before, after):
             extra_fields={"💬 Канал": before.channel.mention}
         )
     except Exception as e:
-        print(f"Ошибка логирования редактирования: {e}")
+        log.error("Ошибка логирования редактирования: %s", e)
         
 @bot.event
 async def on_raw_bulk_message_delete(payload):
-    if not payload.guild_id:
+    # Пачки задания очистки - в логе одна итоговая запись
+    if not payload.guild_id or all(message_id in purge_deleted_ids for message_id in payload.message_ids):
         return
     
     guild = bot.get_guild(payload.guild_id)
@@ -1332,7 +2388,7 @@ async def on_raw_bulk_message_delete(payload):
 
 @bot.event
 async def on_bulk_message_delete(messages):
-    if not messages:
+    if not messages or all(message.id in purge_deleted_ids for message in messages):
         return
     
     guild = messages[0].guild
@@ -1410,31 +2466,17 @@ async def on_guild_channel_delete(channel):
 
 @bot.event
 async def on_guild_channel_update(before, after):
-    changes = []
-    
     if before.name != after.name:
-        changes.append(f"**Название:** `{before.name}` → `{after.name}`")
+        queue_change(after.guild, 'channel', after, 'name', before.name, after.name)
     
     if before.position != after.position:
-        changes.append(f"**Позиция:** `{before.position}` → `{after.position}`")
+        queue_change(after.guild, 'channel', after, 'position', before.position, after.position)
     
     if hasattr(before, 'topic') and hasattr(after, 'topic') and before.topic != after.topic:
-        changes.append(f"**Топик:** `{before.topic or 'Нет'}` → `{after.topic or 'Нет'}`")
+        queue_change(after.guild, 'channel', after, 'topic', before.topic, after.topic)
     
     if hasattr(before, 'slowmode_delay') and hasattr(after, 'slowmode_delay') and before.slowmode_delay != after.slowmode_delay:
-        changes.append(f"**Слоумод:** `{before.slowmode_delay}`с → `{after.slowmode_delay}`с")
-    
-    if changes:
-        moderator, reason = await get_audit_log_info(after.guild, discord.AuditLogAction.channel_update)
-        await log_action(
-            after.guild,
-            "⚙️ Обновление канала",
-            "\n".join(changes),
-            COLORS['UPDATE'],
-            moderator=moderator,
-            reason=reason,
-            extra_fields={"📺 Канал": f"{after.mention} (`{after.name}`)"}
-        )
+        queue_change(after.guild, 'channel', after, 'slowmode_delay', before.slowmode_delay, after.slowmode_delay)
 
 @bot.event
 async def on_guild_role_create(role):
@@ -1478,37 +2520,17 @@ async def on_guild_role_delete(role):
 
 @bot.event
 async def on_guild_role_update(before, after):
-    changes = []
-    
     if before.name != after.name:
-        changes.append(f"**Название:** `{before.name}` → `{after.name}`")
+        queue_change(after.guild, 'role', after, 'name', before.name, after.name)
     
     if before.color != after.color:
-        changes.append(f"**Цвет:** `{before.color}` → `{after.color}`")
+        queue_change(after.guild, 'role', after, 'color', str(before.color), str(after.color))
     
     if before.position != after.position:
-        changes.append(f"**Позиция:** `{before.position}` → `{after.position}`")
+        queue_change(after.guild, 'role', after, 'position', before.position, after.position)
     
     if before.permissions != after.permissions:
-        changed_perms = []
-        for perm, value in after.permissions:
-            if getattr(before.permissions, perm) != value:
-                changed_perms.append(f"{'✅' if value else '⛔'} {perm}")
-        
-        if changed_perms:
-            changes.append("**Права:**\n" + "\n".join(changed_perms[:5]))
-    
-    if changes:
-        moderator, reason = await get_audit_log_info(after.guild, discord.AuditLogAction.role_update)
-        await log_action(
-            after.guild,
-            "⚙️ Обновление роли",
-            "\n".join(changes),
-            COLORS['UPDATE'],
-            moderator=moderator,
-            reason=reason,
-            extra_fields={"🎭 Роль": f"{after.mention} (`{after.name}`)"}
-        )
+        queue_change(after.guild, 'role', after, 'permissions', before.permissions, after.permissions)
 
 @bot.event
 async def on_guild_update(before, after):
@@ -1575,79 +2597,679 @@ async def on_webhooks_update(channel):
         extra_fields={"💬 Канал": channel.mention}
     )
 
-# Улучшенная функция логирования
-# Логирование действий
-async def log_action(guild, action, description, color=COLORS['INFO'], target=None, moderator=None, reason=None, extra_fields=None):
+# Улучшенная функция логирования
+# Логирование действий
+async def log_action(guild, action, description, color=COLORS['INFO'], target=None, moderator=None, reason=None, extra_fields=None):
+    try:
+        if worker_client:
+            worker_client.send(
+                'audit',
+                guild_id=guild.id,
+                action=action,
+                description=description,
+                target_id=target.id if target else None,
+                moderator_id=moderator.id if moderator else None,
+                reason=reason,
+                created_at=time.time()
+            )
+        
+        log_channel_id = await get_log_channel(guild.id)  # БЫЛО: get_log_channel(guild.id) БЕЗ await
+        if not log_channel_id:
+            return
+        
+        channel = bot.get_channel(int(log_channel_id))
+        if not channel:
+            return
+        
+        embed = discord.Embed(
+            title=f"📝 {action}",
+            description=description,
+            color=color,
+            timestamp=datetime.now()
+        )
+        
+        if target:
+            embed.add_field(
+                name="```🎯 Объект действия```",
+                value=f"{target.mention} (ID: {target.id})\nИмя: {target.name}",
+                inline=True
+            )
+        
+        if moderator:
+            embed.add_field(
+                name="```👑 Исполнитель```",
+                value=f"{moderator.mention} (ID: {moderator.id})\nИмя: {moderator.name}", 
+                inline=True
+            )
+        
+        if reason and reason != "Не указана":
+            embed.add_field(name="📋 Причина", value=reason, inline=False)
+        
+        if extra_fields:
+            for field_name, field_value in extra_fields.items():
+                embed.add_field(name=field_name, value=field_value, inline=False)
+        
+        embed.set_footer(text=f"ID: {target.id if target else 'DEMON'}")
+        
+        await asyncio.sleep(0.5)
+        with metrics.timer('discord_send_seconds', kind='log'):
+            await channel.send(embed=embed)
+        
+    except Exception as e:
+        log.error("Ошибка логирования: %s", e)
+
+# ========== ОЧИСТКА СООБЩЕНИЙ ==========
+# История канала читается потоком (страницы по 100, от новых к старым), подходящие
+# сообщения младше 14 дней удаляются bulk delete пачками по 100, старше - по одному
+# с паузой. Задание идет в фоне, прогресс обновляется в ответе команды.
+# Удаленные заданием сообщения не логируются по одному - в конце одна запись в лог.
+
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)  # С запасом до лимита Discord
+BULK_DELETE_CHUNK = 100
+
+purge_jobs = {}  # {channel_id: PurgeJob} - не больше одного задания на канал
+purge_deleted_ids = OrderedDict()  # id сообщений, удаленных очисткой (события удаления по ним пропускаются)
+
+def suppress_delete_logs(messages):
+    for message in messages:
+        lru_put(purge_deleted_ids, message.id, True, 20000)
+
+class PurgeJob:
+    """Фоновая очистка канала с фильтром check(message) -> bool"""
+    
+    def __init__(self, channel, moderator, limit, check, filters, after=None, before=None):
+        self.channel = channel
+        self.moderator = moderator
+        self.limit = limit
+        self.check = check
+        self.filters = filters  # Описание фильтров для отчета
+        self.after = after
+        self.before = before
+        self.scanned = 0
+        self.deleted = 0
+        self.failed = 0
+        self.cancelled = False
+        self.finished = False
+        self.error = None
+        self.started = time.monotonic()
+        self.task = None
+    
+    async def delete_bulk(self, messages):
+        suppress_delete_logs(messages)
+        try:
+            await self.channel.delete_messages(messages, reason=f"Очистка: {self.moderator}")
+            self.deleted += len(messages)
+        except discord.HTTPException as e:
+            log.warning("⚠️ Очистка %s: пачка из %s не удалена: %s", self.channel.id, len(messages), e)
+            self.failed += len(messages)
+    
+    async def delete_single(self, message):
+        suppress_delete_logs([message])
+        try:
+            await message.delete()
+            self.deleted += 1
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:
+            log.warning("⚠️ Очистка %s: сообщение %s не удалено: %s", self.channel.id, message.id, e)
+            self.failed += 1
+        await asyncio.sleep(CONFIG['PURGE_SINGLE_DELETE_INTERVAL'])
+    
+    async def run(self):
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        batch = []
+        matched = 0
+        try:
+            async for message in self.channel.history(
+                limit=CONFIG['PURGE_MAX_SCAN'], before=self.before, after=self.after, oldest_first=False
+            ):
+                if self.cancelled:
+                    break
+                self.scanned += 1
+                if message.pinned or not self.check(message):
+                    continue
+                
+                matched += 1
+                if message.created_at >= cutoff:
+                    batch.append(message)
+                    if len(batch) == BULK_DELETE_CHUNK:
+                        await self.delete_bulk(batch)
+                        batch = []
+                else:
+                    # Дальше от новых к старым - только старые сообщения
+                    if batch:
+                        await self.delete_bulk(batch)
+                        batch = []
+                    await self.delete_single(message)
+                
+                if matched >= self.limit:
+                    break
+            
+            if batch and not self.cancelled:
+                await self.delete_bulk(batch)
+        except discord.HTTPException as e:
+            self.error = str(e)
+            log.error("⛔ Очистка %s прервана: %s", self.channel.id, e)
+        finally:
+            self.finished = True
+    
+    def status_embed(self):
+        if not self.finished:
+            state, color = "⏳ Выполняется", COLORS['INFO']
+        elif self.error:
+            state, color = f"⛔ Ошибка: {self.error[:200]}", COLORS['ERROR']
+        elif self.cancelled:
+            state, color = "⏹️ Остановлено", COLORS['WARNING']
+        else:
+            state, color = "✅ Завершено", COLORS['SUCCESS']
+        
+        embed = discord.Embed(
+            title="🧹 Очистка сообщений",
+            description=f"{state}\n\n"
+                        f"**Канал:** {self.channel.mention}\n"
+                        f"**Удалено:** `{self.deleted}` из `{self.limit}`\n"
+                        f"**Просмотрено:** `{self.scanned}`"
+                        + (f"\n**Не удалось удалить:** `{self.failed}`" if self.failed else ""),
+            color=color,
+            timestamp=datetime.now()
+        )
+        if self.filters:
+            embed.add_field(name="🔎 Фильтры", value="\n".join(self.filters), inline=False)
+        embed.add_field(name="👑 Исполнитель", value=self.moderator.mention, inline=True)
+        embed.add_field(name="⏱️ Время", value=f"`{time.monotonic() - self.started:.0f}` с", inline=True)
+        return embed
+
+async def run_purge_job(job, progress_message, view):
+    """Задание очистки с периодическим обновлением прогресса и итоговой записью в лог"""
+    runner = asyncio.create_task(job.run())
+    try:
+        while not runner.done():
+            await asyncio.wait({runner}, timeout=CONFIG['PURGE_PROGRESS_INTERVAL'])
+            try:
+                await progress_message.edit(embed=job.status_embed(), view=None if runner.done() else view)
+            except discord.HTTPException:
+                pass  # Токен ответа живет 15 минут - дальше задание идет без прогресса
+    finally:
+        if not runner.done():
+            job.cancelled = True
+            runner.cancel()
+        purge_jobs.pop(job.channel.id, None)
+        metrics.inc('purge_deleted_total', job.deleted)
+    
+    await log_action(
+        job.channel.guild,
+        "🧹 Очистка сообщений",
+        f"**Канал:** {job.channel.mention}\n**Удалено:** `{job.deleted}`\n**Просмотрено:** `{job.scanned}`"
+        + ("\n**Остановлено досрочно**" if job.cancelled else ""),
+        COLORS['DELETE'],
+        moderator=job.moderator,
+        extra_fields={"🔎 Фильтры": "\n".join(job.filters) or "нет"}
+    )
+
+# ========== МАССОВАЯ МОДЕРАЦИЯ ==========
+# Бан, кик или таймаут сразу списка участников: баны - одним bulk ban на 200 человек,
+# кики и таймауты - параллельно не больше BATCH_CONCURRENCY запросов. События бана,
+# выхода и таймаута по этим участникам не логируются по одному - в лог уходит одна
+# итоговая запись на всю пачку, без поиска в журнале аудита.
+
+BATCH_ACTIONS = {
+    'ban': {'name': "Бан", 'emoji': "🔨", 'permission': 'ban_members', 'color': 'BAN'},
+    'kick': {'name': "Кик", 'emoji': "👢", 'permission': 'kick_members', 'color': 'KICK'},
+    'timeout': {'name': "Таймаут", 'emoji': "⏰", 'permission': 'moderate_members', 'color': 'WARNING'}
+}
+MEMBER_LOG_SUPPRESS_SECONDS = 60  # Сколько ждать событий гейтвея по участникам пачки
+
+member_logs_suppressed_until = OrderedDict()  # {(guild_id, user_id): monotonic-время окончания}
+
+def suppress_member_logs(guild_id, user_ids):
+    until = time.monotonic() + MEMBER_LOG_SUPPRESS_SECONDS
+    for user_id in user_ids:
+        lru_put(member_logs_suppressed_until, (guild_id, user_id), until, 20000)
+
+def unsuppress_member_logs(guild_id, user_ids):
+    """Действие не выполнено - настоящие события этих участников снова логируются"""
+    for user_id in user_ids:
+        member_logs_suppressed_until.pop((guild_id, user_id), None)
+
+def member_logs_suppressed(guild_id, user_id):
+    until = member_logs_suppressed_until.get((guild_id, user_id))
+    return until is not None and until > time.monotonic()
+
+def parse_user_ids(text):
+    """ID пользователей из упоминаний и чисел в строке"""
+    return [int(match) for match in re.findall(r'\d{15,20}', text or '')]
+
+async def collect_batch_targets(guild, moderator, action, user_ids=(), role=None, joined_minutes=None):
+    """Цели массового действия (объединение списка, роли и недавно зашедших) и число пропущенных"""
+    # Кэш участников неполный (MEMBER_CACHE=voice, CHUNK_GUILDS=0) - разовая загрузка с шлюза без сохранения
+    members = guild.members if guild.chunked else await guild.chunk(cache=False)
+    by_id = {member.id: member for member in members}
+    
+    candidates = {}
+    for user_id in user_ids:
+        # Забанить можно и того, кто уже вышел с сервера
+        member = by_id.get(user_id)
+        if member or action == 'ban':
+            candidates[user_id] = member or discord.Object(id=user_id)
+    if role:
+        for member in members:
+            if member.get_role(role.id):
+                candidates[member.id] = member
+    if joined_minutes:
+        since = discord.utils.utcnow() - timedelta(minutes=joined_minutes)
+        for member in members:
+            if member.joined_at and member.joined_at >= since:
+                candidates[member.id] = member
+    
+    targets = []
+    skipped = 0
+    for user_id, target in candidates.items():
+        if user_id in (moderator.id, bot.user.id, guild.owner_id):
+            skipped += 1
+            continue
+        # Иерархия ролей: не трогаем равных и старших модератору и боту
+        if isinstance(target, discord.Member) and (
+            (target.top_role >= moderator.top_role and moderator.id != guild.owner_id)
+            or target.top_role >= guild.me.top_role
+        ):
+            skipped += 1
+            continue
+        targets.append(target)
+    return targets, skipped
+
+async def run_batch_moderation(guild, action, targets, reason, duration=None, delete_days=0):
+    """
+    Выполнить действие над пачкой: (успешные цели, [(цель, ошибка)])
+    Логи участников глушатся перед каждым запросом (событие шлюза может прийти раньше ответа)
+    и снимаются с тех, для кого действие не удалось
+    """
+    done, failed = [], []
+    pending = list(targets)
+    
+    if action == 'ban':
+        pending = []
+        for start in range(0, len(targets), 200):
+            chunk = targets[start:start + 200]
+            suppress_member_logs(guild.id, [target.id for target in chunk])
+            try:
+                result = await guild.bulk_ban(chunk, reason=reason, delete_message_seconds=delete_days * 86400)
+            except discord.HTTPException as e:
+                # Нет прав на bulk ban (нужен еще manage_guild) - баним по одному
+                log.warning("⚠️ Bulk ban не выполнен (%s), баним по одному", e)
+                unsuppress_member_logs(guild.id, [target.id for target in chunk])
+                pending += chunk
+                continue
+            banned = {user.id for user in result.banned}
+            done += [target for target in chunk if target.id in banned]
+            failed += [(target, "не забанен") for target in chunk if target.id not in banned]
+            unsuppress_member_logs(guild.id, [target.id for target in chunk if target.id not in banned])
+    
+    semaphore = asyncio.Semaphore(CONFIG['BATCH_CONCURRENCY'])
+    
+    async def apply(target):
+        async with semaphore:
+            suppress_member_logs(guild.id, [target.id])
+            try:
+                if action == 'ban':
+                    await guild.ban(target, reason=reason, delete_message_seconds=delete_days * 86400)
+                elif action == 'kick':
+                    await target.kick(reason=reason)
+                else:
+                    await target.timeout(duration, reason=reason)
+                return target, None
+            except discord.HTTPException as e:
+                unsuppress_member_logs(guild.id, [target.id])
+                return target, str(e)
+    
+    for target, error in await asyncio.gather(*(apply(target) for target in pending)):
+        if error:
+            failed.append((target, error))
+        else:
+            done.append(target)
+    
+    metrics.inc('batch_moderation_total', len(done), action=action)
+    return done, failed
+
+def format_targets(targets, limit=30):
+    text = ", ".join(f"<@{target.id}>" for target in targets[:limit])
+    if len(targets) > limit:
+        text += f" *... и еще {len(targets) - limit}*"
+    return text or "—"
+
+# ========== ДЕТЕКТОР РЕЙДОВ ==========
+# На каждый сервер - окно последних входов за RAID_WINDOW_SECONDS со счетчиками:
+# всего входов, свежих аккаунтов и входов на каждый "скелет" имени (без цифр и
+# знаков, в нижнем регистре). Вход добавляется в окно, устаревшие выталкиваются -
+# O(1) на вход амортизированно. При превышении порога сервер переходит в режим
+# рейда: входы не логируются по одному, а собираются в одно обновляемое оповещение.
+
+RAID_UPDATE_INTERVAL = 5  # Период обновления оповещения и применения таймаутов
+
+join_detectors = {}  # {guild_id: JoinRateDetector}
+join_detectors_state = {'pruned_at': 0.0}
+
+def name_skeleton(name):
+    """Имя без цифр, знаков и регистра: raider123 и Raider_77 - одно и то же (короче 3 букв - не учитываем)"""
+    skeleton = re.sub(r'[\W\d_]+', '', unicodedata.normalize('NFKC', name).casefold())
+    return skeleton if len(skeleton) >= 3 else ''
+
+class RaidState:
+    """Текущий рейд на сервере: участники и одно сводное оповещение"""
+    
+    def __init__(self, reasons, members):
+        self.reasons = reasons
+        self.members = list(members)
+        self.young = 0
+        self.started = time.monotonic()
+        self.last_join = self.started
+        self.timed_out = 0  # Сколько участников из members уже обработано авто-таймаутом
+        self.alert_message = None
+        self.previous_verification = None
+        self.finished = False
+        self.dirty = True
+        self.task = None
+
+class JoinRateDetector:
+    """Скользящее окно входов одного сервера"""
+    
+    def __init__(self):
+        self.events = deque()  # (monotonic-время, скелет имени, свежий аккаунт, участник)
+        self.young = 0
+        self.names = defaultdict(int)
+        self.raid = None
+    
+    def add(self, member, now):
+        """Учесть вход; возвращает список сработавших порогов (пустой - все спокойно)"""
+        while self.events and self.events[0][0] <= now - CONFIG['RAID_WINDOW_SECONDS']:
+            _, name, young, _ = self.events.popleft()
+            self.young -= young
+            if name:
+                self.names[name] -= 1
+                if not self.names[name]:
+                    del self.names[name]
+        
+        name = name_skeleton(member.name)
+        young = discord.utils.utcnow() - member.created_at < timedelta(days=CONFIG['RAID_ACCOUNT_AGE_DAYS'])
+        self.events.append((now, name, young, member))
+        self.young += young
+        if name:
+            self.names[name] += 1
+        
+        reasons = []
+        if len(self.events) >= CONFIG['RAID_JOIN_THRESHOLD']:
+            reasons.append(f"`{len(self.events)}` входов за {CONFIG['RAID_WINDOW_SECONDS']}с")
+        if self.young >= CONFIG['RAID_YOUNG_THRESHOLD']:
+            reasons.append(f"`{self.young}` аккаунтов моложе {CONFIG['RAID_ACCOUNT_AGE_DAYS']} дн.")
+        if name and self.names[name] >= CONFIG['RAID_SIMILAR_THRESHOLD']:
+            reasons.append(f"`{self.names[name]}` похожих имен (`{name}`)")
+        return reasons
+    
+    def idle(self, now):
+        """Окно пусто и рейда нет - детектор можно удалить"""
+        return self.raid is None and (not self.events or self.events[-1][0] <= now - CONFIG['RAID_WINDOW_SECONDS'])
+
+def prune_join_detectors(now):
+    """Раз в окно удаляем детекторы серверов без недавних входов, чтобы словарь не рос бесконечно"""
+    if now - join_detectors_state['pruned_at'] < CONFIG['RAID_WINDOW_SECONDS']:
+        return
+    join_detectors_state['pruned_at'] = now
+    for guild_id in [guild_id for guild_id, detector in join_detectors.items() if detector.idle(now)]:
+        del join_detectors[guild_id]
+
+def raid_alert_embed(guild, raid):
+    duration = time.monotonic() - raid.started
+    embed = discord.Embed(
+        title="✅ Рейд завершен" if raid.finished else "🚨 Обнаружен рейд",
+        description="\n".join(f"• {reason}" for reason in raid.reasons),
+        color=COLORS['WARNING'] if raid.finished else COLORS['ERROR'],
+        timestamp=datetime.now()
+    )
+    embed.add_field(name="👥 Входов", value=f"`{len(raid.members)}`", inline=True)
+    embed.add_field(name="🐣 Свежих аккаунтов", value=f"`{raid.young}`", inline=True)
+    embed.add_field(name="⏱️ Длительность", value=f"`{duration:.0f}` с", inline=True)
+    
+    actions = []
+    if CONFIG['RAID_AUTO_TIMEOUT']:
+        actions.append(f"⏰ Таймаут {CONFIG['RAID_TIMEOUT_MINUTES']} мин: `{raid.timed_out}`")
+    if raid.previous_verification is not None:
+        actions.append("🔒 Уровень проверки поднят" + (" (восстановлен)" if raid.finished else ""))
+    if actions:
+        embed.add_field(name="🛡️ Меры", value="\n".join(actions), inline=False)
+    
+    embed.add_field(name="🎯 Участники", value=format_targets(raid.members)[:1024], inline=False)
+    embed.set_footer(text=guild.name)
+    return embed
+
+async def update_raid(guild, raid):
+    """
+    Авто-таймаут новых участников рейда и обновление сводного оповещения
+    Ошибки только логируются: цикл raid_monitor не должен завершить рейд раньше времени
+    """
+    if CONFIG['RAID_AUTO_TIMEOUT'] and raid.timed_out < len(raid.members):
+        batch = raid.members[raid.timed_out:]
+        raid.timed_out = len(raid.members)
+        try:
+            await run_batch_moderation(
+                guild, 'timeout', batch, "Авто-таймаут: рейд",
+                duration=timedelta(minutes=CONFIG['RAID_TIMEOUT_MINUTES'])
+            )
+        except Exception as e:
+            log.error("⛔ Авто-таймаут рейда на %s не выполнен: %s", guild.id, e)
+        raid.dirty = True
+    
+    if not raid.dirty:
+        return
+    raid.dirty = False
+    
+    embed = raid_alert_embed(guild, raid)
     try:
-        log_channel_id = await get_log_channel(guild.id)  # БЫЛО: get_log_channel(guild.id) БЕЗ await
-        if not log_channel_id:
+        if raid.alert_message is not None:
+            await raid.alert_message.edit(embed=embed)
             return
-        
-        channel = bot.get_channel(int(log_channel_id))
-        if not channel:
-            return
-        
-        embed = discord.Embed(
-            title=f"📝 {action}",
-            description=description,
-            color=color,
-            timestamp=datetime.now()
-        )
-        
-        if target:
-            embed.add_field(
-                name="```🎯 Объект действия```",
-                value=f"{target.mention} (ID: {target.id})\nИмя: {target.name}",
-                inline=True
-            )
-        
-        if moderator:
-            embed.add_field(
-                name="```👑 Исполнитель```",
-                value=f"{moderator.mention} (ID: {moderator.id})\nИмя: {moderator.name}", 
-                inline=True
-            )
-        
-        if reason and reason != "Не указана":
-            embed.add_field(name="📋 Причина", value=reason, inline=False)
-        
-        if extra_fields:
-            for field_name, field_value in extra_fields.items():
-                embed.add_field(name=field_name, value=field_value, inline=False)
-        
-        embed.set_footer(text=f"ID: {target.id if target else 'DEMON'}")
-        
-        await asyncio.sleep(0.5)
-        await channel.send(embed=embed)
-        
+        log_channel_id = await get_log_channel(guild.id)
+        channel = bot.get_channel(int(log_channel_id)) if log_channel_id else None
+        if channel:
+            raid.alert_message = await channel.send(embed=embed)
     except Exception as e:
-        print(f"Ошибка логирования: {e}")
+        # В том числе DatabaseUnavailable из get_log_channel - попробуем при следующем обновлении
+        raid.dirty = True
+        log.warning("⚠️ Оповещение о рейде на %s не обновлено: %s", guild.id, e)
+
+async def set_lockdown(guild, raid, enabled):
+    try:
+        if enabled:
+            raid.previous_verification = guild.verification_level
+            await guild.edit(verification_level=discord.VerificationLevel.highest, reason="Рейд: авто-блокировка")
+        elif raid.previous_verification is not None:
+            await guild.edit(verification_level=raid.previous_verification, reason="Рейд завершен")
+    except discord.HTTPException as e:
+        log.warning("⚠️ Не удалось изменить уровень проверки %s: %s", guild.id, e)
+        if enabled:
+            raid.previous_verification = None
+
+async def raid_monitor(guild, detector):
+    """Жизненный цикл рейда: меры, обновления оповещения, завершение после тишины"""
+    raid = detector.raid
+    log.warning("🚨 Рейд на сервере %s (%s): %s", guild.name, guild.id, "; ".join(raid.reasons))
+    metrics.inc('raids_detected_total')
+    try:
+        if CONFIG['RAID_AUTO_LOCKDOWN']:
+            await set_lockdown(guild, raid, True)
+        while time.monotonic() - raid.last_join < CONFIG['RAID_COOLDOWN_SECONDS']:
+            await update_raid(guild, raid)
+            await asyncio.sleep(RAID_UPDATE_INTERVAL)
+    finally:
+        detector.raid = None
+        raid.finished = True
+        raid.dirty = True
+        if raid.previous_verification is not None:
+            await set_lockdown(guild, raid, False)
+        await update_raid(guild, raid)
+        log.info("✅ Рейд на %s завершен: %s входов", guild.id, len(raid.members))
+
+def track_join(member):
+    """Учесть вход; True - сервер в режиме рейда, отдельный лог входа не нужен"""
+    now = time.monotonic()
+    prune_join_detectors(now)
+    detector = join_detectors.setdefault(member.guild.id, JoinRateDetector())
+    reasons = detector.add(member, now)
+    young = detector.events[-1][2]
+    
+    raid = detector.raid
+    if raid is not None:
+        raid.members.append(member)
+        raid.young += young
+        raid.last_join = now
+        raid.dirty = True
+        metrics.inc('raid_joins_total')
+        return True
+    
+    if not reasons:
+        return False
+    
+    # Входы из окна, уже залогированные по одному, тоже попадают в рейд
+    detector.raid = raid = RaidState(reasons, (event[3] for event in detector.events))
+    raid.young = detector.young
+    raid.task = asyncio.create_task(raid_monitor(member.guild, detector))
+    return True
+
+# ========== ВЫПОЛНЕНИЕ КОМАНД ==========
+# Команды с запросами к БД оборачиваются guarded_command: токен-бакет на пользователя,
+# семафор на команду и авто-defer - если по скользящему среднему команда обычно
+# дольше COMMAND_DEFER_BUDGET, defer сразу, иначе по таймеру COMMAND_DEFER_AFTER.
+# Такие команды отвечают только через respond(): он сам выбирает send_message или followup.
+
+COMMAND_LATENCY_ALPHA = 0.2  # Вес последнего вызова в скользящем среднем длительности
+
+class RateLimiter:
+    """Токен-бакет на пользователя: burst команд подряд, дальше rate в секунду"""
+    
+    def __init__(self, rate, burst, max_users=50000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = OrderedDict()  # {user_id: (токены, время обновления)}
+    
+    def acquire(self, user_id, cost=1):
+        """0 - можно выполнять, иначе секунд до появления токена"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        
+        if tokens >= cost:
+            lru_put(self.buckets, user_id, (tokens - cost, now), self.max_users)
+            return 0
+        lru_put(self.buckets, user_id, (tokens, now), self.max_users)
+        return (cost - tokens) / self.rate
+
+user_rate_limiter = RateLimiter(CONFIG['USER_RATE_PER_MINUTE'] / 60, CONFIG['USER_RATE_BURST'])
+command_latency = {}  # {имя команды: скользящее среднее длительности, с}
+
+def respond_lock(interaction):
+    """Блокировка ответа на взаимодействие: defer по таймеру и ответ команды не пересекаются"""
+    return interaction.extras.setdefault('respond_lock', asyncio.Lock())
+
+async def defer_interaction(interaction, command_name):
+    async with respond_lock(interaction):
+        if interaction.response.is_done():
+            return
+        try:
+            await interaction.response.defer(thinking=True)
+            interaction.extras['deferred'] = True
+            metrics.inc('command_deferred_total', command=command_name)
+        except discord.HTTPException as e:
+            log.warning("⚠️ Не удалось отложить ответ на /%s: %s", command_name, e)
+
+async def defer_later(interaction, command_name, delay):
+    await asyncio.sleep(delay)
+    await defer_interaction(interaction, command_name)
+
+async def respond(interaction, content=None, *, ephemeral=False, **kwargs):
+    """Ответ на команду: первый ответ или followup, если ответ уже отложен"""
+    async with respond_lock(interaction):
+        if not interaction.response.is_done():
+            return await interaction.response.send_message(content, ephemeral=ephemeral, **kwargs)
+        
+        if ephemeral and interaction.extras.pop('deferred', False):
+            # Публичное "думает..." скрытым не сделать - убираем его и отвечаем отдельно
+            try:
+                await interaction.delete_original_response()
+            except discord.HTTPException:
+                pass
+        # followup не принимает view=None
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+        return await interaction.followup.send(content, ephemeral=ephemeral, **kwargs)
+
+def guarded_command(limit=None, cost=1):
+    """Лимиты и авто-defer для слеш-команды (ставится под @bot.tree.command и describe/choices)"""
+    def decorator(func):
+        name = func.__name__.removesuffix('_command')
+        semaphore = asyncio.Semaphore(limit or CONFIG['COMMAND_CONCURRENCY'])
+        
+        @functools.wraps(func)
+        async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+            retry_after = user_rate_limiter.acquire(interaction.user.id, cost)
+            if retry_after:
+                metrics.inc('command_rate_limited_total', command=name)
+                await respond(interaction, f"⏳ Слишком часто! Попробуйте через {max(1, round(retry_after))} с", ephemeral=True)
+                return
+            
+            start = time.perf_counter()
+            timer = None
+            if command_latency.get(name, 0) > CONFIG['COMMAND_DEFER_BUDGET']:
+                await defer_interaction(interaction, name)
+            else:
+                timer = asyncio.create_task(defer_later(interaction, name, CONFIG['COMMAND_DEFER_AFTER']))
+            
+            try:
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), CONFIG['COMMAND_QUEUE_TIMEOUT'])
+                except asyncio.TimeoutError:
+                    metrics.inc('command_rejected_total', command=name)
+                    await respond(interaction, "⏳ Бот перегружен, попробуйте чуть позже", ephemeral=True)
+                    return
+                
+                try:
+                    await func(interaction, *args, **kwargs)
+                finally:
+                    semaphore.release()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                elapsed = time.perf_counter() - start
+                previous = command_latency.get(name, elapsed)
+                command_latency[name] = previous + COMMAND_LATENCY_ALPHA * (elapsed - previous)
+                metrics.observe('command_duration_seconds', elapsed, command=name)
+        
+        return wrapper
+    return decorator
 
 # ========== КОМАНДЫ ==========
 
 @bot.tree.command(name="уровень", description="Показать вашу карточку с уровнем")
+@guarded_command()
 async def level_command(interaction: discord.Interaction):
     try:
-        data = await get_user_data(interaction.user.id)
+        data = await get_level_card_data(interaction.user.id)
+        if data is None:
+            await respond(interaction, DB_UNAVAILABLE_MESSAGE, ephemeral=True)
+            return
         
         # Проверяем доступен ли престиж
-        show_prestige_button = (
-            data.get('prestige', 0) < 3 and 
-            data['text_level'] >= 1000 and 
-            data['voice_level'] >= 1000
-        )
+        show_prestige_button = can_prestige(data)
         
         embed = create_level_embed(data, interaction.user, show_prestige_button=show_prestige_button)
+        files = await rank_card_files(embed, data, interaction.user)
         
         if show_prestige_button:
             view = PrestigeView(interaction.user.id)
-            await interaction.response.send_message(embed=embed, view=view)
+            await respond(interaction, embed=embed, view=view, files=files)
         else:
-            await interaction.response.send_message(embed=embed)
+            await respond(interaction, embed=embed, files=files)
             
     except Exception as e:
-        print(f"Ошибка в команде уровень: {e}")
-        await interaction.response.send_message("⛔ Произошла ошибка", ephemeral=True)
+        log.error("Ошибка в команде уровень: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
 
 class PrestigeView(discord.ui.View):
     def __init__(self, user_id):
@@ -1660,72 +3282,160 @@ class PrestigeView(discord.ui.View):
             await interaction.response.send_message("⛔ Эта кнопка не для вас!", ephemeral=True)
             return
         
+        # Запись в БД и рендер карточки могут не уложиться в 3 секунды на ответ
+        await interaction.response.defer()
         success, message = await prestige_up(self.user_id, interaction.guild)
         
         if success:
             # Обновляем embed
-            user_data = await get_user_data(self.user_id)
-            embed = create_level_embed(user_data, interaction.user)
-            await interaction.response.edit_message(embed=embed, view=None)
+            user_data = await get_level_card_data(self.user_id)
+            if user_data:
+                embed = create_level_embed(user_data, interaction.user)
+                files = await rank_card_files(embed, user_data, interaction.user)
+                await interaction.edit_original_response(embed=embed, attachments=files, view=None)
+            else:
+                await interaction.edit_original_response(view=None)
             
             # Отправляем отдельное сообщение с поздравлением
             await interaction.followup.send(f"🎉 {interaction.user.mention}, {message}", ephemeral=True)
         else:
-            await interaction.response.send_message(f"⛔ {message}", ephemeral=True)
+            await interaction.followup.send(f"⛔ {message}", ephemeral=True)
 
 @bot.tree.command(name="профиль", description="Посмотреть профиль пользователя")
 @app_commands.describe(пользователь="Выберите пользователя")
+@guarded_command()
 async def profile_command(interaction: discord.Interaction, пользователь: discord.Member = None):
     try:
         target = пользователь or interaction.user
-        data = await get_user_data(target.id)
+        data = await get_level_card_data(target.id)
+        if data is None:
+            await respond(interaction, DB_UNAVAILABLE_MESSAGE, ephemeral=True)
+            return
         
         # Проверяем доступен ли престиж
-        show_prestige_button = (
-            data.get('prestige', 0) < 3 and 
-            data['text_level'] >= 1000 and 
-            data['voice_level'] >= 1000 and
-            target.id == interaction.user.id  # Только владелец профиля может престижиться
-        )
+        # Только владелец профиля может престижиться
+        show_prestige_button = can_prestige(data) and target.id == interaction.user.id
         
         embed = create_level_embed(data, target, show_prestige_button=show_prestige_button)
+        files = await rank_card_files(embed, data, target)
         
         if show_prestige_button:
             view = PrestigeView(target.id)
-            await interaction.response.send_message(embed=embed, view=view)
+            await respond(interaction, embed=embed, view=view, files=files)
         else:
-            await interaction.response.send_message(embed=embed)
+            await respond(interaction, embed=embed, files=files)
             
     except Exception as e:
-        print(f"Ошибка в команде профиль: {e}")
-        await interaction.response.send_message("⛔ Произошла ошибка", ephemeral=True)
+        log.error("Ошибка в команде профиль: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
+
+class LeaderboardView(discord.ui.View):
+    """Листание топа: стек курсоров начала открытых страниц, назад - по уже известному курсору"""
+    def __init__(self, user_id, top_type, next_cursor):
+        super().__init__(timeout=180)
+        self.user_id = user_id
+        self.top_type = top_type
+        self.cursors = [None]  # Курсор начала каждой открытой страницы (None - первая)
+        self.next_cursor = next_cursor
+        self.update_buttons()
+    
+    def update_buttons(self):
+        self.prev_button.disabled = len(self.cursors) == 1
+        self.next_button.disabled = self.next_cursor is None
+    
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.user_id:
+            await interaction.response.send_message("⛔ Эти кнопки не для вас!", ephemeral=True)
+            return False
+        return True
+    
+    async def show_page(self, interaction: discord.Interaction):
+        # Страница не из кэша - запрос к БД и разрешение участников, отвечаем сразу
+        await interaction.response.defer()
+        embed, self.next_cursor = await create_leaderboard_embed(
+            interaction.guild, self.top_type, self.cursors[-1], len(self.cursors) - 1
+        )
+        self.update_buttons()
+        await interaction.edit_original_response(embed=embed, view=self)
+    
+    @discord.ui.button(label="Назад", style=discord.ButtonStyle.secondary, emoji="◀️")
+    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if len(self.cursors) > 1:
+            self.cursors.pop()
+        await self.show_page(interaction)
+    
+    @discord.ui.button(label="Вперед", style=discord.ButtonStyle.secondary, emoji="▶️")
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if self.next_cursor is not None:
+            self.cursors.append(self.next_cursor)
+        await self.show_page(interaction)
+
+async def send_leaderboard(interaction: discord.Interaction, top_type):
+    embed, next_cursor = await create_leaderboard_embed(interaction.guild, top_type)
+    if next_cursor is not None:
+        view = LeaderboardView(interaction.user.id, top_type, next_cursor)
+        await respond(interaction, embed=embed, view=view)
+    else:
+        await respond(interaction, embed=embed)
 
-@bot.tree.command(name="топ", description="Топ-10 игроков общий рейтинг")
+@bot.tree.command(name="топ", description="Общий рейтинг игроков")
+@guarded_command()
 async def top_command(interaction: discord.Interaction):
     try:
-        embed = await create_leaderboard_embed(interaction.guild, 'total')
-        await interaction.response.send_message(embed=embed)
+        await send_leaderboard(interaction, 'total')
     except Exception as e:
-        print(f"Ошибка в команде топ: {e}")
-        await interaction.response.send_message("⛔ Произошла ошибка", ephemeral=True)
+        log.error("Ошибка в команде топ: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
 
-@bot.tree.command(name="топ_текст", description="Топ-10 игроков по текстовому чату")
+@bot.tree.command(name="топ_текст", description="Рейтинг игроков по текстовому чату")
+@guarded_command()
 async def top_text_command(interaction: discord.Interaction):
     try:
-        embed = await create_leaderboard_embed(interaction.guild, 'text')
-        await interaction.response.send_message(embed=embed)
+        await send_leaderboard(interaction, 'text')
     except Exception as e:
-        print(f"Ошибка в команде топ_текст: {e}")
-        await interaction.response.send_message("⛔ Произошла ошибка", ephemeral=True)
+        log.error("Ошибка в команде топ_текст: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
 
-@bot.tree.command(name="топ_войс", description="Топ-10 игроков по голосовому чату")
+@bot.tree.command(name="топ_войс", description="Рейтинг игроков по голосовому чату")
+@guarded_command()
 async def top_voice_command(interaction: discord.Interaction):
     try:
-        embed = await create_leaderboard_embed(interaction.guild, 'voice')
-        await interaction.response.send_message(embed=embed)
+        await send_leaderboard(interaction, 'voice')
+    except Exception as e:
+        log.error("Ошибка в команде топ_войс: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
+
+@bot.tree.command(name="топ_неделя", description="Топ-10 сервера за эту неделю")
+@app_commands.describe(тип="Тип опыта")
+@app_commands.choices(тип=[
+    app_commands.Choice(name="Общий", value="total"),
+    app_commands.Choice(name="Текстовый", value="text"),
+    app_commands.Choice(name="Голосовой", value="voice"),
+])
+@guarded_command()
+async def top_week_command(interaction: discord.Interaction, тип: app_commands.Choice[str] = None):
+    try:
+        embed = await create_period_leaderboard_embed(interaction.guild, 'w', тип.value if тип else 'total')
+        await respond(interaction, embed=embed)
+    except Exception as e:
+        log.error("Ошибка в команде топ_неделя: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
+
+@bot.tree.command(name="топ_месяц", description="Топ-10 сервера за этот месяц")
+@app_commands.describe(тип="Тип опыта")
+@app_commands.choices(тип=[
+    app_commands.Choice(name="Общий", value="total"),
+    app_commands.Choice(name="Текстовый", value="text"),
+    app_commands.Choice(name="Голосовой", value="voice"),
+])
+@guarded_command()
+async def top_month_command(interaction: discord.Interaction, тип: app_commands.Choice[str] = None):
+    try:
+        embed = await create_period_leaderboard_embed(interaction.guild, 'm', тип.value if тип else 'total')
+        await respond(interaction, embed=embed)
     except Exception as e:
-        print(f"Ошибка в команде топ_войс: {e}")
-        await interaction.response.send_message("⛔ Произошла ошибка", ephemeral=True)
+        log.error("Ошибка в команде топ_месяц: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
 
 @bot.tree.command(name="проверить_войс", description="Принудительная проверка голосовых пользователей (админ)")
 async def force_voice_check_command(interaction: discord.Interaction):
@@ -1809,18 +3519,19 @@ async def force_voice_check_command(interaction: discord.Interaction):
 
 @bot.tree.command(name="статистика", description="Показать подробную статистику пользователя")
 @app_commands.describe(пользователь="Выберите пользователя")
+@guarded_command()
 async def stats_command(interaction: discord.Interaction, пользователь: discord.Member = None):
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("⛔ У вас нет прав администратора!", ephemeral=True)
+        await respond(interaction, "⛔ У вас нет прав администратора!", ephemeral=True)
         return
     
     try:
         target = пользователь or interaction.user
         embed = await create_user_stats_embed(target)
-        await interaction.response.send_message(embed=embed)
+        await respond(interaction, embed=embed)
     except Exception as e:
-        print(f"Ошибка в команде статистика: {e}")
-        await interaction.response.send_message("⛔ Произошла ошибка", ephemeral=True)
+        log.error("Ошибка в команде статистика: %s", e)
+        await respond(interaction, "⛔ Произошла ошибка", ephemeral=True)
 
 @bot.tree.command(name="бан", description="Забанить пользователя")
 @app_commands.describe(
@@ -1985,53 +3696,245 @@ async def unmute_command(
     except Exception as e:
         await interaction.response.send_message(f"⛔ Ошибка при снятии таймаута: {str(e)}", ephemeral=True)
 
+class BatchModerationView(discord.ui.View):
+    """Подтверждение массового действия"""
+    def __init__(self, moderator, action, targets, reason, duration=None, delete_days=0):
+        super().__init__(timeout=120)
+        self.moderator = moderator
+        self.action = action
+        self.targets = targets
+        self.reason = reason
+        self.duration = duration
+        self.delete_days = delete_days
+        self.confirm_button.label = f"Подтвердить ({len(targets)})"
+    
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.moderator.id:
+            await interaction.response.send_message("⛔ Эти кнопки не для вас!", ephemeral=True)
+            return False
+        return True
+    
+    @discord.ui.button(label="Подтвердить", style=discord.ButtonStyle.danger, emoji="✅")
+    async def confirm_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.stop()
+        spec = BATCH_ACTIONS[self.action]
+        await interaction.response.edit_message(
+            content=f"⏳ {spec['name']}: обрабатываем {len(self.targets)} участников...", embed=None, view=None
+        )
+        
+        guild = interaction.guild
+        done, failed = await run_batch_moderation(
+            guild, self.action, self.targets, f"{self.reason} (массово: {self.moderator})",
+            duration=self.duration, delete_days=self.delete_days
+        )
+        
+        embed = discord.Embed(
+            title=f"{spec['emoji']} Массовое действие: {spec['name']}",
+            color=COLORS[spec['color']],
+            timestamp=datetime.now()
+        )
+        embed.add_field(name="✅ Успешно", value=f"`{len(done)}`", inline=True)
+        embed.add_field(name="⛔ Ошибок", value=f"`{len(failed)}`", inline=True)
+        if self.duration:
+            embed.add_field(name="⏱️ Длительность", value=f"{int(self.duration.total_seconds() // 60)} минут", inline=True)
+        embed.add_field(name="🎯 Участники", value=format_targets(done)[:1024], inline=False)
+        if failed:
+            errors = "\n".join(f"<@{target.id}>: {error[:80]}" for target, error in failed[:10])
+            embed.add_field(name="⚠️ Не удалось", value=errors[:1024], inline=False)
+        embed.add_field(name="📋 Причина", value=self.reason, inline=False)
+        await interaction.edit_original_response(content=None, embed=embed)
+        
+        # Одна запись в лог на всю пачку
+        await log_action(
+            guild,
+            f"{spec['emoji']} Массовое действие: {spec['name']}",
+            f"**Успешно:** `{len(done)}`, **ошибок:** `{len(failed)}`\n**Участники:** {format_targets(done)}",
+            COLORS[spec['color']],
+            moderator=self.moderator,
+            reason=self.reason
+        )
+    
+    @discord.ui.button(label="Отмена", style=discord.ButtonStyle.secondary, emoji="✖️")
+    async def cancel_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.stop()
+        await interaction.response.edit_message(content="✖️ Массовое действие отменено", embed=None, view=None)
+
+@bot.tree.command(name="массово", description="Бан, кик или таймаут сразу многих участников")
+@app_commands.describe(
+    действие="Что сделать с участниками",
+    пользователи="Упоминания или ID через пробел",
+    роль="Все участники с этой ролью",
+    за_минут="Все, кто зашел на сервер за последние N минут",
+    длительность="Длительность таймаута в минутах",
+    причина="Причина",
+    удалить_сообщения="Удалить сообщения за последние дни (для бана)"
+)
+@app_commands.choices(
+    действие=[
+        app_commands.Choice(name="Бан", value="ban"),
+        app_commands.Choice(name="Кик", value="kick"),
+        app_commands.Choice(name="Таймаут", value="timeout"),
+    ],
+    удалить_сообщения=[
+        app_commands.Choice(name="Не удалять", value="0"),
+        app_commands.Choice(name="1 день", value="1"),
+        app_commands.Choice(name="7 дней", value="7"),
+    ]
+)
+async def batch_moderation_command(
+    interaction: discord.Interaction,
+    действие: app_commands.Choice[str],
+    пользователи: str = None,
+    роль: discord.Role = None,
+    за_минут: int = None,
+    длительность: int = 60,
+    причина: str = "Не указана",
+    удалить_сообщения: app_commands.Choice[str] = None
+):
+    spec = BATCH_ACTIONS[действие.value]
+    if not getattr(interaction.user.guild_permissions, spec['permission']):
+        await interaction.response.send_message(f"⛔ У вас нет прав на действие «{spec['name']}»!", ephemeral=True)
+        return
+    
+    if not (пользователи or роль or за_минут):
+        await interaction.response.send_message("⛔ Укажите пользователей, роль или за_минут!", ephemeral=True)
+        return
+    
+    if действие.value == 'timeout' and not 1 <= длительность <= 40320:
+        await interaction.response.send_message("⛔ Длительность таймаута - от 1 до 40320 минут (28 дней)!", ephemeral=True)
+        return
+    
+    if not interaction.guild.chunked:
+        # Участники загружаются с шлюза - на больших серверах дольше 3 секунд на ответ
+        await interaction.response.defer(ephemeral=True, thinking=True)
+    
+    targets, skipped = await collect_batch_targets(
+        interaction.guild, interaction.user, действие.value,
+        user_ids=parse_user_ids(пользователи), role=роль, joined_minutes=за_минут
+    )
+    
+    if not targets:
+        await respond(interaction, "⛔ Нет подходящих участников!", ephemeral=True)
+        return
+    
+    if len(targets) > CONFIG['BATCH_MAX_TARGETS']:
+        await respond(
+            interaction,
+            f"⛔ Слишком много участников: {len(targets)} (максимум {CONFIG['BATCH_MAX_TARGETS']})! Сузьте фильтр.",
+            ephemeral=True
+        )
+        return
+    
+    view = BatchModerationView(
+        interaction.user, действие.value, targets, причина,
+        duration=timedelta(minutes=длительность) if действие.value == 'timeout' else None,
+        delete_days=int(удалить_сообщения.value) if удалить_сообщения else 0
+    )
+    
+    embed = discord.Embed(
+        title=f"{spec['emoji']} {spec['name']}: {len(targets)} участников",
+        description=format_targets(targets),
+        color=COLORS[spec['color']]
+    )
+    if skipped:
+        embed.add_field(name="⏭️ Пропущено", value=f"`{skipped}` (вы, бот, владелец или роль не ниже вашей/бота)", inline=False)
+    embed.add_field(name="📋 Причина", value=причина, inline=False)
+    
+    await respond(interaction, embed=embed, view=view, ephemeral=True)
+
+class PurgeView(discord.ui.View):
+    """Кнопка остановки задания очистки"""
+    def __init__(self, job):
+        super().__init__(timeout=None)
+        self.job = job
+    
+    @discord.ui.button(label="Остановить", style=discord.ButtonStyle.danger, emoji="⏹️")
+    async def cancel_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.job.moderator.id and not interaction.user.guild_permissions.manage_messages:
+            await interaction.response.send_message("⛔ Эта кнопка не для вас!", ephemeral=True)
+            return
+        
+        if not self.job.finished:
+            self.job.cancelled = True
+        await interaction.response.edit_message(embed=self.job.status_embed(), view=None)
+
 @bot.tree.command(name="очистить", description="Очистить сообщения в канале")
 @app_commands.describe(
-    количество="Количество сообщений для удаления (макс. 100)",
-    пользователь="Очистить сообщения только от этого пользователя"
+    количество=f"Количество сообщений для удаления (макс. {CONFIG['PURGE_MAX_MESSAGES']})",
+    пользователь="Очистить сообщения только от этого пользователя",
+    содержит="Только сообщения, содержащие этот текст (без учета регистра)",
+    вложения="Только сообщения с вложениями",
+    за_минут="Только сообщения за последние N минут",
+    старше_минут="Только сообщения старше N минут"
 )
 async def clear_command(
     interaction: discord.Interaction,
     количество: int = 10,
-    пользователь: discord.Member = None
+    пользователь: discord.Member = None,
+    содержит: str = None,
+    вложения: bool = False,
+    за_минут: int = None,
+    старше_минут: int = None
 ):
     if not interaction.user.guild_permissions.manage_messages:
         await interaction.response.send_message("⛔ У вас нет прав для управления сообщениями!", ephemeral=True)
         return
     
-    if количество < 1 or количество > 100:
-        await interaction.response.send_message("⛔ Количество должно быть от 1 до 100!", ephemeral=True)
+    if количество < 1 or количество > CONFIG['PURGE_MAX_MESSAGES']:
+        await interaction.response.send_message(f"⛔ Количество должно быть от 1 до {CONFIG['PURGE_MAX_MESSAGES']}!", ephemeral=True)
         return
     
-    await interaction.response.defer(ephemeral=True)
+    if interaction.channel.id in purge_jobs:
+        await interaction.response.send_message("⛔ В этом канале уже идет очистка!", ephemeral=True)
+        return
+    
+    # Обычная подстрока, не регулярное выражение: проверка идет в цикле событий по тысячам
+    # сообщений, и выражение с катастрофическим перебором остановило бы весь бот
+    if содержит and len(содержит) > 200:
+        await interaction.response.send_message("⛔ Слишком длинный текст для поиска (макс. 200 символов)!", ephemeral=True)
+        return
+    needle = содержит.casefold() if содержит else None
+    
+    now = discord.utils.utcnow()
+    after = now - timedelta(minutes=за_минут) if за_минут else None
+    before = now - timedelta(minutes=старше_минут) if старше_минут else None
+    
+    filters = []
+    if пользователь:
+        filters.append(f"Только от {пользователь.mention}")
+    if needle:
+        filters.append(f"Текст: `{содержит}`")
+    if вложения:
+        filters.append("Только с вложениями")
+    if after:
+        filters.append(f"Не раньше <t:{int(after.timestamp())}:R>")
+    if before:
+        filters.append(f"Не позже <t:{int(before.timestamp())}:R>")
+    
+    def check(msg):
+        if пользователь and msg.author.id != пользователь.id:
+            return False
+        if вложения and not msg.attachments:
+            return False
+        if needle and needle not in msg.content.casefold():
+            return False
+        return True
+    
+    # Задание регистрируется до первого await - параллельный вызов в этом канале уже его увидит
+    job = PurgeJob(interaction.channel, interaction.user, количество, check, filters, after=after, before=before)
+    purge_jobs[interaction.channel.id] = job
     
     try:
-        def check(msg):
-            if пользователь:
-                return msg.author == пользователь and not msg.pinned
-            return not msg.pinned
-        
-        deleted = await interaction.channel.purge(limit=количество, check=check)
-        
-        embed = discord.Embed(
-            title="🧹 Очистка сообщений",
-            description=f"Удалено **{len(deleted)}** сообщений в {interaction.channel.mention}",
-            color=COLORS['SUCCESS'],
-            timestamp=datetime.now()
-        )
-        
-        if пользователь:
-            embed.add_field(name="👤 Фильтр", value=f"Только от {пользователь.mention}", inline=True)
-        
-        embed.add_field(name="👑 Исполнитель", value=interaction.user.mention, inline=True)
-        
-        await interaction.followup.send(embed=embed, ephemeral=True)
-        
-        await asyncio.sleep(5)
-        await interaction.delete_original_response()
+        await interaction.response.defer(ephemeral=True)
+        view = PurgeView(job)
+        progress_message = await interaction.followup.send(embed=job.status_embed(), view=view, ephemeral=True, wait=True)
+        job.task = asyncio.create_task(run_purge_job(job, progress_message, view))
         
     except Exception as e:
-        await interaction.followup.send(f"⛔ Ошибка при очистке: {str(e)}", ephemeral=True)
+        purge_jobs.pop(interaction.channel.id, None)
+        log.error("⛔ Ошибка запуска очистки: %s", e)
+        if interaction.response.is_done():
+            await interaction.followup.send(f"⛔ Ошибка при очистке: {str(e)}", ephemeral=True)
 
 @bot.tree.command(name="установить_канал", description="Установить канал для уведомлений")
 @app_commands.describe(канал="Выберите текстовый канал")
@@ -2073,6 +3976,7 @@ async def set_logs_command(interaction: discord.Interaction, канал: discord
     app_commands.Choice(name="Текстовый", value="text"),
     app_commands.Choice(name="Голосовой", value="voice"),
 ])
+@guarded_command(limit=2)
 async def give_level_command(
     interaction: discord.Interaction,
     пользователь: discord.Member,
@@ -2080,11 +3984,11 @@ async def give_level_command(
     количество: int
 ):
     if not interaction.user.guild_permissions.administrator:
-        await interaction.response.send_message("⛔ У вас нет прав!", ephemeral=True)
+        await respond(interaction, "⛔ У вас нет прав!", ephemeral=True)
         return
     
     if количество < 1:
-        await interaction.response.send_message("⛔ Количество должно быть положительным!", ephemeral=True)
+        await respond(interaction, "⛔ Количество должно быть положительным!", ephemeral=True)
         return
     
     await add_xp(пользователь.id, количество, тип.value, interaction.guild)
@@ -2095,9 +3999,10 @@ async def give_level_command(
         description=f"✅ Выдано **{количество}** XP ({type_name}) пользователю {пользователь.mention}",
         color=discord.Color.green()
     )
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
 
 @bot.tree.command(name="логи_инфо", description="Показать информацию о настройках логов")
+@guarded_command()
 async def logs_info_command(interaction: discord.Interaction):
     guild_id = interaction.guild.id
     
@@ -2122,7 +4027,7 @@ async def logs_info_command(interaction: discord.Interaction):
         inline=True
     )
     
-    await interaction.response.send_message(embed=embed)
+    await respond(interaction, embed=embed)
 
 @bot.tree.command(name="тревога", description="Управление системой оповещений (только для владельца сервера и создателя бота)")
 @app_commands.describe(действие="Включить или выключить систему тревог")
@@ -2194,27 +4099,20 @@ async def profile_text_command(interaction: discord.Interaction, текст: str
             await interaction.response.send_message("⛔ Текст не может быть длиннее 100 символов!", ephemeral=True)
             return
         
-        user_data = await get_user_data(interaction.user.id)
-        
-        # Проверяем когда последний раз меняли текст
-        last_updated = user_data.get('profile_text_updated')
-        if last_updated:
-            last_updated_dt = last_updated.replace(tzinfo=None) if isinstance(last_updated, datetime) else last_updated
-            time_diff = datetime.now() - last_updated_dt
-            days_passed = time_diff.days
-            
-            if days_passed < 30:
-                days_left = 30 - days_passed
-                await interaction.response.send_message(
-                    f"⛔ Вы можете менять текст профиля только раз в месяц! Попробуйте через {days_left} дней.",
-                    ephemeral=True
-                )
-                return
+        # Запись с проверкой "раз в 30 дней" одним оператором - только текст, опыт не трогаем
+        updated = await db_query('fetchval', 'set_profile_text', interaction.user.id, текст)
+        if updated is None:
+            last_updated = await db_query('fetchval', 'get_profile_text_updated', interaction.user.id)
+            days_passed = (datetime.now() - last_updated.replace(tzinfo=None)).days if last_updated else 30
+            days_left = max(30 - days_passed, 1)
+            await interaction.response.send_message(
+                f"⛔ Вы можете менять текст профиля только раз в месяц! Попробуйте через {days_left} дней.",
+                ephemeral=True
+            )
+            return
         
-        # Обновляем текст
-        user_data['profile_text'] = текст
-        user_data['profile_text_updated'] = datetime.now()
-        await save_user_data(interaction.user.id, user_data)
+        if interaction.user.id in user_cache:
+            user_cache[interaction.user.id]['profile_text'] = текст
         
         embed = discord.Embed(
             title="✅ Текст профиля обновлен!",
@@ -2231,16 +4129,15 @@ async def profile_text_command(interaction: discord.Interaction, текст: str
         await interaction.response.send_message(embed=embed, ephemeral=True)
         
     except Exception as e:
-        print(f"Ошибка в команде профиль_текст: {e}")
+        log.error("Ошибка в команде профиль_текст: %s", e)
         await interaction.response.send_message("⛔ Произошла ошибка!", ephemeral=True)
 
 @bot.tree.command(name="профиль_текст_сброс", description="Сбросить текст профиля")
 async def profile_text_reset_command(interaction: discord.Interaction):
     try:
-        user_data = await get_user_data(interaction.user.id)
-        user_data['profile_text'] = None
-        user_data['profile_text_updated'] = None
-        await save_user_data(interaction.user.id, user_data)
+        await db_query('execute', 'clear_profile_text', interaction.user.id)
+        if interaction.user.id in user_cache:
+            user_cache[interaction.user.id]['profile_text'] = None
         
         embed = discord.Embed(
             title="✅ Текст профиля сброшен!",
@@ -2251,7 +4148,7 @@ async def profile_text_reset_command(interaction: discord.Interaction):
         await interaction.response.send_message(embed=embed, ephemeral=True)
         
     except Exception as e:
-        print(f"Ошибка в команде профиль_текст_сброс: {e}")
+        log.error("Ошибка в команде профиль_текст_сброс: %s", e)
         await interaction.response.send_message("⛔ Произошла ошибка!", ephemeral=True)
 
 @bot.tree.command(name="сброс_юзера", description="Полный сброс пользователя (только для БОГОВ!)")
@@ -2272,26 +4169,18 @@ async def reset_user_command(interaction: discord.Interaction, пользова
         return
     
     try:
-        # Получаем текущие данные пользователя (для логов)
-        old_data = await get_user_data(пользователь.id)
-        
-        # Полный сброс данных
-        reset_data = {
-            'user_id': пользователь.id,
-            'text_xp': 0,
-            'text_level': 1,
-            'voice_xp': 0,
-            'voice_level': 1,
-            'total_xp': 0,
-            'total_level': 1,
-            'prestige': 0,
-            'profile_text': None,
-            'profile_text_updated': None
+        # Полный сброс одним оператором; RETURNING отдает данные до сброса (для отчета)
+        row = await reset_user_xp(пользователь.id, 'reset_user')
+        if row is None:
+            await interaction.response.send_message(f"ℹ️ У {пользователь.mention} нет данных для сброса", ephemeral=True)
+            return
+        old_data = {
+            'total_level': row['old_total_level'],
+            'total_xp': row['old_total_xp'],
+            'prestige': row['old_prestige'],
+            'profile_text': row['old_profile_text']
         }
         
-        # Сохраняем сброшенные данные
-        await save_user_data(пользователь.id, reset_data)
-        
         # Создаем embed с результатами
         embed = discord.Embed(
             title="🔄 Полный сброс пользователя",
@@ -2370,10 +4259,10 @@ async def reset_user_command(interaction: discord.Interaction, пользова
             
             await пользователь.send(embed=user_embed)
         except discord.Forbidden:
-            print(f"⛔ Не удалось отправить уведомление пользователю {пользователь.name}")
+            log.error("⛔ Не удалось отправить уведомление пользователю %s", пользователь.name)
         
     except Exception as e:
-        print(f"Ошибка при сбросе пользователя: {e}")
+        log.error("Ошибка при сбросе пользователя: %s", e)
         await interaction.response.send_message(
             f"⛔ Произошла ошибка при сбросе пользователя: {str(e)}", 
             ephemeral=True
@@ -2423,7 +4312,7 @@ async def user_info_command(interaction: discord.Interaction, пользоват
             name="📈 Прогресс",
             value=f"**Общий уровень:** `{user_data['total_level']}`\n"
                   f"**Общий опыт:** `{user_data['total_xp']:,}`\n"
-                  f"**Престиж:** `{user_data.get('prestige', 0)}/3`",
+                  f"**Престиж:** `{user_data.get('prestige', 0)}/{MAX_PRESTIGE}`",
             inline=True
         )
         
@@ -2472,18 +4361,12 @@ async def user_info_command(interaction: discord.Interaction, пользоват
                         inline=True
                     )
             except (ValueError, AttributeError) as e:
-                print(f"Ошибка обработки даты: {e}")
+                log.error("Ошибка обработки даты: %s", e)
         
         # Информация о возможности престижа
-        can_prestige = (
-            user_data.get('prestige', 0) < 3 and 
-            user_data['text_level'] >= 1000 and 
-            user_data['voice_level'] >= 1000
-        )
-        
         embed.add_field(
             name="🎯 Статус престижа",
-            value=f"**Доступен:** {'✅' if can_prestige else '⛔'}",
+            value=f"**Доступен:** {'✅' if can_prestige(user_data) else '⛔'}",
             inline=True
         )
         
@@ -2492,7 +4375,7 @@ async def user_info_command(interaction: discord.Interaction, пользоват
         await interaction.response.send_message(embed=embed, ephemeral=True)
         
     except Exception as e:
-        print(f"Ошибка в команде инфо_юзер: {e}")
+        log.error("Ошибка в команде инфо_юзер: %s", e)
         await interaction.response.send_message("⛔ Произошла ошибка при получении данных!", ephemeral=True)
 
 @bot.tree.command(name="пригласить", description="Пригласить пользователя в голосовой канал через ЛС")
@@ -2637,12 +4520,272 @@ async def invite_voice_command(
             await interaction.followup.send(embed=error_embed, ephemeral=True)
             
     except Exception as e:
-        print(f"Ошибка в команде пригласить: {e}")
+        log.error("Ошибка в команде пригласить: %s", e)
         await interaction.followup.send(
             f"⛔ Произошла ошибка при отправке приглашения: {str(e)}", 
             ephemeral=True
         )
 
+# ========== ИНСТРУМЕНТАЦИЯ ==========
+
+# Профилирование (PROFILE_ENABLED=1)
+handler_stats = defaultdict(lambda: {'count': 0, 'wall': 0.0, 'busy': 0.0, 'max_step': 0.0})
+slow_callbacks = deque(maxlen=20)  # [(время, мс, описание)]
+loop_lag = {'last': 0.0, 'max': 0.0, 'heartbeat': 0.0}
+profiler_state = {'task': None, 'thread': None}
+
+LOOP_LAG_INTERVAL = max(0.01, min(0.25, CONFIG['SLOW_CALLBACK_SECONDS'] / 2))
+
+class MeasuredCoroutine:
+    """Awaitable-обертка, которая замеряет каждый шаг корутины - т.е. время, пока она держит цикл событий"""
+    
+    def __init__(self, coro):
+        self.coro = coro
+        self.busy = 0.0
+        self.max_step = 0.0
+    
+    def _account(self, start):
+        step = time.perf_counter() - start
+        self.busy += step
+        if step > self.max_step:
+            self.max_step = step
+    
+    def __await__(self):
+        gen = self.coro.__await__()
+        send_value, throw_exc = None, None
+        
+        while True:
+            start = time.perf_counter()
+            try:
+                if throw_exc is not None:
+                    yielded = gen.throw(throw_exc)
+                else:
+                    yielded = gen.send(send_value)
+            except StopIteration as stop:
+                self._account(start)
+                return stop.value
+            except BaseException:
+                self._account(start)
+                raise
+            self._account(start)
+            
+            try:
+                send_value, throw_exc = (yield yielded), None
+            except BaseException as exc:
+                send_value, throw_exc = None, exc
+
+async def profile_call(name, coro):
+    """Выполнение корутины с записью статистики обработчика"""
+    measured = MeasuredCoroutine(coro)
+    start = time.perf_counter()
+    try:
+        return await measured
+    finally:
+        stats = handler_stats[name]
+        stats['count'] += 1
+        stats['wall'] += time.perf_counter() - start
+        stats['busy'] += measured.busy
+        stats['max_step'] = max(stats['max_step'], measured.max_step)
+        
+        if measured.max_step > CONFIG['SLOW_CALLBACK_SECONDS']:
+            slow_callbacks.append((datetime.now(), measured.max_step * 1000, name))
+            log.warning("🐢 %s держал цикл событий %.0f мс за один шаг", name, measured.max_step * 1000)
+
+def make_profiled(name, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await profile_call(name, func(*args, **kwargs))
+    return wrapper
+
+async def monitor_loop_lag():
+    """Замер задержки цикла событий: насколько позже запланированного мы просыпаемся"""
+    while True:
+        start = time.monotonic()
+        loop_lag['heartbeat'] = start
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        
+        lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL)
+        loop_lag['last'] = lag
+        loop_lag['max'] = max(loop_lag['max'], lag)
+        metrics.observe('event_loop_lag_seconds', lag)
+
+def loop_watchdog(loop_thread_id):
+    """
+    Поток-сторож: если цикл событий давно не отмечался, снимаем стек его потока -
+    это и есть колбэк, который сейчас держит цикл
+    """
+    threshold = CONFIG['SLOW_CALLBACK_SECONDS']
+    reported_heartbeat = None
+    
+    while True:
+        time.sleep(max(threshold / 4, 0.01))
+        
+        heartbeat = loop_lag['heartbeat']
+        stall = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+        if stall <= threshold or heartbeat == reported_heartbeat:
+            continue
+        
+        reported_heartbeat = heartbeat
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=15)) if frame else "стек недоступен"
+        slow_callbacks.append((datetime.now(), stall * 1000, stack.strip().splitlines()[-2].strip() if frame else stack))
+        log.warning("🐢 Цикл событий заблокирован уже %.0f мс, стек:\n%s", stall * 1000, stack)
+
+def start_profiler():
+    """Запуск монитора лагов и потока-сторожа (один раз за процесс)"""
+    if not CONFIG['PROFILE_ENABLED'] or profiler_state['task'] is not None:
+        return
+    
+    loop_lag['heartbeat'] = time.monotonic()
+    profiler_state['task'] = asyncio.create_task(monitor_loop_lag())
+    profiler_state['thread'] = threading.Thread(
+        target=loop_watchdog,
+        args=(threading.get_ident(),),
+        name='loop-watchdog',
+        daemon=True
+    )
+    profiler_state['thread'].start()
+    log.info("🔬 Профилирование включено, порог медленного колбэка: %.0f мс", CONFIG['SLOW_CALLBACK_SECONDS'] * 1000)
+
+def instrument_event_handlers():
+    """Оборачивает все обработчики @bot.event счетчиком событий и таймером"""
+    for name, handler in list(vars(bot).items()):
+        if not name.startswith('on_') or not asyncio.iscoroutinefunction(handler):
+            continue
+        if getattr(handler, '__instrumented__', False):
+            continue
+        
+        def make_wrapper(event_name, coro):
+            @functools.wraps(coro)
+            async def wrapper(*args, **kwargs):
+                metrics.inc('events_total', event=event_name)
+                with metrics.timer('event_duration_seconds', event=event_name):
+                    if CONFIG['PROFILE_ENABLED']:
+                        return await profile_call(event_name, coro(*args, **kwargs))
+                    return await coro(*args, **kwargs)
+            wrapper.__instrumented__ = True
+            return wrapper
+        
+        setattr(bot, name, make_wrapper(name, handler))
+
+def instrument_tasks_and_commands():
+    """В режиме профилирования оборачивает фоновые задачи и слеш-команды"""
+    if not CONFIG['PROFILE_ENABLED']:
+        return
+    
+    for name, value in list(globals().items()):
+        if isinstance(value, tasks.Loop):
+            value.coro = make_profiled(f"task:{name}", value.coro)
+    
+    for command in bot.tree.walk_commands():
+        if isinstance(command, app_commands.Command):
+            command._callback = make_profiled(f"/{command.qualified_name}", command._callback)
+
+@bot.tree.command(name="профайлер", description="Самые медленные обработчики и лаги цикла событий (админ)")
+@app_commands.describe(количество="Сколько обработчиков показать")
+async def profiler_command(interaction: discord.Interaction, количество: int = 10):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("⛔ Требуются права администратора!", ephemeral=True)
+        return
+    
+    if not CONFIG['PROFILE_ENABLED']:
+        await interaction.response.send_message(
+            "ℹ️ Профилирование выключено. Запустите бота с `PROFILE_ENABLED=1`.",
+            ephemeral=True
+        )
+        return
+    
+    top = sorted(handler_stats.items(), key=lambda item: item[1]['max_step'], reverse=True)[:max(1, min(количество, 25))]
+    
+    embed = discord.Embed(
+        title="🔬 Профайлер обработчиков",
+        color=discord.Color.orange(),
+        timestamp=datetime.now()
+    )
+    
+    lines = []
+    for name, stats in top:
+        avg_wall = stats['wall'] / stats['count'] * 1000
+        avg_busy = stats['busy'] / stats['count'] * 1000
+        lines.append(
+            f"`{name}` ×{stats['count']}\n"
+            f"　└ макс. шаг `{stats['max_step'] * 1000:.1f}` мс, "
+            f"цикл `{avg_busy:.1f}` мс, всего `{avg_wall:.1f}` мс в среднем"
+        )
+    
+    embed.description = "\n".join(lines)[:4000] if lines else "*Пока нет данных*"
+    
+    embed.add_field(
+        name="⏱️ Лаг цикла событий",
+        value=f"**Текущий:** `{loop_lag['last'] * 1000:.1f}` мс\n**Максимум:** `{loop_lag['max'] * 1000:.1f}` мс",
+        inline=True
+    )
+    
+    if slow_callbacks:
+        recent = [
+            f"<t:{int(ts.timestamp())}:R> `{ms:.0f}` мс — `{where[:80]}`"
+            for ts, ms, where in list(slow_callbacks)[-5:]
+        ]
+        embed.add_field(name="🐢 Последние блокировки", value="\n".join(recent), inline=False)
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    # Время от создания interaction на стороне Discord до завершения команды
+    latency = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    metrics.observe('app_command_seconds', latency, command=command.qualified_name)
+    metrics.inc('app_commands_total', command=command.qualified_name, status='ok')
+
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    command_name = interaction.command.qualified_name if interaction.command else 'unknown'
+    metrics.inc('app_commands_total', command=command_name, status='error')
+    log.error("⛔ Ошибка в команде %s: %s", command_name, error, exc_info=error)
+
+metrics.gauge('db_pool_size', lambda: db.db_pool.get_size() if db.db_pool else None)
+metrics.gauge('db_pool_idle', lambda: db.db_pool.get_idle_size() if db.db_pool else None)
+metrics.gauge('db_pool_max_size', lambda: db.db_pool.get_max_size() if db.db_pool else None)
+metrics.gauge('db_breaker_state', lambda: CircuitBreaker.STATES[db_breaker.state])
+metrics.gauge('pending_xp_deltas', lambda: len(pending_xp_deltas))
+metrics.gauge('xp_history_buffer', lambda: len(db.xp_history_buffer))
+metrics.gauge('rank_card_cache_size', lambda: len(rank_card_cache))
+metrics.gauge('member_cache_size', lambda: len(member_resolver.cache))
+metrics.gauge('discord_cached_members', lambda: sum(len(guild.members) for guild in bot.guilds))
+metrics.gauge('discord_cached_users', lambda: len(bot.users))
+metrics.gauge('process_rss_bytes', rss_bytes)
+metrics.gauge('rank_index_users', lambda: rank_index.total if rank_index.loaded else None)
+metrics.gauge('avatar_cache_size', lambda: len(avatar_cache))
+metrics.gauge('worker_buffer_bytes', lambda: worker_client.writer.transport.get_write_buffer_size() if worker_client and worker_client.connected else None)
+metrics.gauge('log_queue_depth', lambda: log_queue.qsize())
+metrics.gauge('pending_change_batches', lambda: len(pending_changes))
+metrics.gauge('voice_sessions', lambda: len(voice_sessions))
+metrics.gauge('guilds', lambda: len(bot.guilds))
+metrics.gauge('gateway_latency_seconds', lambda: [
+    ((('shard', shard_id),), latency) for shard_id, latency in bot.latencies
+] if CONFIG['SHARDED'] else (bot.latency if bot.is_ready() else None))
+
+instrument_event_handlers()
+instrument_tasks_and_commands()
+
+async def run_bot():
+    async with bot:
+        try:
+            # SIGTERM (docker stop, systemd) - такая же мягкая остановка, как Ctrl+C
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+        except (NotImplementedError, RuntimeError):
+            pass
+        
+        try:
+            await bot.start(CONFIG['TOKEN'])
+        finally:
+            await shutdown()
+
 # Запуск бота
 if __name__ == "__main__":
-    bot.run(CONFIG['TOKEN'])
\ No newline at end of file
+    try:
+        asyncio.run(run_bot())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
\ No newline at end of file
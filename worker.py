@@ -0,0 +1,200 @@
+"""
+Воркер учета XP и журнала аудита
+
+Принимает события от процесса бота через Unix-сокет (JSON-строки), копит их
+и пачками пишет в Postgres: начисления XP одного пользователя за период
+схлопываются в одно атомарное обновление (db.apply_xp_delta) и попадают
+в историю XP для топов за неделю/месяц, события аудита
+уходят в audit_events одним COPY. О повышении уровня воркер сообщает боту
+обратно по тому же соединению - уведомление отправляет бот.
+
+Запуск:
+    WORKER_SOCKET=/tmp/koyebot.sock python worker.py     # отдельным процессом
+    WORKER_SOCKET=/tmp/koyebot.sock WORKER_SPAWN=1 ...   # бот сам запустит воркер
+
+Переменные окружения те же, что у бота (DATABASE_URL, DB_*, XP_PER_LEVEL и т.д.).
+"""
+
+import os
+import json
+import signal
+import asyncio
+from datetime import datetime
+
+import db
+from db import CONFIG, log, metrics, setup_logging
+
+AUDIT_COLUMNS = ['guild_id', 'action', 'description', 'target_id', 'moderator_id', 'reason', 'created_at']
+AUDIT_BUFFER_LIMIT = 100_000  # Событий аудита в памяти, пока БД недоступна (старые отбрасываются)
+
+xp_buffer = {}  # {user_id: {'text': дельта, 'voice': дельта, 'guild_id': id, 'writer': StreamWriter}}
+audit_buffer = []  # [кортеж в порядке AUDIT_COLUMNS]
+clients = set()
+flush_lock = asyncio.Lock()  # Запись из цикла и при отключении клиента не должна идти параллельно
+
+def buffer_xp(user_id, text, voice, guild_id, writer):
+    entry = xp_buffer.setdefault(user_id, {'text': 0, 'voice': 0, 'guild_id': None, 'writer': None})
+    entry['text'] += text
+    entry['voice'] += voice
+    # Уведомление о уровне - на сервер и соединение последнего начисления
+    if guild_id:
+        entry['guild_id'] = guild_id
+        entry['writer'] = writer
+
+def handle_event(event, writer):
+    if event['op'] == 'xp':
+        delta = event['xp']
+        buffer_xp(
+            event['user_id'],
+            delta if event['xp_type'] == 'text' else 0,
+            delta if event['xp_type'] == 'voice' else 0,
+            event.get('guild_id'),
+            writer
+        )
+        if event.get('guild_id'):
+            db.record_xp_history(event['guild_id'], event['user_id'], delta, event['xp_type'])
+    elif event['op'] == 'audit':
+        audit_buffer.append((
+            event['guild_id'],
+            event['action'],
+            event.get('description'),
+            event.get('target_id'),
+            event.get('moderator_id'),
+            event.get('reason'),
+            datetime.fromtimestamp(event['created_at'])
+        ))
+    elif event['op'] == 'forget':
+        # Престиж/сброс: опыт пользователя обнулен в БД - накопленные дельты к нему не относятся
+        xp_buffer.pop(event['user_id'], None)
+    else:
+        log.warning("Неизвестное событие воркера: %s", event['op'])
+        return
+    metrics.inc('worker_received_total', op=event['op'])
+
+def notify_level_up(writer, user_id, guild_id, xp_type, old_level, new_level):
+    if writer is None or writer.is_closing():
+        return
+    message = {
+        'op': 'level_up',
+        'user_id': user_id,
+        'guild_id': guild_id,
+        'xp_type': xp_type,
+        'old_level': old_level,
+        'new_level': new_level
+    }
+    writer.write(json.dumps(message).encode() + b'\n')
+
+async def flush_xp():
+    for user_id in list(xp_buffer):
+        # Пользователя мог убрать 'forget' (сброс опыта), пока шла запись предыдущего
+        entry = xp_buffer.pop(user_id, None)
+        if entry is None:
+            continue
+        try:
+            old_levels, user = await db.apply_xp_delta(user_id, entry['text'], entry['voice'])
+        except db.DatabaseUnavailable as e:
+            if e.sent:
+                # Запрос дошел до сервера и мог примениться - повтор начислил бы опыт дважды.
+                # Остальных пользователей это не касается: если БД легла, следующий запрос не уйдет (sent=False)
+                log.error("⛔ Опыт %s мог не записаться: %s", user_id, e)
+                db.count_possibly_lost_xp(entry['text'], entry['voice'])
+                continue
+            # Возвращаем в буфер (перед пришедшим за время запроса) и ждем следующего цикла
+            newer = xp_buffer.pop(user_id, None)
+            buffer_xp(user_id, entry['text'], entry['voice'], entry['guild_id'], entry['writer'])
+            if newer:
+                buffer_xp(user_id, newer['text'], newer['voice'], newer['guild_id'], newer['writer'])
+            log.warning("⚠️ Запись XP отложена: %s", e)
+            return
+        except Exception as e:
+            log.error("⛔ Ошибка записи XP %s: %s", user_id, e)
+            continue
+
+        for xp_type in ('text', 'voice'):
+            if entry[xp_type] > 0 and user[f'{xp_type}_level'] > old_levels[xp_type] and entry['guild_id']:
+                notify_level_up(
+                    entry['writer'], user_id, entry['guild_id'], xp_type,
+                    old_levels[xp_type], user[f'{xp_type}_level']
+                )
+        metrics.inc('xp_granted_total', entry['text'], type='text')
+        metrics.inc('xp_granted_total', entry['voice'], type='voice')
+
+async def flush_audit():
+    global audit_buffer
+    if not audit_buffer:
+        return
+
+    records, audit_buffer = audit_buffer, []
+    try:
+        async with db.db_connection('insert_audit_events') as conn:
+            await conn.copy_records_to_table('audit_events', records=records, columns=AUDIT_COLUMNS)
+    except Exception as e:
+        audit_buffer = (records + audit_buffer)[-AUDIT_BUFFER_LIMIT:]
+        log.warning("⚠️ Запись аудита отложена (%s событий): %s", len(audit_buffer), e)
+
+async def flush():
+    async with flush_lock:
+        await flush_xp()
+        await db.flush_xp_history()
+        await flush_audit()
+
+async def flush_loop(stop):
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), CONFIG['WORKER_FLUSH_SECONDS'])
+        except asyncio.TimeoutError:
+            pass
+        await flush()
+
+async def handle_client(reader, writer):
+    clients.add(writer)
+    log.info("🔌 Подключен процесс бота (клиентов: %s)", len(clients))
+    try:
+        while line := await reader.readline():
+            try:
+                handle_event(json.loads(line), writer)
+            except (ValueError, KeyError) as e:
+                log.error("⛔ Некорректное событие: %s", e)
+    finally:
+        # EOF - бот останавливается: дописываем все до закрытия, чтобы успеть отправить повышения уровня
+        await flush()
+        clients.discard(writer)
+        writer.close()
+
+async def run():
+    await db.init_database()
+
+    path = CONFIG['WORKER_SOCKET']
+    if os.path.exists(path):
+        os.unlink(path)  # Сокет от прошлого запуска
+    server = await asyncio.start_unix_server(handle_client, path)
+    log.info("🧵 Воркер слушает %s, запись пачек раз в %sс", path, CONFIG['WORKER_FLUSH_SECONDS'])
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await flush_loop(stop)
+    finally:
+        server.close()
+        await flush()
+        if xp_buffer or audit_buffer or db.xp_history_buffer:
+            log.error(
+                "⛔ Не записано: XP %s пользователей, история %s записей, аудит %s событий",
+                len(xp_buffer), len(db.xp_history_buffer), len(audit_buffer)
+            )
+        await db.close_database()
+        if os.path.exists(path):
+            os.unlink(path)
+        log.info("👋 Воркер остановлен")
+
+if __name__ == "__main__":
+    if not CONFIG['WORKER_SOCKET']:
+        raise ValueError("Путь к сокету не задан! Установите переменную WORKER_SOCKET")
+    log_listener, _ = setup_logging("[worker] ")
+    try:
+        asyncio.run(run())
+    finally:
+        log_listener.stop()
@@ -0,0 +1,270 @@
+"""
+Массовый импорт/экспорт опыта и настроек серверов через COPY
+
+Таблицы users и server_settings выгружаются и загружаются потоком
+(COPY ... TO/FROM) в CSV или в бинарном формате Postgres, без построчных
+запросов и без Discord API. Уровни после загрузки пересчитываются одним
+UPDATE по формуле бота (XP_PER_LEVEL, MAX_LEVEL).
+
+Запуск (подключение берется из DATABASE_URL, как у бота):
+    python xp_tool.py export users.csv                       # выгрузка users в CSV
+    python xp_tool.py export settings.bin --table server_settings --format binary
+    python xp_tool.py export - > users.csv                   # в stdout
+    python xp_tool.py import users.csv                       # замена значений из файла
+    python xp_tool.py import other_bot.csv --mode add        # прибавить опыт к текущему
+    python xp_tool.py seed --users 1000000                   # тестовые данные
+    python xp_tool.py recompute                              # пересчитать уровни всех пользователей
+
+CSV для импорта - с заголовком; достаточно колонки user_id (guild_id) и тех
+колонок, которые нужно загрузить, например user_id,text_xp,voice_xp.
+Пустая ячейка не меняет текущее значение у существующей строки (у новой -
+значение по умолчанию). Из повторов одного ключа в режиме replace берется последний.
+Бинарный формат загружается только из файлов, выгруженных этим же скриптом.
+"""
+
+import sys
+import csv
+import time
+import random
+import asyncio
+import argparse
+
+import asyncpg
+
+import db
+
+# ========== ОПИСАНИЕ ТАБЛИЦ ==========
+
+TABLES = {
+    'users': {
+        'key': 'user_id',
+        'columns': [
+            'user_id', 'text_xp', 'text_level', 'voice_xp', 'voice_level', 'total_xp', 'total_level',
+            'prestige', 'profile_text', 'profile_text_updated', 'last_updated'
+        ],
+        # Колонки, которые в режиме add складываются с текущими значениями
+        'additive': ['text_xp', 'voice_xp']
+    },
+    'server_settings': {
+        'key': 'guild_id',
+        'columns': ['guild_id', 'notification_channel', 'log_channel', 'last_updated'],
+        'additive': []
+    }
+}
+
+STAGING_TABLE = 'xp_tool_staging'
+STAGING_ROW = 'xp_tool_row'  # Номер строки файла во временной таблице (порядок дубликатов ключа)
+
+# Уровни - производные от опыта; IS DISTINCT FROM не трогает строки, где ничего не меняется
+RECOMPUTE_LEVELS_SQL = '''
+    UPDATE users AS u SET
+        total_xp = u.text_xp + u.voice_xp,
+        text_level = LEAST(u.text_xp / $1 + 1, $2),
+        voice_level = LEAST(u.voice_xp / $1 + 1, $2),
+        total_level = LEAST((u.text_xp + u.voice_xp) / $1 + 1, $2)
+    WHERE {where}(
+        u.total_xp IS DISTINCT FROM u.text_xp + u.voice_xp
+        OR u.text_level IS DISTINCT FROM LEAST(u.text_xp / $1 + 1, $2)
+        OR u.voice_level IS DISTINCT FROM LEAST(u.voice_xp / $1 + 1, $2)
+        OR u.total_level IS DISTINCT FROM LEAST((u.text_xp + u.voice_xp) / $1 + 1, $2)
+    )
+'''
+
+def copied_rows(status):
+    """Число строк из статуса COPY/INSERT/UPDATE ('COPY 123')"""
+    return int(status.split()[-1])
+
+def read_csv_columns(path, table):
+    """Колонки из заголовка CSV (только известные таблице, ключ обязателен)"""
+    with open(path, newline='', encoding='utf-8') as source:
+        header = next(csv.reader(source), [])
+
+    spec = TABLES[table]
+    unknown = [column for column in header if column not in spec['columns']]
+    if unknown:
+        raise ValueError(f"Неизвестные колонки для {table}: {', '.join(unknown)}")
+    if spec['key'] not in header:
+        raise ValueError(f"В CSV нет ключевой колонки {spec['key']}")
+    return header
+
+# ========== ЭКСПОРТ ==========
+
+async def export_table(conn, table, path, fmt):
+    spec = TABLES[table]
+    columns = ', '.join(spec['columns'])
+    output = sys.stdout.buffer if path == '-' else path
+
+    status = await conn.copy_from_query(
+        f"SELECT {columns} FROM {table} ORDER BY {spec['key']}",
+        output=output,
+        format=fmt,
+        header=True if fmt == 'csv' else None
+    )
+    return copied_rows(status)
+
+# ========== ИМПОРТ ==========
+
+async def create_staging(conn, table):
+    """Временная таблица той же структуры без ограничений - в нее COPY, потом слияние (merge_staging)"""
+    await conn.execute(f'''
+        CREATE TEMP TABLE {STAGING_TABLE} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP
+    ''')
+    # COPY с явным списком колонок заполняет ее по порядку строк файла
+    await conn.execute(f'ALTER TABLE {STAGING_TABLE} ADD COLUMN {STAGING_ROW} BIGSERIAL')
+
+async def merge_staging(conn, table, columns, mode):
+    """
+    Загрузка из временной таблицы: недостающие строки создаются со значениями колонок
+    по умолчанию, затем одним UPDATE на все строки накладываются значения из файла.
+    Пустое значение (NULL) оставляет текущее значение колонки, у новой строки - DEFAULT.
+    Дубликаты ключа: в режиме add опыт суммируется, иначе берется последняя строка файла
+    """
+    spec = TABLES[table]
+    key = spec['key']
+    values = [column for column in columns if column != key]
+
+    # Только ключ: пустые ячейки не превращаются в NULL-опыт у новых пользователей.
+    # Строку, созданную ботом между этими запросами, UPDATE ниже тоже обновит
+    status = await conn.execute(f'''
+        INSERT INTO {table} ({key})
+        SELECT DISTINCT {key} FROM {STAGING_TABLE}
+        ON CONFLICT ({key}) DO NOTHING
+    ''')
+    if not values:
+        return copied_rows(status)
+
+    if mode == 'add':
+        # Опыт из нескольких строк одного пользователя суммируется, для остальных колонок берется MAX
+        select_list = ', '.join(
+            [key] + [
+                f'SUM({column})::INTEGER' if column in spec['additive'] else f'MAX({column})'
+                for column in values
+            ]
+        )
+        source = f'SELECT {select_list} FROM {STAGING_TABLE} GROUP BY {key}'
+        update = ', '.join(
+            f'{column} = GREATEST(t.{column} + COALESCE(s.{column}, 0), 0)' if column in spec['additive']
+            else f'{column} = COALESCE(s.{column}, t.{column})'
+            for column in values
+        )
+    else:
+        source = (
+            f'SELECT DISTINCT ON ({key}) {", ".join(columns)} FROM {STAGING_TABLE} '
+            f'ORDER BY {key}, {STAGING_ROW} DESC'
+        )
+        update = ', '.join(f'{column} = COALESCE(s.{column}, t.{column})' for column in values)
+
+    status = await conn.execute(f'''
+        UPDATE {table} AS t SET {update}
+        FROM ({source}) AS s
+        WHERE t.{key} = s.{key}
+    ''')
+    return copied_rows(status)
+
+async def recompute_levels(conn, only_staged=False):
+    """Пересчет total_xp и уровней одним UPDATE (для всех или только для загруженных пользователей)"""
+    where = f'u.user_id IN (SELECT user_id FROM {STAGING_TABLE}) AND ' if only_staged else ''
+    status = await conn.execute(
+        RECOMPUTE_LEVELS_SQL.format(where=where),
+        db.CONFIG['XP_PER_LEVEL'],
+        db.CONFIG['MAX_LEVEL']
+    )
+    return copied_rows(status)
+
+async def import_table(conn, table, path, fmt, mode):
+    if fmt == 'binary':
+        # В бинарном COPY нет заголовка - порядок колонок как при экспорте
+        columns = TABLES[table]['columns']
+    else:
+        columns = read_csv_columns(path, table)
+
+    async with conn.transaction():
+        await create_staging(conn, table)
+        status = await conn.copy_to_table(
+            STAGING_TABLE,
+            source=path,
+            columns=columns,
+            format=fmt,
+            header=True if fmt == 'csv' else None
+        )
+        loaded = copied_rows(status)
+        merged = await merge_staging(conn, table, columns, mode)
+        recomputed = await recompute_levels(conn, only_staged=True) if table == 'users' else 0
+
+    return loaded, merged, recomputed
+
+async def seed_users(conn, count, max_xp, seed):
+    """Синтетические пользователи для тестового окружения (copy_records_to_table из генератора)"""
+    rng = random.Random(seed)
+
+    def records():
+        for index in range(count):
+            yield (10 ** 17 + index, rng.randint(0, max_xp), rng.randint(0, max_xp))
+
+    columns = ['user_id', 'text_xp', 'voice_xp']
+    async with conn.transaction():
+        await create_staging(conn, 'users')
+        status = await conn.copy_records_to_table(STAGING_TABLE, records=records(), columns=columns)
+        loaded = copied_rows(status)
+        merged = await merge_staging(conn, 'users', columns, 'replace')
+        recomputed = await recompute_levels(conn, only_staged=True)
+
+    return loaded, merged, recomputed
+
+# ========== CLI ==========
+
+async def run(args):
+    conn = await asyncpg.connect(db.CONFIG['DATABASE_URL'], timeout=db.CONFIG['DB_CONNECT_TIMEOUT'])
+    try:
+        # Загрузка в пустую базу (тестовое окружение) - схема как у бота
+        await db.run_migrations(conn)
+
+        start = time.perf_counter()
+        if args.command == 'export':
+            rows = await export_table(conn, args.table, args.path, args.format)
+            summary = f"выгружено строк: {rows}"
+        elif args.command == 'import':
+            loaded, merged, recomputed = await import_table(conn, args.table, args.path, args.format, args.mode)
+            summary = f"загружено: {loaded}, записано: {merged}, пересчитано уровней: {recomputed}"
+        elif args.command == 'seed':
+            loaded, merged, recomputed = await seed_users(conn, args.users, args.max_xp, args.seed)
+            summary = f"создано: {loaded}, записано: {merged}, пересчитано уровней: {recomputed}"
+        else:
+            async with conn.transaction():
+                recomputed = await recompute_levels(conn)
+            summary = f"пересчитано уровней: {recomputed}"
+
+        # При выгрузке в stdout там данные - отчет в stderr
+        print(f"✅ {args.command}: {summary} за {time.perf_counter() - start:.2f}с", file=sys.stderr)
+    finally:
+        await conn.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Массовый импорт/экспорт опыта через COPY")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('export', "выгрузить таблицу"), ('import', "загрузить таблицу")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('path', help="файл ('-' - stdout, только для export)")
+        command.add_argument('--table', choices=list(TABLES), default='users')
+        command.add_argument('--format', choices=['csv', 'binary'], default='csv')
+        if name == 'import':
+            command.add_argument(
+                '--mode', choices=['replace', 'add'], default='replace',
+                help="replace - значения из файла, add - прибавить опыт к текущему"
+            )
+
+    seed = commands.add_parser('seed', help="создать тестовых пользователей")
+    seed.add_argument('--users', type=int, default=100000)
+    seed.add_argument('--max-xp', type=int, default=500000)
+    seed.add_argument('--seed', type=int, default=42)
+
+    commands.add_parser('recompute', help="пересчитать уровни всех пользователей (после смены XP_PER_LEVEL)")
+
+    args = parser.parse_args(argv)
+    if args.command == 'import' and args.path == '-':
+        parser.error("импорт из stdin не поддерживается - укажите файл")
+    return args
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))